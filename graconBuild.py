@@ -0,0 +1,290 @@
+#!/usr/bin/env python2.7
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+'''
+converts all assets of a build manifest in a pool of warm worker processes
+
+command line options:
+-manifest	json manifest file. relative paths inside are relative to the manifest folder
+-processes [int] (number of worker processes, default: 0 = one per cpu core)
+-timeout [int] (seconds a job may take from submission before it counts as failed, e.g. because its worker died. default: 3600)
+
+manifest format:
+{
+  "jobs": [
+    { "name": "bg1", "tool": "graconGfx", "options": { "infile": "gfx/bg1.png", "outfilebase": "build/bg1", "palettes": 2, "transcol": "0xff00ff" } },
+    { "tool": "graconGfxAnimation", "options": { "infolder": "gfx/hero.gfx_sprite", "outfile": "build/sprites/hero.animation", "createAllocationDummy": true } },
+    { "tool": "graconMusic", "args": [ "music/title.mod", "build/title" ], "after": [ "bg1" ] }
+  ]
+}
+
+tool is the gracon script name. options are passed as command line options, booleans become on/off, hex options must be strings.
+args is an alternative raw argument list, named options in it (-name value) are picked up the same way.
+name is optional and defaults to the job index, after lists names of jobs that must complete first.
+inputs and outputs optionally list additional files a job reads or writes.
+
+jobs are ordered automatically if one reads files another one writes (input options like infile/infolder/refpalette
+against output options like outfile/outfilebase), and jobs writing the same files run in manifest order.
+this includes animations sharing one allocation dummy.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import traceback
+import multiprocessing
+import graconUserOptions
+
+
+logging.basicConfig( level=logging.INFO, format='%(message)s')
+
+TOOLS = (
+  'graconGfx',
+  'graconGfxAnimation',
+  'graconMap',
+  'graconMusic',
+  'graconFont',
+  'graconText',
+  'graconHdmaFixedColorGradient',
+  'graconHdmaPaletteGradient',
+  'graconHdmaWindowOverlay',
+  'graconHdmaZscroll',
+  'graconPaletteAnimation'
+)
+#graconGfxAnimation writes the allocation dummy unless disabled
+ALLOCATION_DUMMY_DEFAULT = True
+INPUT_OPTIONS = ('infile', 'infolder', 'refpalette')
+OUTPUT_OPTIONS = ('outfile', 'outfilebase')
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_SKIPPED = 'skipped'
+JOB_TIMEOUT = 'timeout'
+POLL_INTERVAL = 0.05
+
+
+def main():
+  options = graconUserOptions.Options( sys.argv, {
+	'manifest'		: {
+	  'value'			: '',
+	  'type'			: 'str'
+	  },
+	'processes'		: {
+	  'value'			: 0,
+	  'type'			: 'int',
+	  'max'			: 256,
+	  'min'			: 0
+	  },
+	'timeout'		: {
+	  'value'			: 3600,
+	  'type'			: 'int',
+	  'max'			: 0xffffff,
+	  'min'			: 1
+	  }
+  })
+
+  jobs = getJobs( options.get('manifest') )
+  os.chdir( os.path.dirname( os.path.abspath( options.get('manifest') ) ) )
+
+  t0 = time.time()
+  pool = multiprocessing.Pool( options.get('processes') or None, warmWorker )
+  results = runJobs( pool, jobs, options.get('timeout') )
+  if [result for result in results.values() if JOB_TIMEOUT == result['status']]:
+	#lost or hung tasks would block join forever
+	pool.terminate()
+  else:
+	pool.close()
+  pool.join()
+
+  for line in getReport( jobs, results, time.time() - t0 ):
+	logging.info( line )
+
+  if [result for result in results.values() if JOB_DONE != result['status']]:
+	sys.exit(1)
+
+
+def getJobs( manifestFileName ):
+  try:
+	manifestFile = open( manifestFileName, 'r' )
+	manifest = json.load( manifestFile )
+	manifestFile.close()
+  except IOError:
+	logging.error( 'Unable to access manifest file %s' % manifestFileName )
+	sys.exit(1)
+  except ValueError as error:
+	logging.error( 'Unable to parse manifest file %s: %s' % ( manifestFileName, error ) )
+	sys.exit(1)
+
+  jobs = []
+  for i, job in enumerate( manifest['jobs'] if type( manifest ) is dict else manifest ):
+	tool = os.path.splitext( os.path.basename( job.get( 'tool', '' ) ) )[0]
+	if tool not in TOOLS:
+	  logging.error( 'Unknown tool "%s" in job %s.' % ( job.get( 'tool', '' ), i ) )
+	  sys.exit(1)
+	jobOptions = job['options'] if 'options' in job else getArgumentOptions( [str( arg ) for arg in job.get( 'args', [] )] )
+	if 'graconGfxAnimation' == tool and not jobOptions.get( 'outfile' ) and not job.get( 'outputs' ):
+	  logging.error( 'Job %s has neither outfile nor outputs, unable to order it against animations sharing its allocation dummy.' % job.get( 'name', i ) )
+	  sys.exit(1)
+	jobs.append({
+	  'id'		: i,
+	  'name'	: str( job.get( 'name', i ) ),
+	  'tool'	: tool,
+	  'args'	: [str( arg ) for arg in job['args']] if 'args' in job else getArguments( jobOptions ),
+	  'inputs'	: [normalizePath( path ) for path in job.get( 'inputs', [] ) + [jobOptions[name] for name in INPUT_OPTIONS if jobOptions.get( name )]],
+	  'outputs'	: [normalizePath( path ) for path in job.get( 'outputs', [] ) + [jobOptions[name] for name in OUTPUT_OPTIONS if jobOptions.get( name )] + getSharedOutputs( tool, jobOptions )],
+	  'after'	: [str( name ) for name in job.get( 'after', [] )]
+	})
+
+  names = [job['name'] for job in jobs]
+  for job in jobs:
+	if names.count( job['name'] ) > 1:
+	  logging.error( 'Duplicate job name %s.' % job['name'] )
+	  sys.exit(1)
+	for name in job['after']:
+	  if name not in names:
+		logging.error( 'Job %s waits for unknown job %s.' % ( job['name'], name ) )
+		sys.exit(1)
+	job['dependencies'] = getDependencies( job, jobs )
+  return jobs
+
+
+def getArguments( jobOptions ):
+  arguments = []
+  for name in sorted( jobOptions ):
+	value = jobOptions[name]
+	if type( value ) is bool:
+	  value = 'on' if value else 'off'
+	arguments += ['-%s' % name, unicode( value ).encode( 'utf-8' )]
+  return arguments
+
+
+def getArgumentOptions( args ):
+  '''named options of a raw argument list, as the tools' option parser reads them'''
+  return dict( ( args[i][1:], args[i+1] ) for i in range( len( args ) - 1 ) if args[i].startswith( '-' ) )
+
+
+def getSharedOutputs( tool, jobOptions ):
+  '''files written by a tool besides its declared outputs that other jobs write too'''
+  sharedOutputs = []
+  if 'graconGfxAnimation' == tool and isEnabled( jobOptions.get( 'createAllocationDummy' ), ALLOCATION_DUMMY_DEFAULT ):
+	sharedOutputs.append( "%s/dummy.gfx_sprite.animation" % os.path.dirname( jobOptions.get( 'outfile', '' ) ) )
+  return sharedOutputs
+
+
+def isEnabled( value, default ):
+  '''boolean option as given in the manifest, default if left out'''
+  if None == value:
+	return default
+  return value not in ( False, 'off' )
+
+
+def normalizePath( path ):
+  return os.path.normpath( str( path ) )
+
+
+def getDependencies( job, jobs ):
+  '''ids of earlier jobs writing what job writes, plus all jobs writing what job reads'''
+  dependencies = set()
+  for other in jobs:
+	if other['id'] == job['id']:
+	  continue
+	if other['name'] in job['after']:
+	  dependencies.add( other['id'] )
+	elif other['id'] < job['id'] and set( other['outputs'] ) & set( job['outputs'] ):
+	  dependencies.add( other['id'] )
+	elif [path for path in job['inputs'] for output in other['outputs'] if isProducedBy( path, output )]:
+	  dependencies.add( other['id'] )
+  return dependencies
+
+
+def isProducedBy( path, output ):
+  '''outputs may be file name bases like outfilebase, inputs may be folders containing outputs'''
+  return path == output or path.startswith( output + '.' ) or output.startswith( path + os.sep )
+
+
+def runJobs( pool, jobs, timeout ):
+  '''submits every job as soon as all its dependencies are done, jobs depending on failed ones are skipped.
+  the pool never delivers results of tasks whose worker died, so jobs without result after timeout seconds fail'''
+  results = {}
+  pending = dict( ( job['id'], job ) for job in jobs )
+  running = {}
+
+  while pending or running:
+	for job in sorted( pending.values(), key=lambda job: job['id'] ):
+	  if [dependency for dependency in job['dependencies'] if dependency in results and JOB_DONE != results[dependency]['status']]:
+		results[job['id']] = { 'status' : JOB_SKIPPED, 'time' : 0.0, 'message' : 'dependency failed' }
+		del pending[job['id']]
+	  elif not [dependency for dependency in job['dependencies'] if dependency not in results]:
+		running[job['id']] = ( pool.apply_async( runJob, ( job['id'], job['tool'], job['args'] ) ), time.time() )
+		del pending[job['id']]
+
+	if running:
+	  finished = False
+	  for jobId, ( asyncResult, submitted ) in sorted( running.items() ):
+		if asyncResult.ready():
+		  results[jobId] = asyncResult.get()
+		elif time.time() - submitted > timeout:
+		  results[jobId] = { 'id' : jobId, 'status' : JOB_TIMEOUT, 'time' : time.time() - submitted, 'message' : 'no result after %s seconds, worker died or job hangs' % timeout }
+		else:
+		  continue
+		del running[jobId]
+		finished = True
+		if JOB_DONE != results[jobId]['status']:
+		  logging.error( 'job %s failed: %s' % ( jobs[jobId]['name'], results[jobId]['message'] ) )
+	  if not finished:
+		time.sleep( POLL_INTERVAL )
+
+	elif pending:
+	  logging.error( 'Circular job dependencies between %s.' % ', '.join( job['name'] for job in pending.values() ) )
+	  sys.exit(1)
+
+  return results
+
+
+def warmWorker():
+  '''import PIL and all tools once per worker process'''
+  from PIL import Image
+  #tools log errors only, as when run on their own
+  logging.getLogger().setLevel( logging.ERROR )
+  for tool in TOOLS:
+	__import__( tool )
+
+
+def runJob( jobId, tool, args ):
+  t0 = time.time()
+  status = JOB_DONE
+  message = ''
+  sys.argv = ['%s.py' % tool] + args
+  try:
+	__import__( tool )
+	sys.modules[tool].main()
+  except SystemExit as exit:
+	if exit.code:
+	  status = JOB_FAILED
+	  message = 'exit code %s' % exit.code
+  except Exception:
+	status = JOB_FAILED
+	message = traceback.format_exc().strip().splitlines()[-1]
+  return { 'id' : jobId, 'status' : status, 'time' : time.time() - t0, 'message' : message }
+
+
+def getReport( jobs, results, totalTime ):
+  nameLength = max( [len( job['name'] ) for job in jobs] + [4] )
+  report = ['%s  %-18s  %-7s  %s' % ( 'name'.ljust( nameLength ), 'tool', 'status', 'seconds' )]
+  for job in jobs:
+	result = results[job['id']]
+	report.append( '%s  %-18s  %-7s  %.2f' % ( job['name'].ljust( nameLength ), job['tool'][len( 'gracon' ):], result['status'], result['time'] ) )
+
+  jobTime = sum( result['time'] for result in results.values() )
+  failed = len( [result for result in results.values() if result['status'] in ( JOB_FAILED, JOB_TIMEOUT )] )
+  skipped = len( [result for result in results.values() if JOB_SKIPPED == result['status']] )
+  report.append( '%s jobs, %s failed, %s skipped, %.2f seconds of conversion in %.2f seconds' % ( len( jobs ), failed, skipped, jobTime, totalTime ) )
+  return report
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python2.7
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+'''
+content-addressed conversion cache shared by the gracon tools
+
+cache entries are keyed by a hash of all input file contents, the effective option set and the source of the gracon modules involved.
+a hit copies the stored output files into place instead of running the conversion.
+
+environment:
+GRACON_CACHE		cache folder. caching is disabled if unset
+GRACON_CACHE_SIZE	maximum cache size in megabytes, least recently used entries are evicted beyond that (default: 256)
+GRACON_CACHE_LINK	set to "on" to hardlink outputs on cache hits instead of copying them.
+			only safe as long as outputs are replaced, not rewritten in place by other tools
+
+command line options:
+-clear [on|off] (remove all cache entries and statistics, default: off)
+
+without options, a hit/miss report per tool and the current cache size is printed.
+'''
+
+import os
+import sys
+import glob
+import types
+import shutil
+import hashlib
+import tempfile
+import logging
+import graconUserOptions
+
+
+CACHE_FORMAT = '1'
+CACHE_SIZE_DEFAULT = 256
+MANIFEST_NAME = 'manifest'
+LOG_NAME = 'log'
+TEMP_PREFIX = 'tmp'
+BLOCK_SIZE = 0x10000
+#options not affecting output
+UNKEYED_SETTINGS = ('processes',)
+
+
+def main():
+  logging.basicConfig( level=logging.INFO, format='%(message)s')
+  options = graconUserOptions.Options( sys.argv, {
+	'clear'		: {
+	  'value'			: False,
+	  'type'			: 'bool'
+	  }
+  })
+
+  cacheFolder = getCacheFolder()
+  if not cacheFolder:
+	logging.error( 'GRACON_CACHE is not set, caching is disabled.' )
+	sys.exit(1)
+
+  if options.get('clear'):
+	clear( cacheFolder )
+	logging.info( 'cleared cache %s' % cacheFolder )
+	return
+
+  for line in getReport( cacheFolder ):
+	logging.info( line )
+
+
+def run( settings, inputs, outputs, convert ):
+  '''runs convert() unless a cache entry for same settings and inputs exists. convert() must write exactly the files matched by outputs (paths or glob patterns).
+  inputs matched by outputs are never removed or stored'''
+  cacheFolder = getCacheFolder()
+  if not cacheFolder:
+	return convert()
+
+  tool = getToolName()
+  entry = os.path.join( cacheFolder, getKey( settings, inputs, sys.modules.get( convert.__module__, sys.modules['__main__'] ) ) )
+  if restore( entry ):
+	logging.debug( 'cache hit for %s, %s' % ( tool, entry ) )
+	logReport( cacheFolder, 'hit', tool )
+	return
+
+  logging.debug( 'cache miss for %s, %s' % ( tool, entry ) )
+  #stale outputs must not end up in the entry, also breaks hardlinks into the cache before the tool rewrites its outputs
+  for path in getOutputPaths( outputs, inputs ):
+	os.remove( path )
+  convert()
+
+  store( entry, getOutputPaths( outputs, inputs ) )
+  logReport( cacheFolder, 'miss', tool )
+  evict( cacheFolder, getCacheSize() )
+
+
+def getCacheFolder():
+  cacheFolder = os.environ.get( 'GRACON_CACHE', '' )
+  if cacheFolder and not os.path.isdir( cacheFolder ):
+	os.makedirs( cacheFolder )
+  return cacheFolder
+
+
+def getCacheSize():
+  try:
+	return int( os.environ.get( 'GRACON_CACHE_SIZE', CACHE_SIZE_DEFAULT ) ) * 1024 * 1024
+  except ValueError:
+	logging.error( 'Invalid GRACON_CACHE_SIZE %s.' % os.environ.get( 'GRACON_CACHE_SIZE' ) )
+	sys.exit(1)
+
+
+def getToolName():
+  return os.path.splitext( os.path.basename( sys.argv[0] ) )[0] or 'library'
+
+
+def getKey( settings, inputs, module ):
+  digest = hashlib.sha1( CACHE_FORMAT )
+  for sourceFile in getSourceFiles( module ):
+	digest.update( os.path.basename( sourceFile ) )
+	hashFile( digest, sourceFile )
+
+  settings = [( name, value ) for name, value in settings.items() if name not in UNKEYED_SETTINGS] if hasattr( settings, 'items' ) else settings
+  digest.update( repr( [getSettingValue( value ) for value in settings] ) )
+
+  for path in inputs:
+	if path:
+	  hashPath( digest, path )
+  return digest.hexdigest()
+
+
+def getSourceFiles( module ):
+  '''tool module and all gracon modules it imports, the tool version is implied by their source. independent of other tools loaded into the same process'''
+  sourceFiles = set()
+  pending = [module]
+  while pending:
+	current = pending.pop()
+	if not getattr( current, '__file__', None ):
+	  continue
+	sourceFile = os.path.abspath( os.path.splitext( current.__file__ )[0] + '.py' )
+	if sourceFile in sourceFiles or not os.path.exists( sourceFile ):
+	  continue
+	sourceFiles.add( sourceFile )
+	pending += [value for value in vars( current ).values() if isinstance( value, types.ModuleType ) and value.__name__.startswith( 'gracon' )]
+  return sorted( sourceFiles, key=os.path.basename )
+
+
+def getSettingValue( value ):
+  '''objects like colors are hashed by their attributes, their repr contains memory addresses'''
+  if type( value ) in ( tuple, list ):
+	return [getSettingValue( item ) for item in value]
+  if hasattr( value, '__dict__' ):
+	return sorted( vars( value ).items() )
+  return value
+
+
+def hashPath( digest, path ):
+  digest.update( '\0%s\0' % path )
+  if os.path.isdir( path ):
+	for root, dirs, names in os.walk( path ):
+	  dirs.sort()
+	  for name in sorted( names ):
+		filePath = os.path.join( root, name )
+		digest.update( '\0%s\0' % os.path.relpath( filePath, path ) )
+		hashFile( digest, filePath )
+  elif os.path.isfile( path ):
+	hashFile( digest, path )
+  else:
+	digest.update( '\0missing\0' )
+
+
+def hashFile( digest, path ):
+  with open( path, 'rb' ) as inFile:
+	for block in iter( lambda: inFile.read( BLOCK_SIZE ), '' ):
+	  digest.update( block )
+
+
+def getOutputPaths( outputs, inputs ):
+  paths = []
+  for output in outputs:
+	if not output:
+	  continue
+	if glob.has_magic( output ):
+	  paths += sorted( glob.glob( output ) )
+	elif os.path.isfile( output ):
+	  paths.append( output )
+  inputPaths = set( os.path.abspath( path ) for path in inputs if path )
+  return [path for path in paths if os.path.abspath( path ) not in inputPaths]
+
+
+def restore( entry ):
+  try:
+	with open( os.path.join( entry, MANIFEST_NAME ), 'r' ) as manifest:
+	  paths = manifest.read().splitlines()
+  except IOError:
+	return False
+
+  link = 'on' == os.environ.get( 'GRACON_CACHE_LINK', 'off' )
+  try:
+	for i in range( len( paths ) ):
+	  if os.path.lexists( paths[i] ):
+		os.remove( paths[i] )
+	  elif os.path.dirname( paths[i] ) and not os.path.isdir( os.path.dirname( paths[i] ) ):
+		os.makedirs( os.path.dirname( paths[i] ) )
+	  copyFile( os.path.join( entry, str( i ) ), paths[i], link )
+
+	#manifest modification time is what least recently used eviction goes by
+	os.utime( os.path.join( entry, MANIFEST_NAME ), None )
+  except ( IOError, OSError ):
+	#entry evicted by concurrent build meanwhile, convert again
+	return False
+  return True
+
+
+def copyFile( source, target, link ):
+  if link:
+	try:
+	  os.link( source, target )
+	  return
+	except OSError:
+	  pass
+  shutil.copyfile( source, target )
+
+
+def store( entry, paths ):
+  '''entry is assembled in a temporary folder first, so concurrent builds never see partial entries'''
+  tempFolder = tempfile.mkdtemp( prefix=TEMP_PREFIX, dir=os.path.dirname( entry ) )
+  for i in range( len( paths ) ):
+	shutil.copyfile( paths[i], os.path.join( tempFolder, str( i ) ) )
+  with open( os.path.join( tempFolder, MANIFEST_NAME ), 'w' ) as manifest:
+	manifest.write( ''.join( '%s\n' % path for path in paths ) )
+
+  try:
+	os.rename( tempFolder, entry )
+  except OSError:
+	shutil.rmtree( tempFolder, True )
+
+
+def evict( cacheFolder, maxSize ):
+  entries = getEntries( cacheFolder )
+  totalSize = sum( entry['size'] for entry in entries )
+  for entry in sorted( entries, key=lambda entry: entry['used'] ):
+	if totalSize <= maxSize:
+	  break
+	shutil.rmtree( entry['path'], True )
+	totalSize -= entry['size']
+
+
+def getEntries( cacheFolder ):
+  entries = []
+  for name in os.listdir( cacheFolder ):
+	path = os.path.join( cacheFolder, name )
+	manifest = os.path.join( path, MANIFEST_NAME )
+	if name.startswith( TEMP_PREFIX ) or not os.path.isfile( manifest ):
+	  continue
+	try:
+	  entries.append({
+		'path' : path,
+		'size' : sum( os.path.getsize( os.path.join( path, fileName ) ) for fileName in os.listdir( path ) ),
+		'used' : os.path.getmtime( manifest )
+	  })
+	except OSError:
+	  #evicted by concurrent build
+	  pass
+  return entries
+
+
+def logReport( cacheFolder, result, tool ):
+  '''single appended line per run, short enough to stay intact with concurrent builds'''
+  with open( os.path.join( cacheFolder, LOG_NAME ), 'a' ) as logFile:
+	logFile.write( '%s %s\n' % ( result, tool ) )
+
+
+def getReport( cacheFolder ):
+  tools = {}
+  try:
+	with open( os.path.join( cacheFolder, LOG_NAME ), 'r' ) as logFile:
+	  for line in logFile:
+		result, tool = line.split()
+		tools.setdefault( tool, { 'hit' : 0, 'miss' : 0 } )[result] += 1
+  except IOError:
+	pass
+
+  report = []
+  for tool in sorted( tools ):
+	total = tools[tool]['hit'] + tools[tool]['miss']
+	report.append( '%s: %s hits, %s misses, hit rate %.1f%%' % ( tool, tools[tool]['hit'], tools[tool]['miss'], 100.0 * tools[tool]['hit'] / total ) )
+
+  entries = getEntries( cacheFolder )
+  report.append( '%s entries, %.1f of %.1f megabytes used' % ( len( entries ), sum( entry['size'] for entry in entries ) / 1048576.0, getCacheSize() / 1048576.0 ) )
+  return report
+
+
+def clear( cacheFolder ):
+  for entry in getEntries( cacheFolder ):
+	shutil.rmtree( entry['path'], True )
+  if os.path.exists( os.path.join( cacheFolder, LOG_NAME ) ):
+	os.remove( os.path.join( cacheFolder, LOG_NAME ) )
+
+
+if __name__ == "__main__":
+	main()
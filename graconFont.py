@@ -176,38 +176,33 @@ def main():
 	logging.error( 'unable to access required output-file %s' % options.get('outfile') )
 	sys.exit(1)
 
-  outFile.write(HEADER_MAGIC)
+  stream = graconGfx.ByteStream(HEADER_MAGIC)
 
-  outFile.write(chr(options.get('tilesize'))) #width
-  outFile.write(chr(options.get('tilesize'))) #height
-  outFile.write(chr(options.get('bpp')))
-  outFile.write(chr(paletteId)) #pal id
+  stream.byte(options.get('tilesize')) #width
+  stream.byte(options.get('tilesize')) #height
+  stream.byte(options.get('bpp'))
+  stream.byte(paletteId) #pal id
 
-  outFile.write(chr(((options.get('tilesize')*options.get('tilesize'))/8)*options.get('bpp'))) #tilelength in bytes
-  outFile.write(chr(last & 0xff))
-  outFile.write(chr((last & 0xff00) >> 8 ))
+  stream.byte(((options.get('tilesize')*options.get('tilesize'))/8)*options.get('bpp')) #tilelength in bytes
+  stream.word(last)
 
   paletteHash = hash(str(palette)) & 0xffff
-  outFile.write(chr(paletteHash & 0xff))
-  outFile.write(chr((paletteHash & 0xff00) >> 8 ))
-  
-  outFile.seek(HEADER_SIZE)
+  stream.word(paletteHash)
   
   for color in palette:
-    outFile.write(chr(color.getSNES() & 0xff))
-    outFile.write(chr((color.getSNES() & 0xff00) >> 8 ))
+    stream.word(color.getSNES())
 
   for char in chars[0:last]:
     widthBreak = char['width']
     if char['breakable']:
       widthBreak = widthBreak | 0x80
-    outFile.write(chr(widthBreak))
+    stream.byte(widthBreak)
 
-  i = 0
   for char in chars[0:last]:
-    i += 1
-    for byte in char['tile']:
-      outFile.write(byte)
+    stream.extend(char['tile'])
+
+  outFile.write(stream)
+  outFile.close()
     
   logging.info('Successfully wrote vwf font package file %s. containing %s chars.' % (options.get('outfile'),last))
 
@@ -218,24 +213,8 @@ def chunks(l, n):
         yield l[i:i+n]
 
 def getTileWriteStream( tiles, options ):
-  stream = []
-  for tile in tiles:
-    if len(tile) > 0:
-      bitplanes = fetchBitplanes( tile, options )
-      for i in range( 0, len( bitplanes ), 2 ):
-        while bitplanes[i].notEmpty():
-          stream.append(( chr( bitplanes[i].first() ) ))
-          stream.append(( chr( bitplanes[i+1].first() ) ))
-  return stream
-  
-def fetchBitplanes( tile, options ):
-  bitplanes = []
-  for bitPlane in range( options.get('bpp') ):
-    bitplaneTile = graconGfx.BitStream()
-    for pixel in tile:
-      bitplaneTile.writeBit( pixel >> bitPlane )
-    bitplanes.append( bitplaneTile )
-  return bitplanes  
+  tiles = [tile for tile in tiles if len(tile) > 0]
+  return graconGfx.ByteStream( graconGfx.encodeBitplanes( tiles, options.get('bpp') ) )
 
 def getpixel(image, x, y):
   return graconGfx.Color(image.getpixel((x,y)))
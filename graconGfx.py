@@ -31,6 +31,7 @@ options:
 -mode [sprite|bg] (bg mode outputs tilemap, sprite mode outputs relative tilemap for 8x8 tiles)
 -optimize [on|off] (don't rearrange tiles & don't output tilemap, default: on)
 -transcol 0x[15bit transparent color] (every pixel having this color AFTER reducing image colordepth to snes 15bit format will be considered transparent. format: -bbbbbgg gggrrrrr default: 0x7C1F (pink))
+-maxtiles [int] (maximum amount of unique tiles. closest tiles get merged until image fits, default: 1023)
 -tilethreshold [int] (total difference in pixel color acceptable for two tiles to be considered the same. Cranking this value up potentially results in fewer tiles used in the converted image. this is meant to help identify parts of the image that may be optimized. default: 0)
 -verify [on|off] (additionaly output converted image in png format(useful to verify that converted image looks fine)
 
@@ -38,6 +39,11 @@ possible input formats are: all supported by python Image module (png, gif, etc.
 input image alpha channel or transparency(gif/png) is dismissed completely. Relevant to transparent color of converted image is option -transcol" and nothing else.
 image size will be padded to a multiple of tilesize and padded parts are filled with transparent color(palette color index 0).
 
+library use:
+  conversion = graconGfx.convert( 'image.png', bpp=4, palettes=2 )
+  source may also be a PIL image. options are passed as keyword arguments, errors raise graconGfx.ConversionError.
+  conversion.tileStream, .paletteStream, .tilemapStream hold the output bytes, conversion.tiles/.palettes the entities and conversion.statistics the tile counts.
+
 format sprite tilemap (spritetilemap):
   x/y-offset relative to upper left corner of source image
   byte	0			1			2		3
@@ -69,8 +75,11 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 import graconUserOptions
+import graconCache
 import copy
-import subprocess
+import heapq
+import numpy
+import lz4.frame
 
 
 logging.basicConfig( level=logging.ERROR, format='%(message)s')
@@ -79,11 +88,74 @@ MAX_COLOR_COUNT = 256
 INFINITY = 1e300000
 BG_TILEMAP_SIZE = 32
 LOOKBACK_TILES = 128
+TILE_SEARCH_BATCH = 64
+MIRROR_CONFIGS = (
+  { 'x' : False, 'y' : False },
+  { 'x' : True, 'y' : False },
+  { 'x' : False, 'y' : True },
+  { 'x' : True, 'y' : True },
+)
+NIBBLE_SWAP_LUT = numpy.array([((byte & 0xf) << 4) | (byte >> 4) for byte in range(256)], dtype=numpy.uint8)
 NOISE_FACTOR = 700
 
 
 def main():
-  options = graconUserOptions.Options( sys.argv, {
+  options = getOptions( sys.argv )
+  try:
+    graconCache.run( options, [options.get('infile'), options.get('refpalette')], getOutputFileNames( options ), lambda: convertFile( options ) )
+  except ConversionError as error:
+    logging.error( error )
+    sys.exit(1)
+
+def convertFile( options ):
+  conversion = convertImage( options.get('infile'), options )
+  writeOutputFiles( conversion, options )
+
+  stats = conversion.statistics
+  logging.info('conversion complete, optimized from %s to %s tiles, %s palettes used. Wasted %s seconds' % (stats.totalTiles, stats.actualTiles, stats.actualPalettes, stats.timeWasted))
+
+def getOutputFileNames( options ):
+  return ["%s.%s" % ( options.get('outfilebase'), ext ) for ext in ('tiles', 'palette', 'tilemap', 'palette.sample.png', 'image.sample.png')]
+
+def convert( source, **values ):
+  '''library entry point, converts image file or PIL image in memory. takes the command line options as keyword arguments, raises ConversionError instead of exiting'''
+  try:
+    options = getOptions( [], values, True )
+  except graconUserOptions.OptionsError as error:
+    raise ConversionError( str(error) )
+  return convertImage( source, options )
+
+def convertImage( source, options ):
+  t0 = time.clock()
+  inputImage = getInputImage( options, source )
+  tiles = parseTiles(inputImage, options)['normal']
+  
+  #lossy, gets global palette, but every color is in there only once
+  optimizedPalette = fetchGlobalPaletteTileRelative(tiles, options)
+  #lossless, gets global palette by merging down every palette of every tile as efficiently as possible. doesn't reduce color depth yet
+  palettizedTiles = palettizeTiles( tiles, optimizedPalette, options )
+  
+  if options.get('optimize'):
+    optimizedTiles = clusterTiles( optimizeTilesNew( palettizedTiles, None, options ), options )
+  else:
+    optimizedTiles = palettizedTiles
+
+  return Conversion( optimizedTiles, optimizedPalette, inputImage, options, t0 )
+
+def getOptions( args, values=None, raiseErrors=False ):
+  options = graconUserOptions.Options( args, getDefaultOptions(), values, raiseErrors )
+  options.set('transcol', Color(getColorTuple(options.get('transcol'))))
+
+  if options.get('directcolor'):
+    options.set('bpp', 8)
+    options.set('palettes', 1)
+  
+  if not options.get('outfilebase') and isinstance( options.get('infile'), basestring ):
+    options.set('outfilebase', options.get('infile'))
+  return options
+
+def getDefaultOptions():
+  return {
 	'bpp' 		: {
 	  'value'			: 4,
 	  'type'			: 'int',
@@ -210,44 +282,7 @@ def main():
       'value'           : False,
       'type'            : 'bool'
     }
-  })
-  
-  options.set('transcol', Color(getColorTuple(options.get('transcol'))))
-    
-  t0 = time.clock()
-
-  if options.get('directcolor'):
-    options.set('bpp', 8)
-    options.set('palettes', 1)
-  
-  if not options.get('outfilebase'):
-    options.set('outfilebase', options.get('infile'))
-    
-  inputImage = getInputImage( options, options.get('infile'))  
-  tiles = parseTiles(inputImage, options)['normal']
-  
-  #lossy, gets global palette, but every color is in there only once
-  optimizedPalette = fetchGlobalPaletteTileRelative(tiles, options)
-  #lossless, gets global palette by merging down every palette of every tile as efficiently as possible. doesn't reduce color depth yet
-  palettizedTiles = palettizeTiles( tiles, optimizedPalette, options )
-  
-  
-  #stupid hack that ensures certain amount of tiles are never exceeded for any given picture
-  adder = 10
-  if options.get('optimize'):
-    optimizedTiles = optimizeTilesNew( palettizedTiles, None, options )
-    while len([tile for tile in optimizedTiles if tile['refId'] == None]) > options.get('maxtiles'):
-      options.set('tilethreshold', options.get('tilethreshold') + adder)
-      logging.info('maxtiles %s exceed, running again with threshold %s.' % (options.get('maxtiles'), options.get('tilethreshold')))
-      optimizedTiles = optimizeTilesNew( palettizedTiles, None, options )
-      adder = adder + (adder/2)
-  else:
-    optimizedTiles = palettizedTiles
-    
-  writeOutputFiles(optimizedTiles, optimizedPalette, inputImage, options)
-
-  stats = Statistics(optimizedTiles, optimizedPalette, t0)
-  logging.info('conversion complete, optimized from %s to %s tiles, %s palettes used. Wasted %s seconds' % (stats.totalTiles, stats.actualTiles, stats.actualPalettes, stats.timeWasted))
+  }
 
 def debugLogTileStatus(tiles):
   for tile in tiles:
@@ -263,28 +298,18 @@ def getReferencePaletteImage( options ):
 	return getInputImageNoResolutionSet(options, options.get('refpalette')) if options.get('refpalette') else []
 
   
-def writeOutputFiles(tiles, palettes, image, options):
-  outTiles = augmentOutIds(tiles)
-  outPalettes = augmentOutIds(palettes)
-  
-  tileFile = getOutputFile( options, ext='tiles' )
-  [tileFile.write(char) for char in getTileWriteStream( outTiles, options )] 
-  tileFile.close
+def writeOutputFiles(conversion, options):
+  writeOutputFile( options, 'tiles', conversion.tileStream )
 
   if not options.get('directcolor'):
-    palFile = getOutputFile( options, ext='palette' )
-    [palFile.write(char) for char in getPaletteWriteStream( outPalettes, options )] 
-    palFile.close
+    writeOutputFile( options, 'palette', conversion.paletteStream )
     if options.get('verify'):
-      writeSamplePalette(outPalettes, options)
+      writeSamplePalette(conversion.palettes, options)
 
-  tilemapFile = getOutputFile( options, ext='tilemap' )
-  tilemapStream = getSpriteTileMapStream(tiles, palettes, options, False, False) if options.get('mode') == 'sprite' else getBgTileMapStream(tiles, palettes, options, False, False)
-  [tilemapFile.write(char) for char in tilemapStream] 
-  tilemapFile.close
+  writeOutputFile( options, 'tilemap', conversion.tilemapStream )
   
   if options.get('verify'):
-	writeSampleImage(outTiles, outPalettes, image, options)
+	writeSampleImage(conversion.tiles, conversion.palettes, conversion.image, options)
 
 
 def augmentOutIds(elements):
@@ -317,48 +342,73 @@ def writeSamplePalette(palettes, options):
 
 def writeSampleImage(tiles, palettes, image, options):
   '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-  sample = Image.new( "RGB", ( image['resolutionX'], image['resolutionY'] ), options.get('transcol').getPIL())
-  for tile in tiles:
-    tileConfig = fetchTileConfig( tile, tiles, palettes )
-    if not options.get('directcolor'):
-      tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel']	#hack, copy pixels of referenced tile into current tile
-
-    actualTile = mirrorTile( tile, { 'x' : tileConfig['xMirror'], 'y' : tileConfig['yMirror'] } )
-    actualPalette = palettes[tileConfig['palId']]
-    for yPos in range(len(actualTile['pixel'])):
-      for xPos in range(len(actualTile['pixel'][yPos])):
-        if options.get('directcolor'):
-          pixel = actualTile['pixel'][yPos][xPos]
-        else:
-          colorIndex = actualTile['pixel'][yPos][xPos]
-          pixel = actualPalette['color'][colorIndex]
-        pixelPos = (actualTile['x']+xPos, actualTile['y']+yPos)
-        sample.putpixel(pixelPos,pixel.getPIL())
+  sample = getSampleCanvas( image['resolutionX'], image['resolutionY'], options )
+  drawSampleTiles( sample, tiles, tiles, resolveTileReferences(tiles, palettes), getPaletteRgbTable(palettes, options), options )
   outFileName = "%s.%s" % ( options.get('outfilebase'), 'image.sample.png' )
-  sample.save( outFileName, 'PNG' )
+  Image.fromarray( sample, 'RGB' ).save( outFileName, 'PNG' )
 
 def writeSampleTileset(tiles, palettes, image, options):
   '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-  sample = Image.new( "RGB", ( image['resolutionX'], image['resolutionY'] ), options.get('transcol').getPIL() )
-  for tile in tiles:
-    if tile['refId'] == None:
-      tileConfig = fetchTileConfig( tile, tiles, palettes )
-      if not options.get('directcolor'):
-        tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel'] #hack, copy pixels of referenced tile into current tile
-
-      actualTile = mirrorTile( tile, { 'x' : tileConfig['xMirror'], 'y' : tileConfig['yMirror'] } )
-      actualPalette = palettes[tileConfig['palId']]
-      for yPos in range(len(actualTile['pixel'])):
-        for xPos in range(len(actualTile['pixel'][yPos])):
-          if options.get('directcolor'):
-            pixel = actualTile['pixel'][yPos][xPos]
-          else:
-            colorIndex = actualTile['pixel'][yPos][xPos]
-            pixel = actualPalette['color'][colorIndex]
-          pixelPos = (actualTile['x']+xPos, actualTile['y']+yPos)
-          sample.putpixel(pixelPos,pixel.getPIL())
+  sample = getSampleCanvas( image['resolutionX'], image['resolutionY'], options )
+  drawSampleTiles( sample, [tile for tile in tiles if tile['refId'] == None], tiles, resolveTileReferences(tiles, palettes), getPaletteRgbTable(palettes, options), options )
   outFileName = "%s.%s" % ( options.get('outfilebase'), 'tileset.sample.png' )
-  sample.save( outFileName, 'PNG' )
+  Image.fromarray( sample, 'RGB' ).save( outFileName, 'PNG' )
+
+def getSampleCanvas( width, height, options, channels=3 ):
+  canvas = numpy.empty( ( height, width, channels ), dtype=numpy.uint8 )
+  canvas[:,:] = (options.get('transcol').getPIL() + (0xff,))[:channels]
+  return canvas
+
+def getPaletteRgbTable( palettes, options ):
+  '''rgb lookup table indexed by palette id and color index'''
+  width = max( [2 ** options.get('bpp')] + [len(palette['color']) for palette in palettes] )
+  table = numpy.zeros( ( max( len(palettes), 1 ), width, 3 ), dtype=numpy.uint8 )
+  for paletteId in range(len(palettes)):
+    colors = [color.getPIL() for color in palettes[paletteId]['color']]
+    if 0 < len(colors):
+      table[paletteId, :len(colors)] = colors
+  return table
+
+def drawSampleTiles( canvas, drawTiles, tiles, resolution, paletteTable, options, offsetX=0, transparent=False, bigTiles=False ):
+  '''renders tiles into canvas array from tile index, palette and mirror lookups. tiles of equal size are looked up and blitted in one go'''
+  groups = {}
+  for tile in drawTiles:
+    tileId = tile['id']
+    if options.get('directcolor'):
+      pixels = getTileRgbArray(tile)
+    else:
+      pixels = numpy.asarray( tiles[resolution['tileId'][tileId]]['indexedPixel'] )
+    if resolution['yMirror'][tileId]:
+      pixels = pixels[::-1]
+    if resolution['xMirror'][tileId]:
+      pixels = pixels[:, ::-1]
+    if bigTiles:
+      pixels = getBigTileLayout(pixels)
+    groups.setdefault( pixels.shape, [] ).append( ( pixels, tile['x'] + offsetX, tile['y'], resolution['palId'][tileId] ) )
+
+  for group in groups.values():
+    pixels = numpy.array( [entry[0] for entry in group] )
+    if options.get('directcolor'):
+      rgb = pixels
+    else:
+      rgb = paletteTable[numpy.array( [entry[3] for entry in group] )[:, None, None], pixels]
+    opaque = pixels != 0 if transparent else None
+    blitTiles( canvas, rgb, numpy.array( [entry[1] for entry in group] ), numpy.array( [entry[2] for entry in group] ), opaque )
+  return canvas
+
+def getBigTileLayout( pixels ):
+  '''big sprite tiles are stored as consecutive 8x8 tiles, lay those out in rows of 4'''
+  count = len(pixels) / 8
+  columns = min( count, 4 )
+  return pixels.reshape( count / columns, columns, 8, -1 ).transpose( 0, 2, 1, 3 ).reshape( count / columns * 8, -1 )
+
+def blitTiles( canvas, rgb, xPos, yPos, opaque=None ):
+  '''copies stack of rgb tiles into canvas, clipped at canvas border. later tiles overwrite earlier ones'''
+  ys, xs = numpy.broadcast_arrays( yPos[:, None, None] + numpy.arange( rgb.shape[1] )[None, :, None], xPos[:, None, None] + numpy.arange( rgb.shape[2] )[None, None, :] )
+  visible = ( 0 <= ys ) & ( ys < canvas.shape[0] ) & ( 0 <= xs ) & ( xs < canvas.shape[1] )
+  if opaque is not None:
+    visible &= opaque
+  canvas[ys[visible], xs[visible], :3] = rgb[visible]
 
 
 def parseTiles(image, options, frameID=0):
@@ -375,11 +425,10 @@ def writeTileMap(tiles, palettes, options):
 def writeBgTileMap(tiles, palettes, options):
   '''writes successive blocks of 32x32 tile tilemaps'''
   bgTilemaps = getBgTilemaps(tiles, palettes, options)
-  outFile = getOutputFile( options, ext='tilemap' )
+  stream = ByteStream()
   for tile in [tile for tilemap in bgTilemaps for tile in tilemap]:
-	outFile.write( chr( tile & 0xff ) )
-	outFile.write( chr( (tile & 0xff00) >> 8 ) )
-  outFile.close()
+	stream.word( tile )
+  writeOutputFile( options, 'tilemap', stream )
 
 def adjustTileId(tileId, options)  :
   if 16 == options.get('tilesizex'):
@@ -391,10 +440,12 @@ def adjustTileId(tileId, options)  :
   return tileId
 
 
-def getBgTileMapStreamGlobal(tiles, globalTiles, palettes, options, xMirror, yMirror):
+def getBgTileMapStreamGlobal(tiles, globalTiles, palettes, options, xMirror, yMirror, resolution=None):
   resolutionX = options.get('resolutionx')/options.get('tilesizex')
   resolutionY = options.get('resolutiony')/options.get('tilesizey')
-  emptyTile = adjustTileId(getEmptyTileConfig(globalTiles, palettes)['concatConfig'], options)
+  if resolution == None:
+    resolution = resolveTileReferences(globalTiles, palettes)
+  emptyTile = adjustTileId(getEmptyTileConfig(globalTiles, resolution)['concatConfig'], options)
   logging.debug("resolution: %s x %s " % (resolutionX, resolutionY))
   if options.get('partitionTilemap'):    
     screensize = 0x400
@@ -412,7 +463,7 @@ def getBgTileMapStreamGlobal(tiles, globalTiles, palettes, options, xMirror, yMi
   for tile in tiles:
     tilePosX = int(math.floor(tile['x'] / options.get('tilesizex')))
     tilePosY = int(math.floor(tile['y'] / options.get('tilesizey')))
-    tileConfig = adjustTileId(fetchTileConfig( tile, globalTiles, palettes )['concatConfig'], options)
+    tileConfig = adjustTileId(fetchTileConfig( tile, resolution )['concatConfig'], options)
 
     if options.get('partitionTilemap'):
       partition = 0
@@ -431,10 +482,9 @@ def getBgTileMapStreamGlobal(tiles, globalTiles, palettes, options, xMirror, yMi
     else:
       bgTilemap[tilePosX + (tilePosY * resolutionX)] = tileConfig
     
-  stream = []
+  stream = ByteStream()
   for tile in bgTilemap:
-    stream.append( chr( tile & 0xff ) )
-    stream.append( chr( (tile & 0xff00) >> 8 ) )
+    stream.word( tile )
   return stream
   
   
@@ -443,7 +493,8 @@ def getBgTileMapStream(tiles, palettes, options, xMirror, yMirror):
 
   resolutionX = options.get('resolutionx')/options.get('tilesizex')
   resolutionY = options.get('resolutiony')/options.get('tilesizey')
-  emptyTile = adjustTileId(getEmptyTileConfig(tiles, palettes)['concatConfig'], options)
+  resolution = resolveTileReferences(tiles, palettes)
+  emptyTile = adjustTileId(getEmptyTileConfig(tiles, resolution)['concatConfig'], options)
   logging.debug("resolution: %s x %s " % (resolutionX, resolutionY))
   if options.get('partitionTilemap'):    
     screensize = 0x400
@@ -459,7 +510,7 @@ def getBgTileMapStream(tiles, palettes, options, xMirror, yMirror):
   for tile in tiles:
     tilePosX = int(math.floor(tile['x'] / options.get('tilesizex')))
     tilePosY = int(math.floor(tile['y'] / options.get('tilesizey')))
-    tileConfig = adjustTileId(fetchTileConfig( tile, tiles, palettes )['concatConfig'], options)
+    tileConfig = adjustTileId(fetchTileConfig( tile, resolution )['concatConfig'], options)
     if options.get('partitionTilemap'):
       partition = 0
       if resolutionX > 32 and resolutionY > 32:
@@ -477,20 +528,20 @@ def getBgTileMapStream(tiles, palettes, options, xMirror, yMirror):
     else:
       bgTilemap[tilePosX + (tilePosY * resolutionX)] = tileConfig
     
-  stream = []
+  stream = ByteStream()
   for tile in bgTilemap:
-    stream.append( chr( tile & 0xff ) )
-    stream.append( chr( (tile & 0xff00) >> 8 ) )
+    stream.word( tile )
   return stream
 
 
 def getBgTilemaps(tiles, palettes, options):
-  emptyTile = adjustTileId(getEmptyTileConfig(tiles, palettes)['concatConfig'], options)
+  resolution = resolveTileReferences(tiles, palettes)
+  emptyTile = adjustTileId(getEmptyTileConfig(tiles, resolution)['concatConfig'], options)
   bgTilemaps = [[emptyTile for i in range(BG_TILEMAP_SIZE * BG_TILEMAP_SIZE)] for i in range(getCurrentTilemap(options.get('resolutionx'), options.get('resolutiony'), options) + 1)]
   for tile in tiles:
     mapId = getCurrentTilemap(tile['x'], tile['y'], options)
     tilePos = getPositionInTilemap(tile['x'], tile['y'], options)
-    tileConfig = adjustTileId(fetchTileConfig( tile, tiles, palettes )['concatConfig'], options)
+    tileConfig = adjustTileId(fetchTileConfig( tile, resolution )['concatConfig'], options)
 
     try:
       bgTilemaps[mapId][tilePos] = tileConfig
@@ -499,14 +550,13 @@ def getBgTilemaps(tiles, palettes, options):
   return bgTilemaps
 
 
-def getEmptyTileConfig(tiles, palettes):
-  '''scans for empty tile, returns fake value if none found '''
+def getEmptyTileConfig(tiles, resolution):
+  '''scans for last empty tile, returns fake value if none found '''
   '''todo, do we really need an additional empty tile here sometimes?'''
-  emptyTiles = [tile for tile in tiles if tileIsEmpty(tile)]
-  try:
-	return fetchTileConfig( emptyTiles.pop(), tiles, palettes )
-  except IndexError:
-	return { 'concatConfig': 0 }
+  for tile in reversed(tiles):
+	if tileIsEmpty(tile):
+	  return fetchTileConfig( tile, resolution )
+  return { 'concatConfig': 0 }
 	
 	
 def tileIsEmpty(tile):
@@ -528,11 +578,12 @@ def getCurrentTilemap(xPos, yPos, options):
   return int(math.floor(xPos / float(BG_TILEMAP_SIZE * options.get('tilesizex'))) * math.floor(yPos / float(BG_TILEMAP_SIZE * options.get('tilesizey'))))
 
 
-def getSpriteTileMapStreamGlobal( tiles, globalTiles, palettes, options, xMirror, yMirror ):
-  options.get('resolutionx')
-  stream = []
+def getSpriteTileMapStreamGlobal( tiles, globalTiles, palettes, options, xMirror, yMirror, resolution=None ):
+  if resolution == None:
+    resolution = resolveTileReferences(globalTiles, palettes)
+  stream = ByteStream()
   for tile in tiles:
-    tileConfig = fetchSpriteTileConfig( tile, globalTiles, palettes, options )
+    tileConfig = fetchSpriteTileConfig( tile, resolution, options )
     concatInfo = tileConfig['concatConfig']
     if xMirror:
       concatInfo = concatInfo ^ (1 << 14)
@@ -541,17 +592,17 @@ def getSpriteTileMapStreamGlobal( tiles, globalTiles, palettes, options, xMirror
 
     posX = max(options.get('resolutionx')-tileConfig['x']-(tileConfig['sizemultiplier']*options.get('tilesizex')),0) if xMirror == True else tileConfig['x']
     posY = max(options.get('resolutiony')-tileConfig['y']-(tileConfig['sizemultiplier']*options.get('tilesizey')),0) if yMirror == True else tileConfig['y']
-    stream.append( chr( posX & 0xff) )
-    stream.append( chr( posY & 0xff ) )
-    stream.append( chr( concatInfo & 0xff ) )
-    stream.append( chr( (concatInfo & 0xff00) >> 8 ) )
+    stream.byte( posX )
+    stream.byte( posY )
+    stream.word( concatInfo )
 
   return stream
   
 def getSpriteTileMapStream( tiles, palettes, options, xMirror, yMirror ):
-  stream = []
+  resolution = resolveTileReferences(tiles, palettes)
+  stream = ByteStream()
   for tile in tiles:
-    tileConfig = fetchSpriteTileConfig( tile, tiles, palettes, options )
+    tileConfig = fetchSpriteTileConfig( tile, resolution, options )
     concatInfo = tileConfig['concatConfig']
     if xMirror:
       concatInfo = concatInfo ^ (1 << 14)
@@ -560,167 +611,118 @@ def getSpriteTileMapStream( tiles, palettes, options, xMirror, yMirror ):
 
     posX = max(options.get('resolutionx')-tileConfig['x']-(tileConfig['sizemultiplier']*options.get('tilesizex')),0) if xMirror == True else tileConfig['x']
     posY = max(options.get('resolutiony')-tileConfig['y']-(tileConfig['sizemultiplier']*options.get('tilesizey')),0) if yMirror == True else tileConfig['y']
-    stream.append( chr( posX & 0xff) )
-    stream.append( chr( posY & 0xff ) )
-    stream.append( chr( concatInfo & 0xff ) )
-    stream.append( chr( (concatInfo & 0xff00) >> 8 ) )
+    stream.byte( posX )
+    stream.byte( posY )
+    stream.word( concatInfo )
 
   return stream
 
 
 
 def writeSpriteTileMap( tiles, palettes, options ):
-  outFile = getOutputFile( options, ext='spritemap' )
+  resolution = resolveTileReferences(tiles, palettes)
+  stream = ByteStream()
   for tile in tiles:
-	tileConfig = fetchSpriteTileConfig( tile, tiles, palettes, options )
-	outFile.write( chr( tileConfig['concatConfig'] & 0xff ) )
-	outFile.write( chr( (tileConfig['concatConfig'] & 0xff00) >> 8 ) )
-	outFile.write( chr( tileConfig['x'] & 0xff ) )
-	outFile.write( chr( tileConfig['y'] & 0xff ) )
-  outFile.close()
-
-
-def fetchTileConfig( tile, tiles, palettes ):
-  actualTile = fetchActualTile( tiles, tile['id'], False, False )
-
-  #this is what it was before, and this produced bad palette ids for bg tiles in JPR. when using actualTile, everything was fine. Maybe there are cases where one or the other is correct?
-  #I think the problem is that palette must be referenced across multiple tiles...
-  actualPaletteTile = fetchActualPaletteTile( tiles, tile['id'] )
-  actualPalette = fetchActualEntity( palettes, actualPaletteTile['palette']['id'] )
-
-  x = 1 if actualTile['xMirror'] else 0
-  y = 1 if actualTile['yMirror'] else 0
+	tileConfig = fetchSpriteTileConfig( tile, resolution, options )
+	stream.word( tileConfig['concatConfig'] )
+	stream.byte( tileConfig['x'] )
+	stream.byte( tileConfig['y'] )
+  writeOutputFile( options, 'spritemap', stream )
+
+
+def fetchTileConfig( tile, resolution ):
+  tileId = tile['id']
+  #palette is taken from the tile palette reference chain, not from the referenced tile. the latter produced bad palette ids for bg tiles in JPR.
+  x = 1 if resolution['xMirror'][tileId] else 0
+  y = 1 if resolution['yMirror'][tileId] else 0
   return {
 	'x' : tile['x'],
 	'y' : tile['y'],
-	'xMirror' : actualTile['xMirror'],
-	'yMirror' : actualTile['yMirror'],
-	'tileId' : actualTile['id'],
-	'palId' : actualPalette['id'],
-	'tileOutId' : actualTile['outId'],
-	'palOutId' : actualPalette['outId'],	
-	'concatConfig' : (y << 15) | (x << 14) | ((actualPalette['outId'] & 0x7) << 10) | (actualTile['outId'] & 0x3ff)
+	'xMirror' : resolution['xMirror'][tileId],
+	'yMirror' : resolution['yMirror'][tileId],
+	'tileId' : resolution['tileId'][tileId],
+	'palId' : resolution['palId'][tileId],
+	'tileOutId' : resolution['tileOutId'][tileId],
+	'palOutId' : resolution['palOutId'][tileId],	
+	'concatConfig' : (y << 15) | (x << 14) | ((resolution['palOutId'][tileId] & 0x7) << 10) | (resolution['tileOutId'][tileId] & 0x3ff)
   }
 
 
-def fetchSpriteTileConfig( tile, tiles, palettes, options ):
-  actualTile = fetchActualTile( tiles, tile['id'], False, False )
-  actualPalette = fetchActualEntity( palettes, actualTile['palette']['id'] )
+def fetchSpriteTileConfig( tile, resolution, options ):
+  tileId = tile['id']
   
   #this is for big tiles, 32x32 etc.
   idMultiplier = int(math.sqrt(len(tile['pixel']) / options.get('tilesizey')))
   if 0 == idMultiplier:
     idMultiplier = 1
   priority = 0x0
-  x = 1 if tile['xMirror'] else 0
-  y = 1 if tile['yMirror'] else 0
+  x = 1 if resolution['xMirror'][tileId] else 0
+  y = 1 if resolution['yMirror'][tileId] else 0
   return {
 	'x' : tile['x'],
 	'y' : tile['y'],
   'sizemultiplier' : idMultiplier, 
-	'xMirror' : tile['xMirror'],
-	'yMirror' : tile['yMirror'],
-	'tileId' : actualTile['id'] * idMultiplier,
-	'palId' : actualPalette['id'],
-	'tileOutId' : actualTile['outId'],
-	'palOutId' : actualPalette['outId'],	
-	'concatConfig' : (y << 15) | (x << 14) | (priority << 12) | ((actualPalette['outId'] & 0x7) << 9) | (actualTile['outId'] & 0x1ff)
+	'xMirror' : resolution['xMirror'][tileId],
+	'yMirror' : resolution['yMirror'][tileId],
+	'tileId' : resolution['tileId'][tileId] * idMultiplier,
+	'palId' : resolution['spritePalId'][tileId],
+	'tileOutId' : resolution['tileOutId'][tileId],
+	'palOutId' : resolution['spritePalOutId'][tileId],	
+	'concatConfig' : (y << 15) | (x << 14) | (priority << 12) | ((resolution['spritePalOutId'][tileId] & 0x7) << 9) | (resolution['tileOutId'][tileId] & 0x1ff)
   }
 
 def writeTiles( tiles, options ):
-  outFile = getOutputFile( options, ext='tiles' )
-  for tile in tiles:
-    if tile['refId'] == None:
-      writeBitplaneTile( outFile, tile, options )
-  outFile.close()
-
-
-def writeBitplaneTile( outFile, tile, options ):
-  bitplanes = fetchBitplanes( tile, options )
-  for i in range( 0, len( bitplanes ), 2 ):
-    while bitplanes[i].notEmpty():
-      outFile.write( chr( bitplanes[i].first() ) )
-      outFile.write( chr( bitplanes[i+1].first() ) )
+  target = 'pixel' if options.get('directcolor') else 'indexedPixel' 
+  writeOutputFile( options, 'tiles', ByteStream( encodeBitplanes( [tile[target] for tile in tiles if tile['refId'] == None], options.get('bpp') ) ) )
 
 
 def getTileWriteStream( tiles, options ):
-  stream = []
-  partitioned = []
   target = 'pixel' if options.get('directcolor') else 'indexedPixel' 
-  slices = [item for sublist in [chunks(scanline, 8) for tile in tiles for scanline in tile[target] if tile['refId'] == None] for item in sublist]
-  #pp.pprint(slices)
+  slices = getTileSlices( [tile[target] for tile in tiles if tile['refId'] == None] )
   targetLength = len(slices)/8
   if 16 == options.get('tilesizey') and (targetLength & 0x7f) != 0:
     targetLength = (targetLength & 0xff80) + 0x80
 
-  for i in range(targetLength):
-    tile = []
-    for y in range(8):      
-      src = i*8+y
-      if 16 == options.get('tilesizex'):
-        #barrel shift left lower 4 bits if tilewidth = 16
-        src = (src & 0xFFF0) | ((src & 0x7) << 1) | ((src & 0x8) >> 3)
-      if 16 == options.get('tilesizey'):
-        #barrel shift left next 4 bits if tileheight = 16
-        src = (src & 0xFF0F) | ((src & 0x70) << 1) | ((src & 0x80) >> 3)
-        
-      #pp.pprint('src $%03x -> $%03x' % (i*8+y, src))
-      #pp.pprint(slices[src])
-      try:
-        tile.append(slices[src])
-      except IndexError:
-        #pad out to multiple of 16 so that end of tiles gets converted correctly
-        tile.append([0,0,0,0,0,0,0,0])
-
-    partitioned.append(tile)
-    
-  #pp.pprint(('tiles', partitioned))
-  for tile in partitioned:
-    bitplanes = fetchBitplanes2( tile, options )
-    for i in range( 0, len( bitplanes ), 2 ):
-      while bitplanes[i].notEmpty():
-        stream.append(( chr( bitplanes[i].first() ) ))
-        stream.append(( chr( bitplanes[i+1].first() ) ))
-  return stream
-
-def fetchBitplanes2( tile, options ):
-  bitplanes = []
-  for bitPlane in range( options.get('bpp') ):
-    bitplaneTile = BitStream()
-    for pixel in [pixel for scanline in tile for pixel in scanline]:
-      bitplaneTile.writeBit( pixel >> bitPlane )
-    bitplanes.append( bitplaneTile )
-  return bitplanes
+  src = numpy.arange( targetLength*8 )
+  if 16 == options.get('tilesizex'):
+    #barrel shift left lower 4 bits if tilewidth = 16
+    src = (src & 0xFFF0) | ((src & 0x7) << 1) | ((src & 0x8) >> 3)
+  if 16 == options.get('tilesizey'):
+    #barrel shift left next 4 bits if tileheight = 16
+    src = (src & 0xFF0F) | ((src & 0x70) << 1) | ((src & 0x80) >> 3)
+
+  #pad out to multiple of 16 so that end of tiles gets converted correctly
+  padded = numpy.zeros( ( max( len(slices), src.max()+1 if len(src) else 0 ), 8 ), dtype=slices.dtype )
+  padded[:len(slices)] = slices
+  return ByteStream( encodeBitplanes( padded[src], options.get('bpp') ) )
+
+def getTileSlices( tiles ):
+  '''split tile scanlines into 8 pixel wide slices, ordered by tile, scanline, slice'''
+  if 0 == len(tiles):
+    return numpy.zeros( ( 0, 8 ), dtype=numpy.int32 )
+  return numpy.concatenate( [numpy.asarray( tile, dtype=numpy.int32 ).reshape( -1, 8 ) for tile in tiles] )
+
+def encodeBitplanes( tiles, bpp ):
+  '''encode indexed 8x8 tiles to snes planar format, bitplanes interleaved pairwise per scanline'''
+  tiles = numpy.asarray( tiles, dtype=numpy.int32 ).reshape( -1, 1, 8, 8 )
+  planes = ( ( tiles >> numpy.arange( bpp ).reshape( 1, -1, 1, 1 ) ) & 1 ).astype( numpy.uint8 )
+  rows = numpy.packbits( planes, axis=3 ).reshape( len(tiles), bpp, 8 )
+  pairs = rows[:, :bpp & ~1].reshape( len(tiles), bpp/2, 2, 8 ).transpose( 0, 1, 3, 2 ).reshape( len(tiles), (bpp & ~1)*8 )
+  #odd bitplane count, last plane is stored on its own
+  return numpy.concatenate( ( pairs, rows[:, bpp & ~1:].reshape( len(tiles), (bpp & 1)*8 ) ), axis=1 ).tostring()
 
 def getPaletteWriteStream( palettes, options ):
-  stream = []
+  stream = ByteStream()
   for color in [pixel for palette in [palette for palette in palettes if palette['refId'] == None] for pixel in palette['color']]:
-    stream.append(chr((color.getSNES() & 0xff)))
-    stream.append(chr((color.getSNES() & 0xff00) >> 8 ))
+    stream.word( color.getSNES() )
   return stream
 
 
-def fetchBitplanes( inputTile, options ):
-  bitplanes = []
-  target = 'pixel' if options.get('directcolor') else 'indexedPixel' 
-  for tile in [inputTile[target]]:
-    for bitPlane in range( options.get('bpp') ):
-      bitplaneTile = BitStream()
-      for pixel in [pixel for scanline in tile for pixel in scanline]:
-        bitplaneTile.writeBit( pixel >> bitPlane )
-      bitplanes.append( bitplaneTile )
-  return bitplanes
-
-
 def chunks(l, n):
     return [l[i:i+n] for i in range(0, len(l), n)]  
   
 def writePalettes( palettes, options ):
-  outFile = getOutputFile( options, ext='palette' )
-  for color in [pixel for palette in [palette for palette in palettes if palette['refId'] == None] for pixel in palette['color']]:
-    outFile.write(chr((color.getSNES() & 0xff)))
-    outFile.write(chr((color.getSNES() & 0xff00) >> 8 ))
-  outFile.close()
+  writeOutputFile( options, 'palette', getPaletteWriteStream( palettes, options ) )
 
 
 def getOutputFile( options, ext ):
@@ -728,47 +730,63 @@ def getOutputFile( options, ext ):
   try:
 	outFile = open( outFileName, 'wb' )
   except IOError:
-	logging.error( 'unable to access output file %s' % outFileName )
-	sys.exit(1)
+	raise ConversionError( 'unable to access output file %s' % outFileName )
   return outFile
 
 
+def writeOutputFile( options, ext, stream ):
+  '''writes complete output stream to file in one go'''
+  outFile = getOutputFile( options, ext )
+  outFile.write( stream )
+  outFile.close()
+
+
 def palettizeTiles( tiles, palettes, options ):
   '''replaces direct tile colors with best-matching entries of assigned palette'''
-  return [(tile if tile['refId'] != None else palettizeTile( tile, palettes, options )) for tile in tiles]
-
-
-def findOptimumTilePalette(palettes, pixels):
-  optimumPalette = { 'error' : INFINITY }
-  for palette in [pal for pal in palettes if pal['refId'] == None]:
-	squareError = 0
-	for similarColor in [getSimilarColor( pixel, palette['color'] ) for scanline in pixels for pixel in scanline]:
-		squareError += similarColor['error'] * similarColor['error']
-	palette['error'] = math.sqrt(squareError)
-	optimumPalette = palette if palette['error'] < optimumPalette['error'] else optimumPalette
-  return optimumPalette
-
-
-def palettizeTile( tile, palettes, options ):
-  palette = findOptimumTilePalette(palettes, tile['pixel'])
-
-  indexedScanlines = []
-  scanlines = []
-
-  for scanline in tile['pixel']:
-    indexedPixels = []
-    pixels = []
-    for pixel in scanline:
-      similarColor = getSimilarColor( pixel, palette['color'] )
-      if options.get('forcePalette') and (similarColor['error'] != 0):
-        maxi = 0
-        indexedPixels.append(maxi)
-        pixels.append(palette['color'][maxi])
-      else:
-        indexedPixels.append( palette['color'].index(similarColor['value']) )
-        pixels.append(similarColor['value'])
-    scanlines.append(pixels)
-    indexedScanlines.append(indexedPixels)
+  sourceTiles = [tile for tile in tiles if tile['refId'] == None]
+  palettes = [palette for palette in palettes if palette['refId'] == None]
+  if 0 == len(sourceTiles):
+    return tiles
+  packed = [pixel.getRGB() for tile in sourceTiles for scanline in tile['pixel'] for pixel in scanline]
+  bounds = numpy.cumsum([0] + [sum([len(scanline) for scanline in tile['pixel']]) for tile in sourceTiles])
+  colors, inverse = numpy.unique(packed, return_inverse=True)
+  colors = numpy.stack(((colors >> 16) & 0xff, (colors >> 8) & 0xff, colors & 0xff), axis=1)
+
+  matches = [getPaletteMatches( colors, palette ) for palette in palettes]
+  errors = numpy.array([match['error'] for match in matches])[:, inverse]
+  #tiles x palettes square error matrix, first palette wins ties
+  optimumPalettes = numpy.argmin(numpy.add.reduceat(errors, bounds[:-1], axis=1), axis=0)
+
+  palettized = {}
+  for i in range(len(sourceTiles)):
+    match = matches[optimumPalettes[i]]
+    pixels = inverse[bounds[i]:bounds[i+1]]
+    palettized[id(sourceTiles[i])] = palettizeTile( sourceTiles[i], palettes[optimumPalettes[i]], match['index'][pixels], match['value'][pixels], match['error'][pixels], options )
+  return [(tile if tile['refId'] != None else palettized[id(tile)]) for tile in tiles]
+
+
+def getPaletteMatches( colors, palette ):
+  '''for each (r, g, b) color, index, value position and square error of most similar palette color, like getSimilarColor'''
+  refColors = numpy.array([color.getRGBtuple() for color in palette['color']], dtype=numpy.int64)
+  redMean = colors[:, numpy.newaxis, 0] + refColors[numpy.newaxis, :, 0] / 2
+  diff = colors[:, numpy.newaxis] - refColors[numpy.newaxis]
+  errors = (((512+redMean)*diff[:,:,0]*diff[:,:,0])>>8) + 4*diff[:,:,1]*diff[:,:,1] + (((767-redMean)*diff[:,:,2]*diff[:,:,2])>>8)
+  #last of equally similar colors wins, its index is that of first identical palette color
+  value = len(palette['color']) - 1 - numpy.argmin(errors[:, ::-1], axis=1)
+  firstIndex = numpy.array([palette['color'].index(color) for color in palette['color']])
+  return {
+    'index' : firstIndex[value],
+    'value' : value,
+    'error' : errors.min(axis=1)
+  }
+
+
+def palettizeTile( tile, palette, indices, values, errors, options ):
+  if options.get('forcePalette'):
+    indices = numpy.where(errors != 0, 0, indices)
+    values = numpy.where(errors != 0, 0, values)
+  indexedScanlines = indices.reshape(len(tile['pixel']), -1).tolist()
+  scanlines = [[palette['color'][value] for value in scanline] for scanline in values.reshape(len(tile['pixel']), -1).tolist()]
   return {
 	'indexedPixel'	: indexedScanlines,
 	'pixel'			: scanlines,
@@ -788,27 +806,60 @@ def palettizeTile( tile, palettes, options ):
   }
 
 
-def fetchActualTile( entities, entityId, xStatus, yStatus ):
-  if entities[entityId]['refId'] == None:
-    tile = entities[entityId]
-    tile['xMirror'] = xStatus
-    tile['yMirror'] = yStatus
-    return tile
-  else:
-    return fetchActualTile( entities, entities[entityId]['refId'], entities[entityId]['xMirror'] ^ xStatus, entities[entityId]['yMirror'] ^ yStatus )
-
-def fetchActualPaletteTile(entities, entityId):
-  return entities[entityId] if entities[entityId]['palette']['refId'] == None else fetchActualPaletteTile( entities, entities[entityId]['palette']['refId'] )
+def resolveTileReferences( tiles, palettes ):
+  '''flattens tile, tile palette and palette reference chains into lookup lists indexed by tile id, with mirror bits accumulated along each chain'''
+  count = len(tiles)
+  tileIds = [None] * count
+  xMirrors = [False] * count
+  yMirrors = [False] * count
+  for tileId in range(count):
+    path = []
+    rootId = tileId
+    while tileIds[rootId] == None and tiles[rootId]['refId'] != None:
+      path.append(rootId)
+      rootId = tiles[rootId]['refId']
+    if tileIds[rootId] == None:
+      tileIds[rootId] = rootId
+    for pathId in reversed(path):
+      refId = tiles[pathId]['refId']
+      tileIds[pathId] = tileIds[refId]
+      xMirrors[pathId] = tiles[pathId]['xMirror'] ^ xMirrors[refId]
+      yMirrors[pathId] = tiles[pathId]['yMirror'] ^ yMirrors[refId]
+
+  paletteTileIds = getReferenceRoots([tile['palette']['refId'] for tile in tiles])
+  paletteIds = getReferenceRoots([palette['refId'] for palette in palettes])
+  palIds = [paletteIds[tiles[paletteTileId]['palette']['id']] for paletteTileId in paletteTileIds]
+  spritePalIds = [paletteIds[tiles[rootId]['palette']['id']] for rootId in tileIds]
+  return {
+	'tileId' : tileIds,
+	'tileOutId' : [tiles[rootId]['outId'] for rootId in tileIds],
+	'xMirror' : xMirrors,
+	'yMirror' : yMirrors,
+	'palId' : palIds,
+	'palOutId' : [palettes[palId]['outId'] for palId in palIds],
+	'spritePalId' : spritePalIds,
+	'spritePalOutId' : [palettes[palId]['outId'] for palId in spritePalIds]
+  }
 
-def fetchActualEntity( entities, entityId ):
-  return entities[entityId] if entities[entityId]['refId'] == None else fetchActualEntity( entities, entities[entityId]['refId'] )
+def getReferenceRoots( refIds ):
+  '''resolves a list of parent ids (None for roots) to root ids, compressing each chain once'''
+  rootIds = [None] * len(refIds)
+  for entityId in range(len(refIds)):
+    path = []
+    rootId = entityId
+    while rootIds[rootId] == None and refIds[rootId] != None:
+      path.append(rootId)
+      rootId = refIds[rootId]
+    if rootIds[rootId] == None:
+      rootIds[rootId] = rootId
+    for pathId in path:
+      rootIds[pathId] = rootIds[rootId]
+  return rootIds
 
 def parseGlobalPalettes( tiles, options ):
   globalPalette = fetchGlobalPalette(tiles, options)
   
-  while(len(globalPalette) > (((options.get('bpp') ** 2) - 1) * options.get('palettes'))):
-	nearestIndices = getNearestPaletteIndices( globalPalette )
-	globalPalette.pop( max( nearestIndices['id1'], nearestIndices['id2'] ) )
+  reduceColors( globalPalette, ((options.get('bpp') ** 2) - 1) * options.get('palettes') )
   return partitionGlobalPalette(globalPalette, options)
 
 def partitionGlobalPalette(palettes, options):
@@ -912,15 +963,23 @@ def fetchGlobalPaletteTileRelative(tiles, options):
     
 def removeRedundantPalettes(palettes, options):
   newPalettes = palettes.copy()
-  maxlength = 2**options.get('bpp')
+  colorBits = {}
+  masks = dict((palette, getPaletteMask(palette, colorBits)) for palette in palettes)
+  maskCounts = {}
+  for mask in masks.values():
+    maskCounts[mask] = maskCounts.get(mask, 0) + 1
+
+  #per color, all distinct palette masks containing it, biggest first
+  holders = {}
+  for mask in sorted(maskCounts.keys(), key=countColors, reverse=True):
+    for color in [bit for bit in range(mask.bit_length()) if mask >> bit & 1]:
+      holders.setdefault(color, []).append(mask)
+
   for palette in palettes:
-    for refPalette in [ref for ref in palettes if ref is not palette]:
-      currentPalette = set(palette)
-      referencePalette = set(refPalette)
-      #continue here, remove all palettes contained in others
-      if currentPalette.issubset(referencePalette):
-        newPalettes.remove(palette)
-        break
+    mask = masks[palette]
+    #palettes with identical colors are subsets of each other, all of them go
+    if maskCounts[mask] > 1 or (0 == mask and len(palettes) > 1) or isPaletteMaskContained(mask, holders):
+      newPalettes.remove(palette)
 
   #if everything was a subset of anything (1 different palette total), add longest entry in original palette
   biggestTilePalette = set()
@@ -931,19 +990,35 @@ def removeRedundantPalettes(palettes, options):
     newPalettes.add(biggestTilePalette)
     
   return newPalettes
+
+def isPaletteMaskContained(mask, holders):
+  '''true if any strictly bigger palette contains all colors of mask, only holders of its rarest color need checking'''
+  if 0 == mask:
+    return False
+  rarest = min([holders[bit] for bit in range(mask.bit_length()) if mask >> bit & 1], key=len)
+  length = countColors(mask)
+  for refMask in rarest:
+    if countColors(refMask) <= length:
+      return False
+    if refMask & mask == mask:
+      return True
+  return False
   
 def mergeMatchingPalettes(palettes, options):
   newPalettes = palettes.copy()
   maxLength = 2**options.get('bpp')
+  colorBits = {}
+  masks = dict((palette, getPaletteMask(palette, colorBits)) for palette in palettes)
 
   for palette in palettes:
     bestMatchLength = maxLength
     bestMatchRef = None
     for refPalette in [ref for ref in palettes if ref is not palette]:
-      mergedPalette = tuple(set(refPalette+palette))
-
-      if len(mergedPalette) < bestMatchLength and palette in newPalettes and refPalette in newPalettes:
-        bestMatchLength = len(mergedPalette)
+      if palette not in newPalettes or refPalette not in newPalettes:
+        continue
+      mergedLength = countColors(masks[refPalette] | masks[palette])
+      if mergedLength < bestMatchLength:
+        bestMatchLength = mergedLength
         bestMatchRef = refPalette
     if bestMatchRef:
       mergedPalette = tuple(set(bestMatchRef+palette))
@@ -979,35 +1054,53 @@ def mergeDownPalette(palettes, options):
 def mergeDownPaletteNew(palettes, options):
   palettes = list(palettes)
   maxLength = (2**options.get('bpp'))*2
-  while len(palettes) > options.get('palettes'):
-    print("retry lossy merge, palette size now %s" % len(palettes))
-    bestMatchLength = maxLength
-    bestA = None
-    bestB = None
-    
-    for t in ((i, j, len(set(palettes[i]+palettes[j]))) for i in range(len(palettes)) for j in range(len(palettes)) if j > i):
-      if t[2] < bestMatchLength:
-        bestMatchLength = t[2]
-        bestA = t[0]
-        bestB = t[1]
-
-    if bestA is not None and bestB is not None:
-      palettes.append(reducePaletteColorDepth(list(set(palettes[bestA]+palettes[bestB])), options))
-      palettes[bestA] = None
-      palettes[bestB] = None
-    else:
-      print("unable to reduce, palette size now %s" % len(palettes))
-      sys.exit(1)
-
-    palettes = [x for x in palettes if x is not None]
-
-  return set(palettes)
+  colorBits = {}
+  masks = [getPaletteMask(palette, colorBits) for palette in palettes]
+  alive = [True for palette in palettes]
+
+  #pairs ordered by merged size, then by position, just like a full rescan would pick them
+  candidates = [(countColors(masks[i] | masks[j]), i, j) for i in range(len(palettes)) for j in range(i+1, len(palettes))]
+  candidates = [candidate for candidate in candidates if candidate[0] < maxLength]
+  heapq.heapify(candidates)
+
+  remaining = len(palettes)
+  while remaining > options.get('palettes'):
+    logging.debug("retry lossy merge, palette size now %s" % remaining)
+    while candidates and not (alive[candidates[0][1]] and alive[candidates[0][2]]):
+      heapq.heappop(candidates)
+    if not candidates:
+      raise ConversionError("unable to reduce, palette size now %s" % remaining)
+
+    length, bestA, bestB = heapq.heappop(candidates)
+    palettes.append(reducePaletteColorDepth(list(set(palettes[bestA]+palettes[bestB])), options))
+    masks.append(getPaletteMask(palettes[-1], colorBits))
+    alive[bestA] = False
+    alive[bestB] = False
+    alive.append(True)
+    remaining -= 1
+
+    merged = len(palettes) - 1
+    for i in [i for i in range(merged) if alive[i]]:
+      length = countColors(masks[i] | masks[merged])
+      if length < maxLength:
+        heapq.heappush(candidates, (length, i, merged))
+
+  return set([palettes[i] for i in range(len(palettes)) if alive[i]])
+
+def getPaletteMask(palette, colorBits):
+  '''bitmask of palette colors, bits get assigned to new colors on first sight'''
+  mask = 0
+  for color in palette:
+    mask |= 1 << colorBits.setdefault(color.getRGB(), len(colorBits))
+  return mask
+
+def countColors(mask):
+  return bin(mask).count('1')
   
 def checkPaletteCount( palettes, options):
   palCount = len( [pal for pal in palettes if pal['refId'] == None] )
   if ( palCount > options.get('palettes') ):
-	logging.error( 'Image needs %s palettes, exceeds allowed amount of %s.' % ( palCount, options.get('palettes') ) )
-	sys.exit(1)
+	raise ConversionError( 'Image needs %s palettes, exceeds allowed amount of %s.' % ( palCount, options.get('palettes') ) )
     
 
 def optimizePalettes( palettes, options ):
@@ -1017,8 +1110,7 @@ def optimizePalettes( palettes, options ):
 def getPaletteById(palettes, palId):
   for palette in [pal for pal in palettes if pal['id'] == palId]:
 	return palette
-  logging.error( 'Unable find palette id %s in getPaletteById.' % palId )
-  sys.exit(1)
+  raise ConversionError( 'Unable find palette id %s in getPaletteById.' % palId )
   
 
 def getSimilarPalette( inputPalette, refPalette ):
@@ -1053,9 +1145,7 @@ def getSimilarColorIndex( color, refPalette ):
   return refPalette.index( similarColor['value'] )
   
 def reducePaletteColorDepth( palette, options ):
-  while len( palette ) >= (2**options.get('bpp')):
-    nearestIndices = getNearestPaletteIndices( palette )
-    palette.pop( max( nearestIndices['id1'], nearestIndices['id2'] ) )
+  reduceColors( palette, (2**options.get('bpp')) - 1 )
 
   palette = set(palette)
   if options.get('transcol') in palette:
@@ -1063,104 +1153,233 @@ def reducePaletteColorDepth( palette, options ):
   return tuple(palette)
 
   
-def getNearestPaletteIndices( palette ):
-  diffTable = {}
-  for i in range( 1, len( palette ) ):
-    for iRef in range( 1, len( palette ) ):
-      if i != iRef:
-        diffIndex = "%s-%s" % ( min( i, iRef ), max( i, iRef ) )
-        diffTable[diffIndex] = {
-          'difference'	: compareColors( palette[i], palette[iRef] ),
-          'id1'			: i,
-          'id2'			: iRef
-        }
-  return getMinDifferenceIds( diffTable )
-
-
-def getMinDifferenceIds( diffTable ):
-  minDiff = { 'difference' : INFINITY }
-  for diffName, diff in diffTable.iteritems():
-	minDiff = diff if diff['difference'] < minDiff['difference'] else minDiff
-  return minDiff
+def reduceColors( palette, maxLength ):
+  '''repeatedly drops the higher-indexed color of the most similar pair until palette fits maxLength. color 0 always stays'''
+  if len( palette ) <= maxLength:
+    return palette
+  rgb = numpy.array([color.getRGBtuple() for color in palette], dtype=numpy.int64)
+  low, high = numpy.triu_indices( len( palette ), 1 )
+  keep = low > 0
+  low, high = low[keep], high[keep]
+
+  #same metric as compareColors( palette[high], palette[low] )
+  redMean = rgb[high, 0] + rgb[low, 0] / 2
+  diff = rgb[high] - rgb[low]
+  difference = (((512+redMean)*diff[:,0]*diff[:,0])>>8) + 4*diff[:,1]*diff[:,1] + (((767-redMean)*diff[:,2]*diff[:,2])>>8)
+
+  #pairs never get added, so one sorted pass with lazy skipping of dropped colors is all the queue needed
+  alive = [True for color in palette]
+  length = len( palette )
+  for pair in numpy.lexsort( ( high, low, difference ) ).tolist():
+    if length <= maxLength:
+      break
+    if alive[low[pair]] and alive[high[pair]]:
+      alive[high[pair]] = False
+      length -= 1
+  palette[:] = [palette[i] for i in range( len( palette ) ) if alive[i]]
+  return palette
 
 def tilesLengthCheck(tiles, options):
   returnSize = len([tile for tile in tiles if tile['refId'] == None])
   if returnSize > options.get('maxtiles'):
-    logging.error('maxtiles %s exceed, got %s.' % (options.get('maxtiles'), returnSize))
-    sys.exit(1)
+    raise ConversionError('maxtiles %s exceed, got %s.' % (options.get('maxtiles'), returnSize))
   return tiles
 
 def getDiffErr(tr, tg, tb, rr, rg, rb):
   return (((512+((tr+rr) / 2))*(tr-rr)*(tr-rr))>>8) + 4*(tg-rg)*(tg-rg) + (((767-((tr+rr) / 2))*(tb-rb)*(tb-rb))>>8)
 
-def getTileDiffErr(bestErr, tile, ref):
-  error = 0  
-  for p in range(len(tile)):
-    error += getDiffErr(tile[p][0],tile[p][1],tile[p][2], ref[p][0],ref[p][1],ref[p][2])
-    if error > bestErr:
-      break
-  return error
+def getTileFingerprints( tiles, options ):
+  '''packed pixel strings of all four orientations (normal, x, y, xy) per tile'''
+  if 0 == len(tiles):
+    return []
+  if not options.get('directcolor') and all('indexedPixel' in tile for tile in tiles):
+    pixels = numpy.array([tile['indexedPixel'] for tile in tiles], dtype=numpy.uint8)
+    prefix = numpy.array([tile['palette']['id'] for tile in tiles], dtype=numpy.int32)
+    if options.get('bpp') <= 4 and 0 == pixels.shape[2] & 1:
+      #two pixels per byte, mirroring swaps nibbles
+      packed = (pixels[:,:,0::2] << 4) | pixels[:,:,1::2]
+      xMirrored = NIBBLE_SWAP_LUT[packed[:,:,::-1]]
+    else:
+      packed = pixels
+      xMirrored = packed[:,:,::-1]
+  else:
+    #unpalettized tiles can only be compared by color
+    packed = numpy.array([[[pixel.getRGB() for pixel in scanline] for scanline in tile['pixel']] for tile in tiles], dtype=numpy.uint32)
+    prefix = numpy.zeros(len(tiles), dtype=numpy.int32)
+    xMirrored = packed[:,:,::-1]
+  orientations = (packed, xMirrored, packed[:,::-1], xMirrored[:,::-1])
+  return [tuple(prefix[i].tostring() + orientation[i].tostring() for orientation in orientations) for i in range(len(tiles))]
 
 def optimizeTilesNewHash( tiles, refTiles, options ):
   logging.debug("optimizeTilesNewHash")
-  refhashes = {hash(str(item['indexedPixel'] if hasattr(item, 'indexedPixel') else item['pixel'])):item for sublist in [mirrorTiles(tile) for tile in refTiles] for item in sublist}
+  fingerprints = getTileFingerprints( refTiles + tiles, options )
+  refFingerprints = fingerprints[:len(refTiles)]
+  tileFingerprints = fingerprints[len(refTiles):]
+
+  #all orientations of a tile share the smallest one as key, last ref wins
+  refCanonical = {min(refFingerprints[i]):i for i in range(len(refTiles))}
 
   for i in range(len(tiles)):
     try:
-      match = refhashes[hash(str(tiles[i]['indexedPixel'] if hasattr(tiles[i], 'indexedPixel') else tiles[i]['pixel']))]
-      if tiles[i]['id'] != match['id']:
-        tiles[i]['refId'] = match['id']
-        tiles[i]['xMirror'] = match['xMirror']
-        tiles[i]['yMirror'] = match['yMirror']
+      refIndex = refCanonical[min(tileFingerprints[i])]
     except KeyError:
-      pass
+      continue
+    match = refTiles[refIndex]
+    orientation = max([o for o in range(4) if refFingerprints[refIndex][o] == tileFingerprints[i][0]])
+    if tiles[i]['id'] != match['id']:
+      tiles[i]['refId'] = match['id']
+      tiles[i]['xMirror'] = match['xMirror'] if 0 == orientation else MIRROR_CONFIGS[orientation]['x']
+      tiles[i]['yMirror'] = match['yMirror'] if 0 == orientation else MIRROR_CONFIGS[orientation]['y']
   return tiles
 
+def getTileDiffErrors(tile, refs):
+  '''getDiffErr summed over all pixels of (pixels, 3) tile against each of (n, pixels, 3) refs'''
+  mean = (tile[:,0] + refs[:,:,0]) / 2
+  diff = tile - refs
+  return ((((512+mean)*diff[:,:,0]*diff[:,:,0])>>8) + 4*diff[:,:,1]*diff[:,:,1] + (((767-mean)*diff[:,:,2]*diff[:,:,2])>>8)).sum(axis=1)
+
+def getTileCellSums(tiles):
+  '''per channel color sums of 4x4 grid of cells for (n, height, width, 3) tiles'''
+  rows = numpy.linspace(0, tiles.shape[1], 5).astype(int)[:-1]
+  cols = numpy.linspace(0, tiles.shape[2], 5).astype(int)[:-1]
+  return numpy.add.reduceat(numpy.add.reduceat(tiles, rows, axis=1), cols, axis=2).reshape(len(tiles), -1, 3)
+
+def getTileDiffLowerBounds(cellSums, refCellSums, cellSizes):
+  '''admissible lower bound of getTileDiffErrors, from 2dr^2+4dg^2+2db^2 <= getDiffErr and cauchy-schwarz over cells'''
+  diff = cellSums - refCellSums
+  return ((diff*diff) / cellSizes[:,numpy.newaxis] * numpy.array([2,4,2])).sum(axis=(1,2))
+
+def getTileRgbArray(tile):
+  return numpy.array([[(pixel.r,pixel.g,pixel.b) for pixel in scanline] for scanline in tile['pixel']], dtype=numpy.int64)
+
+def getTileSearchIndex(tiles):
+  rgb = numpy.array([getTileRgbArray(tile) for tile in tiles])
+  return {
+    'cellSums'  : getTileCellSums(rgb),
+    'cellSizes' : getTileCellSums(numpy.ones(rgb.shape[1:], dtype=numpy.int64)[numpy.newaxis])[0,:,0],
+    'pixels'    : rgb.reshape(len(tiles), -1, 3)
+  }
+
+def findNearestTile(rgb, orientations, eligible, index, errCap):
+  '''returns (error, ref position, xMirror, yMirror) of best eligible ref below errCap, or None. Ties go to last orientation, then last ref'''
+  bestErr = errCap
+  best = None
+  for xFlip, yFlip, xMirror, yMirror in orientations:
+    mirrored = rgb[::-1 if yFlip else 1, ::-1 if xFlip else 1]
+    lowerBounds = getTileDiffLowerBounds(getTileCellSums(mirrored[numpy.newaxis])[0], index['cellSums'][eligible], index['cellSizes'])
+    candidates = eligible[numpy.argsort(lowerBounds, kind='mergesort')]
+    lowerBounds = numpy.sort(lowerBounds, kind='mergesort')
+    pixels = mirrored.reshape(-1, 3)
+    orientationErr = bestErr
+    found = []
+    for i in range(0, len(candidates), TILE_SEARCH_BATCH):
+      if lowerBounds[i] > orientationErr:
+        break
+      chunk = candidates[i:i+TILE_SEARCH_BATCH][lowerBounds[i:i+TILE_SEARCH_BATCH] <= orientationErr]
+      errors = getTileDiffErrors(pixels, index['pixels'][chunk])
+      orientationErr = min(orientationErr, errors.min())
+      found.append((chunk, errors))
+    if found:
+      refPos = numpy.concatenate([chunk for chunk, errors in found])
+      errors = numpy.concatenate([errors for chunk, errors in found])
+      if errors.min() <= bestErr:
+        bestErr = errors.min()
+        best = (bestErr, refPos[errors == bestErr].max(), xMirror, yMirror)
+  return best
+
 def optimizeTilesNew( tiles, refTiles, options ):
   if not options.get('optimize'):
       return tiles
 
   if None is refTiles:
     refTiles = tiles
-    chooseLessNoisy = True
-  else:
-    chooseLessNoisy = False
 
   if 0 is options.get('tilethreshold'):
     return optimizeTilesNewHash( tiles, refTiles, options )
 
   logging.debug("optimizeTilesNew")
   start = time.time()
-  refpx = [(item['id'], [(pixel.r,pixel.g,pixel.b) for sublist in item['pixel'] for pixel in sublist], hash(str(item['indexedPixel'] if hasattr(item, 'indexedPixel') else [] ))) for item in refTiles if item['refId'] == None]
-  px = [(item['id'],item['xMirror'],item['yMirror'], [(pixel.r,pixel.g,pixel.b) for sublist in item['pixel'] for pixel in sublist], hash(str(item['indexedPixel']))) for sublist in [mirrorTiles(tile) for tile in tiles] for item in sublist]
+  refs = [item for item in refTiles if item['refId'] == None]
+  if 0 == len(tiles) or 0 == len(refs):
+    return tiles
   logging.debug(("now converting", len(tiles), len(refTiles)))
 
-  currID = -1
-  for t in range(len(px)):
-    if currID != px[t][0]:
-      bestErr = INFINITY
-    currID = px[t][0]
+  refIds = numpy.array([item['id'] for item in refs])
+  index = getTileSearchIndex(refs)
+
+  #refs get excluded as soon as the tile they are looked up by receives a refId
+  refActive = numpy.array([refTiles[refId]['refId'] is None for refId in refIds])
+  refLookup = {}
+  for i in range(len(refIds)):
+    refLookup.setdefault(id(refTiles[refIds[i]]), []).append(i)
+
+  #tiles with an error at or above this are never assigned anyway
+  errCap = options.get('tilethreshold') * options.get('tilethreshold') + 1
+  for tile in tiles:
+    currID = tile['id']
     currIdRelative = currID - tiles[0]['id']
+    eligible = numpy.flatnonzero(refActive & (refIds != currID))
+
+    #unmirrored orientation keeps whatever mirror flags the tile already has
+    orientations = [(False, False, tile['xMirror'], tile['yMirror'])] + [(config['x'], config['y'], config['x'], config['y']) for config in MIRROR_CONFIGS[1:]]
+    best = findNearestTile(getTileRgbArray(tile), orientations, eligible, index, errCap)
 
-    bestId = None
-    bestX = False
-    bestY = False
-    for rr in range(len(refpx)):
-      if currID != refpx[rr][0] and refTiles[refpx[rr][0]]['refId'] is None:
-        error = getTileDiffErr(bestErr, px[t][3], refpx[rr][1])
-        if error <= bestErr:
-          bestErr = error
-          bestId = refpx[rr][0]
-          bestX = px[t][1]
-          bestY = px[t][2]
-    if math.sqrt(bestErr) < options.get('tilethreshold') and bestId != None:
+    if best is not None and math.sqrt(best[0]) < options.get('tilethreshold'):
+      bestId = int(refIds[best[1]])
       tiles[currIdRelative]['refId'] = bestId
       tiles[currIdRelative]['palette']['refId'] = bestId
-      tiles[currIdRelative]['xMirror'] = bestX
-      tiles[currIdRelative]['yMirror'] = bestY
+      tiles[currIdRelative]['xMirror'] = best[2]
+      tiles[currIdRelative]['yMirror'] = best[3]
+      for i in refLookup.get(id(tiles[currIdRelative]), []):
+        refActive[i] = False
 
   logging.debug(("done converting", time.time() - start))
   return tiles
+
+def pushNearestTile(heap, i, rgb, active, orientations, index):
+  eligible = numpy.flatnonzero(active)
+  nearest = findNearestTile(rgb[i], orientations, eligible[eligible != i], index, INFINITY)
+  if nearest is not None:
+    heapq.heappush(heap, (nearest[0], i) + nearest[1:])
+
+def clusterTiles( tiles, options ):
+  '''merge closest pairs of unique tiles until no more than maxtiles remain'''
+  unique = [tile for tile in tiles if tile['refId'] == None]
+  if len(unique) <= options.get('maxtiles'):
+    return tiles
+
+  start = time.time()
+  index = getTileSearchIndex(unique)
+  rgb = [getTileRgbArray(tile) for tile in unique]
+  active = numpy.ones(len(unique), dtype=bool)
+  orientations = [(config['x'], config['y'], config['x'], config['y']) for config in MIRROR_CONFIGS]
+
+  heap = []
+  for i in range(len(unique)):
+    pushNearestTile(heap, i, rgb, active, orientations, index)
+
+  remaining = len(unique)
+  mergeErr = 0
+  while remaining > options.get('maxtiles') and heap:
+    error, i, refPos, xMirror, yMirror = heapq.heappop(heap)
+    if not active[i]:
+      continue
+    if not active[refPos]:
+      #nearest tile got merged away in the meantime
+      pushNearestTile(heap, i, rgb, active, orientations, index)
+      continue
+    unique[i]['refId'] = unique[refPos]['id']
+    unique[i]['palette']['refId'] = unique[refPos]['id']
+    unique[i]['xMirror'] = xMirror
+    unique[i]['yMirror'] = yMirror
+    active[i] = False
+    remaining -= 1
+    mergeErr = error
+
+  logging.info('maxtiles %s reached by merging down to %s tiles, effective tilethreshold %s.' % (options.get('maxtiles'), remaining, int(math.sqrt(mergeErr)) + 1))
+  logging.debug(("done clustering", time.time() - start))
+  return tiles
+
   
 def mirrorTiles( tile):
   return [
@@ -1178,7 +1397,7 @@ def mirrorTile( tile, config ):
   for yPos in verticalRange:
     horizontalRange = range( len( tile['pixel'][yPos] )-1, 0-1, -1 ) if config['x'] else range( len( tile['pixel'][yPos] ) )
     mirrorTile.append( [tile['pixel'][yPos][xPos] for xPos in horizontalRange] )
-    if hasattr(tile, 'indexedPixel'):
+    if 'indexedPixel' in tile:
       mirrorTileIndexed.append( [tile['indexedPixel'][yPos][xPos] for xPos in horizontalRange] )
         
   return {
@@ -1247,6 +1466,7 @@ def parseSpriteTiles( image, options, frameID):
         tiles.append( {
           'id'      : len( tiles ),
           'pixel'   : tile['pixel'],
+          'rgb'     : tile['rgb'],
           'pixhash' : tile['pixhash'],
           'palette' : tile['palette'],
           'frame': frameID,
@@ -1270,10 +1490,17 @@ def parseBigSpriteTiles(tiles, options):
   newTiles = list(tiles)
   newBigTiles = []
   if 0 < len(tiles):
+    #small tiles by position and placed big tiles by 32x32 cell, merged small tiles are dropped by id
+    tilesByPos = {}
+    for tile in tiles:
+      tilesByPos.setdefault((tile['x'], tile['y']), []).append(tile)
+    bigTileCells = {}
+    mergedIds = set()
     emptyTile = copy.deepcopy(tiles[0])
     for scanline in range(len(emptyTile['pixel'])):
       for pixel in range(len(emptyTile['pixel'][scanline])):
         emptyTile['pixel'][scanline][pixel] = options.get('transcol')
+    emptyTile['rgb'][:,:] = options.get('transcol').getPIL()
     emptyTile['palette']['color'] = []
     for tile in tiles:
       currentBigTile = []
@@ -1282,19 +1509,14 @@ def parseBigSpriteTiles(tiles, options):
       sizeX = options.get('tilesizex')
       sizeY = options.get('tilesizey')
       misses = 0
-      breakOut = False
-      for checkBigTile in newBigTiles:
-        if ((currentX >= checkBigTile['x'] and currentX < checkBigTile['x']+32) or (currentX+32 >= checkBigTile['x'] and currentX+32 < checkBigTile['x']+32)) and ((currentY >= checkBigTile['y'] and currentY < checkBigTile['y']+32) or (currentY+32 >= checkBigTile['y'] and currentY+32 < checkBigTile['y']+32)):
-          breakOut = True
-          break
-      if breakOut:
+      if checkBigTileOverlap(bigTileCells, currentX, currentY):
           continue
       for tileCountY in range(tilecounter):
         for tileCountX in range(tilecounter):
 
           compareTileFound = False
-          for compareTile in newTiles:
-            if compareTile['x'] == currentX + (tileCountX * sizeX) and compareTile['y'] == currentY + (tileCountY * sizeY):
+          for compareTile in tilesByPos.get((currentX + (tileCountX * sizeX), currentY + (tileCountY * sizeY)), []):
+            if compareTile['id'] not in mergedIds:
               foundTile = compareTile.copy()
               currentBigTile.append(foundTile)
               compareTileFound = True
@@ -1302,6 +1524,7 @@ def parseBigSpriteTiles(tiles, options):
               currentBigTile.append( {
                 'id'      : None,
                 'pixel'   : emptyTile['pixel'],
+                'rgb'     : emptyTile['rgb'],
                 'pixhash' : emptyTile['pixhash'],
                 'palette' : emptyTile['palette'],
                 'x'       : currentX + (tileCountX * sizeX),
@@ -1320,15 +1543,15 @@ def parseBigSpriteTiles(tiles, options):
             mergedTile = tile
           else:
             mergedTile['pixel'] = mergedTile['pixel'] + list(tile['pixel'])
+            mergedTile['rgb'] = numpy.concatenate((mergedTile['rgb'], tile['rgb']))
             mergedTile['palette']['color'] = mergedTile['palette']['color'] + list(tile['palette']['color'])
         
         mergedTile['palette']['color'] = list(set(mergedTile['palette']['color']))
         newBigTiles.append(mergedTile)
-        for bigSubTile in currentBigTile:
-          for idx, newTile in enumerate(newTiles):
-            if bigSubTile['id'] == newTile['id']:
-              newTiles.pop(idx)
+        bigTileCells.setdefault((mergedTile['x'] // 32, mergedTile['y'] // 32), []).append(mergedTile)
+        mergedIds.update([bigSubTile['id'] for bigSubTile in currentBigTile if bigSubTile['id'] is not None])
 
+    newTiles = [tile for tile in newTiles if tile['id'] not in mergedIds]
     currId = 0
     for tile in newTiles:
       tile['id'] = currId
@@ -1353,35 +1576,41 @@ def parseBigSpriteTiles(tiles, options):
     [row for tile in tiles for row in tile[3]]]
   )
 
+  rgbTiles = [chunks(list(tile['rgb']), len(tile['rgb'])/4) for tile in newBigTiles]
+  rgbRows = reduce(lambda x,y: x+y,
+    [[row for tile in rgbTiles for row in tile[0]],
+    [row for tile in rgbTiles for row in tile[1]],
+    [row for tile in rgbTiles for row in tile[2]],
+    [row for tile in rgbTiles for row in tile[3]]]
+  )
+
   for i in range(len(newBigTiles)):
     newBigTiles[i]['pixel'] = rows[i*128:(i*128)+128]
+    newBigTiles[i]['rgb'] = numpy.array(rgbRows[i*128:(i*128)+128], dtype=numpy.uint8).reshape(-1, options.get('tilesizex'), 3)
 
   return {'normal':newTiles, 'big':newBigTiles}
   
           
+def checkBigTileOverlap(bigTileCells, x, y):
+  '''true if a 32x32 tile at x, y would overlap any placed big tile, only neighbouring cells need checking'''
+  for cellY in range(y // 32 - 1, y // 32 + 2):
+    for cellX in range(x // 32 - 1, x // 32 + 2):
+      for bigTile in bigTileCells.get((cellX, cellY), []):
+        if bigTile['x'] - 32 <= x < bigTile['x'] + 32 and bigTile['y'] - 32 <= y < bigTile['y'] + 32:
+          return True
+  return False
+
 def getTilePosList(tiles):
   return [{'id':tile['id'],'x':tile['x'],'y':tile['y']} for tile in tiles]  
 
 def checkVlineFilled( image, pos, options ):
-  for ypos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-    if isPixelOpaque( image['pixels'], ypos, pos['x'], options ):
-      return True
-  return False
+  return 0 < countOpaquePixels( image, pos['x'], pos['y'], 1, options.get('tilesizey'), options )
 
 def checkTileFilled( image, pos, options ):
-  for ypos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-    for xpos in range( pos['x'], pos['x']+options.get('tilesizex') ):
-      if isPixelOpaque( image['pixels'], ypos, xpos, options ):
-        return True
-  return False
+  return 0 < countOpaquePixels( image, pos['x'], pos['y'], options.get('tilesizex'), options.get('tilesizey'), options )
 
 def checkTileFilledThreshold( image, pos, options ):
-  count = 0
-  for ypos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-    for xpos in range( pos['x'], pos['x']+options.get('tilesizex') ):
-      if isPixelOpaque( image['pixels'], ypos, xpos, options ):
-        count += 1
-  return 2 < count
+  return 2 < countOpaquePixels( image, pos['x'], pos['y'], options.get('tilesizex'), options.get('tilesizey'), options )
 
 def checkBigTileFilledThreshold( image, pos, options ):
   misses = 16
@@ -1398,22 +1627,38 @@ def checkBigTileFilledThreshold( image, pos, options ):
 
 def checkTileRowFilled( image, pos, options ):
   if options.get('optimize'):
-    for ypos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-      if isPixelOpaque( image['pixels'], ypos, pos['x'], options ):
-        return True
-    return False
+    return checkVlineFilled( image, pos, options )
   else:
-    for xpos in range( pos['x'], pos['x']+options.get('tilesizex') ):
-      for ypos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-        if isPixelOpaque( image['pixels'], ypos, xpos, options ):
-          return True
-    return False
+    return checkTileFilled( image, pos, options )
 
 def checkLineFilled( image, pos, options ):
-  for xpos in range( image['resolutionX'] ):
-    if isPixelOpaque( image['pixels'], pos['y'], xpos, options ):
-      return True
-  return False
+  return 0 < countOpaquePixels( image, 0, pos['y'], image['resolutionX'], 1, options )
+
+def countOpaquePixels( image, x, y, width, height, options ):
+  '''number of opaque pixels in region, pixel positions resolve like image['pixels'][y][x] lookups in getPixel'''
+  opacity = getOpacityTable( image, options )
+  x0, x1 = [min(max(xpos + opacity['width'], 0), 3*opacity['width']) for xpos in (x, x + width)]
+  y0, y1 = [min(max(ypos + opacity['height'], 0), 3*opacity['height']) for ypos in (y, y + height)]
+  table = opacity['table']
+  return int(table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0])
+
+def getOpacityTable( image, options ):
+  '''summed-area table of opaque pixels, built once per image and transparent color'''
+  transcol = options.get('transcol').getRGB()
+  if 'opacity' not in image or image['opacity']['transcol'] != transcol:
+    height, width = image['packed'].shape
+    #table spans -size..2*size per axis: negative positions wrap like list indices, positions past the image are transparent
+    padded = numpy.zeros( ( 3*height, 3*width ), dtype=numpy.int32 )
+    padded[:2*height, :2*width] = numpy.tile( image['packed'] != transcol, ( 2, 2 ) )
+    table = numpy.zeros( ( 3*height+1, 3*width+1 ), dtype=numpy.int32 )
+    table[1:, 1:] = padded.cumsum( axis=0 ).cumsum( axis=1 )
+    image['opacity'] = {
+      'transcol' : transcol,
+      'table'    : table,
+      'width'    : width,
+      'height'   : height
+    }
+  return image['opacity']
   
 def isPixelOpaque( pixels, yPos, xPos, options ):
   return getPixel( pixels, yPos, xPos, options ).getRGB() != options.get('transcol').getRGB()
@@ -1463,6 +1708,7 @@ def parseBgTiles( image, options, frameID ):
 	  tiles.append( {
 		'id' 		: len( tiles ),
 		'pixel'		: tile['pixel'],
+		'rgb'		: tile['rgb'],
 		'pixhash'   : tile['pixhash'],
 		'palette'	: tile['palette'],
 		'x'			: pos['x'],
@@ -1478,19 +1724,26 @@ def parseBgTiles( image, options, frameID ):
 
 
 def fetchTile( image, pos, options, tileId ):
-  tile = []
-  palette = [options.get('transcol')]
-  for yPos in range( pos['y'], pos['y']+options.get('tilesizey') ):
-    tileLine = []
-    for xPos in range( pos['x'], pos['x']+options.get('tilesizex') ):
-	  pixel = getPixel( image['pixels'], yPos, xPos, options )
-	  tileLine.append( pixel )
-	  if pixel not in palette:
-		palette.append( pixel )
-    tile.append( tileLine )    
+  '''slice tile out of decoded image, area outside of image is filled with transparent color'''
+  sizeX = options.get('tilesizex')
+  sizeY = options.get('tilesizey')
+  rgb = image['rgb'][pos['y']:pos['y']+sizeY, pos['x']:pos['x']+sizeX]
+  packed = image['packed'][pos['y']:pos['y']+sizeY, pos['x']:pos['x']+sizeX]
+  if rgb.shape[:2] != (sizeY, sizeX):
+    paddedRgb = numpy.empty((sizeY, sizeX, 3), numpy.uint8)
+    paddedRgb[:,:] = options.get('transcol').getPIL()
+    paddedRgb[:rgb.shape[0], :rgb.shape[1]] = rgb
+    rgb = paddedRgb
+    packed = packRgbArray(rgb)
+
+  #palette keeps order of first appearance, transparent color always comes first
+  values, firstIndices = numpy.unique(packed, return_index=True)
+  transparent = options.get('transcol').getRGB()
+  palette = [options.get('transcol')] + [image['colors'][value] for value in values[numpy.argsort(firstIndices)].tolist() if value != transparent]
   return {
-	'pixel'		: tile,
-	'pixhash'   : hash(str(tile)),
+	'pixel'		: getPixelRows(packed, image['colors']),
+	'rgb'		: rgb,
+	'pixhash'   : hash(packed.tostring()),
 	'palette'	: {
 	  'id'			: tileId,
 	  'color'		: palette,
@@ -1500,29 +1753,36 @@ def fetchTile( image, pos, options, tileId ):
 
 
 def getInputImage( options, filename ):
-  try:
-	  inputImage = Image.open( filename )
-  except IOError:
-	  logging.error( 'Unable to load input image "%s"' % filename )
-	  sys.exit(1)
-  
+  inputImage = openImage( filename )
   paddedImage = padImageReduceColdepth( inputImage, options )
   options.set('resolutionx', paddedImage.size[0])
   options.set('resolutiony', paddedImage.size[1])
 
+  rgb = getRgbArray( paddedImage )
+  packed = packRgbArray( rgb )
+  colors = getColorLookup( packed )
+  colors.setdefault( options.get('transcol').getRGB(), options.get('transcol') )
   return {
 	'resolutionX'	: paddedImage.size[0],
 	'resolutionY'	: paddedImage.size[1],
-	'pixels'	: getRgbPixels( paddedImage )
+	'rgb'	: rgb,
+	'packed'	: packed,
+	'colors'	: colors,
+	'pixels'	: getPixelRows( packed, colors )
   }
 
-#total hack...
-def getInputImageNoResolutionSet( options, filename ):
+def openImage( source ):
+  '''accepts already loaded PIL images as well as filenames'''
+  if isinstance( source, Image.Image ):
+    return source
   try:
-      inputImage = Image.open( filename )
+    return Image.open( source )
   except IOError:
-      logging.error( 'Unable to load input image "%s"' % filename )
-      sys.exit(1)
+    raise ConversionError( 'Unable to load input image "%s"' % source )
+
+#total hack...
+def getInputImageNoResolutionSet( options, filename ):
+  inputImage = openImage( filename )
   
   paddedImage = ImageReduceColdepth( inputImage, options )
 
@@ -1534,14 +1794,28 @@ def getInputImageNoResolutionSet( options, filename ):
 
 def getRgbPixels( image ):
   '''extract color-converted pixels from image'''
-  rawPixels = list(image.getdata())
-  outputPixels = []
-  for y in range( image.size[1] ):
-    outputPixels.append( [] )
-    for x in range( image.size[0] ):
-      outputPixels[y].append(Color(rawPixels.pop(0)))
+  packed = packRgbArray( getRgbArray( image ) )
+  return getPixelRows( packed, getColorLookup( packed ) )
+
+
+def getRgbArray( image ):
+  '''decode image into (height, width, 3) array of 8bit rgb components'''
+  return numpy.asarray( image.convert('RGB'), dtype=numpy.uint8 )
+
 
-  return outputPixels
+def packRgbArray( rgb ):
+  '''pack rgb components into 24bit values, same layout as Color.getRGB()'''
+  return (rgb[..., 0].astype(numpy.uint32) << 16) | (rgb[..., 1].astype(numpy.uint32) << 8) | rgb[..., 2].astype(numpy.uint32)
+
+
+def getColorLookup( packed ):
+  '''one shared Color instance per distinct packed color'''
+  return dict((value, Color(getColorTuple(value))) for value in numpy.unique(packed).tolist())
+
+
+def getPixelRows( packed, colors ):
+  '''expand packed array into scanlines of Color objects'''
+  return [[colors[value] for value in scanline] for scanline in packed.tolist()]
 
 
 def ImageReduceColdepth( inputImage, options):
@@ -1581,19 +1855,25 @@ def getColorTuple(inputColor):
   )
 
 def compress(byteList):
+  '''lz4 frame, identical to output of "lz4 --content-size -9"'''
   if 0 == len(byteList):
-      return byteList
-  filename = 'build/temp'
-  packedname = filename + '.lz4'
-  tempfile = open(filename, 'wb')
-  [tempfile.write(byte) for byte in byteList]
-  tempfile.close()
-  subprocess.call(['lz4', '--content-size', '-9', '-f', filename, packedname])
-
-  packedFile = open(packedname, 'rb' )
-  lz4data = packedFile.read()
-  packedFile.close()
-  return lz4data
+      return ByteStream()
+  return ByteStream(lz4.frame.compress(bytes(byteList), compression_level=9, block_size=lz4.frame.BLOCKSIZE_MAX4MB, block_linked=False, content_checksum=True, store_size=True))
+
+class ByteStream(bytearray):
+  '''output byte buffer with little endian helpers, meant to be written to file in one go'''
+  def byte(self, value):
+	self.append(value & 0xff)
+
+  def word(self, value):
+	self.extend((value & 0xff, (value & 0xff00) >> 8))
+
+  def long(self, value):
+	self.extend((value & 0xff, (value & 0xff00) >> 8, (value & 0xff0000) >> 16))
+
+  def fill(self, length):
+	'''zero-pads stream up to length, same as seeking past end of file before writing'''
+	self.extend(bytearray(max(0, length - len(self))))
 
 class BitStream():
   def __init__( self ):
@@ -1619,6 +1899,22 @@ class BitStream():
 	return len(self.bitStream) > 0
 
 
+class ConversionError(Exception):
+  pass
+
+
+class Conversion():
+  '''in-memory conversion result: tile and palette entities, output byte streams and statistics'''
+  def __init__(self, tiles, palettes, image, options, startTime):
+	self.tiles = augmentOutIds(tiles)
+	self.palettes = augmentOutIds(palettes)
+	self.image = image
+	self.tileStream = getTileWriteStream( self.tiles, options )
+	self.paletteStream = getPaletteWriteStream( self.palettes, options ) if not options.get('directcolor') else ByteStream()
+	self.tilemapStream = getSpriteTileMapStream(self.tiles, self.palettes, options, False, False) if options.get('mode') == 'sprite' else getBgTileMapStream(self.tiles, self.palettes, options, False, False)
+	self.statistics = Statistics(self.tiles, self.palettes, startTime)
+
+
 class Statistics():
   def __init__(self, tiles, palettes, startTime):
 	self.totalTiles = len(tiles)
@@ -56,6 +56,7 @@ old frame format: (size 11)
   ANIMATION.FRAME.DATA dw
 
 new frame format: (size 29) (all pointers: relative from start of frame header)
+  packed animations store identical payloads once. pointers of later frames may point back into earlier frames, with 16 bit wraparound
   ANIMATION.FRAME.DELAY db
   ANIMATION.FRAME.TILES.NORMAL.POINTER dw
   ANIMATION.FRAME.TILES.NORMAL.LENGTH dw
@@ -78,6 +79,26 @@ framesNormal
 1: tilemap
 2: tilemap xmirrored
 3: palette    
+
+delta frames (-deltaframes on, header flag HEADER_FLAG_TILES_DELTA):
+  tile lengths in frame header are the bytes uploaded this frame, allocation sizes are the maxima in animation header.
+  the normal tile maximum also covers the largest tile block including its patch list (minus the big tile maximum),
+  so normal plus big maximum always hold a complete tile block. vram allocation stays a full frame, patches may target any part of it.
+  tiles block of every frame is a patch list against vram content left by previous frames.
+  keyframes (first frame, loop start, every -keyframeinterval frames) have a single patch spanning all tiles.
+  1 byte : patch count normal tiles
+  1 byte : patch count big tiles
+  [patch{
+	2 bytes : target offset(bytes) relative to tile allocation
+	2 bytes : length(bytes)
+  }]
+  [tile data of all normal patches, then all big patches]
+
+vram tile slots (-vramtiles n, implies delta frames):
+  normal tiles of all frames share a fixed allocation of n 8x8 tile slots instead of being uploaded per frame.
+  tilemaps point at slots, the patch list of a frame uploads only tiles not resident from previous frames.
+  when slots run out, the resident tile needed again furthest in the future is replaced.
+  allocation size in animation header is the highest slot used.
 '''
 
 
@@ -88,13 +109,14 @@ import math
 import time
 import string
 import graconUserOptions
+import graconCache
 import graconGfx
 import logging
 import struct
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
-import subprocess
+import multiprocessing
 
 logging.basicConfig( level=logging.ERROR, format='%(message)s')
 
@@ -106,6 +128,7 @@ HEADER_MAGIC = 'SP'
 HEADER_SIZE = 26
 HEADER_STATIC_FLAG_PALETTES = 1
 HEADER_STATIC_FLAG_TILES = 2
+HEADER_FLAG_TILES_DELTA = 4
 FRAME_HEADER_SIZE = 20
 ALLOWED_FRAME_FILETYPES = ('.png', '.gif', '.bmp')
 
@@ -126,6 +149,38 @@ FRAME_FLAG_HAS_TILES_BIG = 0x80
 FRAME_TILEMAP_NORMAL_MAX = 100
 FRAME_TILEMAP_BIG_MAX = 8
 
+DELTA_PATCHES_MAX = 255
+
+#frame payloads in the order they are stored after the frame header
+FRAME_PAYLOADS = ('tiles', 'palette', 'tilemap', 'xTilemap')
+
+#65816 instructions of compiled tilemap code: opcode, operand bytes, cycles. accu and index 16 bit, direct page aligned, branches not taken
+OPCODES = {
+  'lda #'       : (0xa9, 2, 3),
+  'lda dp'      : (0xa5, 1, 4),
+  'adc dp'      : (0x65, 1, 4),
+  'adc long,x'  : (0x7f, 3, 6),
+  'sbc #'       : (0xe9, 2, 3),
+  'cmp #'       : (0xc9, 2, 3),
+  'and #'       : (0x29, 2, 3),
+  'ora #'       : (0x09, 2, 3),
+  'sta abs'     : (0x8d, 2, 5),
+  'sta abs,y'   : (0x99, 2, 6),
+  'stz abs'     : (0x9c, 2, 5),
+  'asl a'       : (0x0a, 0, 2),
+  'tax'         : (0xaa, 0, 2),
+  'clc'         : (0x18, 0, 2),
+  'sec'         : (0x38, 0, 2),
+  'bcc'         : (0x90, 1, 2),
+  'bcs'         : (0xb0, 1, 2),
+  'rtl'         : (0x6b, 0, 6)
+}
+SCREEN_WIDTH = 256
+SCREEN_CLAMP_Y = 233
+
+#compiled tilemap code by tilemap, shared by identical frames
+compiledTilemaps = {}
+
 def main():
   options = graconUserOptions.Options( sys.argv, {
 	'palettes' 		: {
@@ -266,14 +321,69 @@ def main():
     'value'           : False,
     'type'            : 'bool'
     },
+  'positionxmax'	: {  #highest object x-position passed to compiled tilemap code. sprites that can't leave the screen skip bounds checks
+	'value'			: 0xffff,
+	'type'			: 'int',
+	'max'			: 0xffff,
+	'min'			: 0
+	},
+  'positionymax'	: {
+	'value'			: 0xffff,
+	'type'			: 'int',
+	'max'			: 0xffff,
+	'min'			: 0
+	},
+  'cyclebudget'	: {  #maximum cycles of compiled tilemap code per frame. 0 means: no limit
+	'value'			: 0,
+	'type'			: 'int',
+	'max'			: 0xffffff,
+	'min'			: 0
+	},
+  'bigspritelut'	: {  #long address of sprite32x32id.lut, required by compiled tilemap code of big sprites
+	'value'			: 0x0,
+	'type'			: 'hex',
+	'max'			: 0xffffff,
+	'min'			: 0x0
+	},
   'forcePalette'        : {
       'value'           : False,
       'type'            : 'bool'
-    }    
+    },
+  'deltaframes'        : {
+      'value'           : False,
+      'type'            : 'bool'
+    },
+  'keyframeinterval' : {  #complete tile upload every n frames with deltaframes. 0 means: first frame and loop start only
+    'value'     : 0,
+    'type'      : 'int',
+    'max'     : 255,
+    'min'     : 0
+    },
+  'vramtiles' : {  #number of 8x8 vram tile slots shared by the normal tiles of all frames. 0 means: upload all tiles of every frame
+    'value'     : 0,
+    'type'      : 'int',
+    'max'     : 0x400,
+    'min'     : 0
+    },
+  'processes'		: {
+	'value'			: 0,	#0 means: one per cpu core
+	'type'			: 'int',
+	'max'			: 256,
+	'min'			: 0
+	}
   })
 
-  sys.setrecursionlimit(10000)
+  outputs = [options.get('outfile'), "%s.i" % options.get('outfile'), "%s.palette.sample.png" % options.get('outfile'), "%s.image.sample.png" % options.get('outfile')]
+  graconCache.run( options, [options.get('infolder'), options.get('refpalette')], outputs, lambda: convert( options ) )
+
+  #accumulates across all animations of a folder, so it's updated on cache hits as well
+  if options.get('createAllocationDummy'):
+    writeAllocationDummy( options )
 
+  logging.info('Successfully wrote animation file %s.' % options.get('outfile'))
+
+
+def convert( options ):
   options.set('transcol', graconGfx.Color(graconGfx.getColorTuple(options.get('transcol'))))
   
   if not os.path.exists(options.get('infolder')):
@@ -319,13 +429,18 @@ def main():
     
   options.set('outfilebase', options.get('outfile'))
   logging.debug("parsing tiles")
-  tileFrames = [graconGfx.parseTiles(graconGfx.getInputImage(options, "%s/%s" % (options.get('infolder'), tileFiles[i])), options, i) for i in range(len(tileFiles))]
+  pool = getFramePool(options, len(tileFiles))
+  parsedFrames = mapFrames(pool, parseFrame, [(options, "%s/%s" % (options.get('infolder'), tileFiles[i]), i) for i in range(len(tileFiles))])
+  tileFrames = [tileFrame for tileFrame, resolution in parsedFrames]
 
   if not 0 < len(tileFrames):
 	logging.error( 'Error, input folder "%s" does not contain any parseable frame image files.' % options.get('infolder') )
 	sys.exit(1)
-    
-  firstImage = graconGfx.getInputImage(options, "%s/%s" % (options.get('infolder'), tileFiles[0]))
+
+  #image loading sets resolution options, first frame's resolution applies from here on
+  imageSizeX, imageSizeY = parsedFrames[0][1]
+  options.set('resolutionx', imageSizeX)
+  options.set('resolutiony', imageSizeY)
   
   globalTilesNormal = [tile for tileFrame in tileFrames for tile in tileFrame['normal']]
   globalTilesBig = [tile for tileFrame in tileFrames for tile in tileFrame['big']]
@@ -342,42 +457,62 @@ def main():
     tileFramesNormal = [graconGfx.augmentOutIds(graconGfx.tilesLengthCheck(graconGfx.optimizeTilesNew(graconGfx.palettizeTiles(frame['normal'], palette, options), globalTilesNormal, options),options)) for frame in tileFrames]
   else:
     logging.debug("non static")
-    tileFramesNormal = [graconGfx.augmentOutIds(graconGfx.tilesLengthCheck(graconGfx.optimizeTilesNew(graconGfx.palettizeTiles(frame['normal'], palette, options), None, options), options)) for frame in tileFrames]
+    tileFramesNormal = mapFrames(pool, optimizeFrame, [(options, frame['normal'], palette) for frame in tileFrames])
   
   if options.get('statictiles'):
     for i in range(len(globalTilesBig)):
       globalTilesBig[i]['id'] = i
-    tileFramesBig = [graconGfx.augmentOutIds(graconGfx.palettizeTiles(frame['big'], palette, options)) for frame in tileFrames]
-  else:
-    tileFramesBig = [graconGfx.augmentOutIds(graconGfx.palettizeTiles(frame['big'], palette, options)) for frame in tileFrames]    
+  tileFramesBig = mapFrames(pool, palettizeFrame, [(options, frame['big'], palette) for frame in tileFrames])
+
+  if pool:
+    pool.close()
+    pool.join()
 
   palette = graconGfx.augmentOutIds(palette)
+  keyframes = getKeyframes(len(tileFrames), loopstart, options)
+
+  if options.get('vramtiles') and not options.get('statictiles'):
+    slotTiles = allocateTileSlots(tileFramesNormal, keyframes, options)
 
   framesNormals = getCompletedFrames(tileFramesNormal, globalTilesNormal, palette, options)
   framesBigs = getCompletedFrames(tileFramesBig, globalTilesBig, palette, options)
 
-  frames = [Frame(framesNormals[i],framesBigs[i],options) for i in range(len(framesNormals))]
+  if options.get('vramtiles') and not options.get('statictiles'):
+    framesNormals = [(slotTiles[i],) + framesNormals[i][1:] for i in range(len(framesNormals))]
+
+  if (options.get('deltaframes') or options.get('vramtiles')) and not options.get('statictiles'):
+    deltaTiles = getDeltaTiles(framesNormals, framesBigs, keyframes, options)
+  else:
+    deltaTiles = [None for frame in framesNormals]
+
+  frames = [Frame(framesNormals[i],framesBigs[i],options,deltaTiles[i]) for i in range(len(framesNormals))]
+  if options.get('compileTilemapCode') and 'sprite' == options.get('mode'):
+    for i in range(len(frames)):
+      cycles = max(frames[i].tilemapCycles, frames[i].xTilemapCycles)
+      logging.info('frame %s tilemap code: %s cycles, x-mirrored %s cycles' % (i, frames[i].tilemapCycles, frames[i].xTilemapCycles))
+      if options.get('cyclebudget') and options.get('cyclebudget') < cycles:
+        logging.error('frame %s tilemap code takes %s cycles, but only %s are allowed maximum' % (i, cycles, options.get('cyclebudget')))
+        sys.exit(1)
+
+  compressFrames(frames, options)
 
   maxTileLengthNormal = 0
   maxTileLengthBig = 0
   maxTilemapLength = 0
   maxPaletteLength = 0
   framecount = len(tileFrames)
-  currentFramePointer = 0
-  framePointers = []
-  imageSizeX = firstImage['resolutionX']
-  imageSizeY = firstImage['resolutionY']
   
   labelPrefix = "%x" % abs(hash(string.replace(options.get('infolder'), "/", ".")))
   logging.debug("calculating pointers")
+  framePointers = layoutFrames(frames, options)
   for frame in frames:
-    framePointers.append(currentFramePointer)
-    currentFramePointer += frame.getLength()
-
     maxTileLengthNormal = frame.allocLenTilesNormal if maxTileLengthNormal < frame.allocLenTilesNormal else maxTileLengthNormal
     maxTileLengthBig = frame.allocLenTilesBig if maxTileLengthBig < frame.allocLenTilesBig else maxTileLengthBig
     maxTilemapLength = (frame.allocTilemapLength + frame.allocTilemapBigLength) if maxTilemapLength < (frame.allocTilemapLength + frame.allocTilemapBigLength) else maxTilemapLength
     maxPaletteLength = frame.allocPaletteLength if maxPaletteLength < frame.allocPaletteLength else maxPaletteLength
+
+  #delta tile blocks carry a patch list and may exceed the allocation, tile buffers sized by both maxima must hold them
+  maxTileLengthNormal = max([maxTileLengthNormal] + [frame.tileBlockLength - maxTileLengthBig for frame in frames])
   
   
   try:
@@ -390,49 +525,41 @@ def main():
   #write header
   incFile.write('__%s.st: \n' % labelPrefix)
 
-  outFile.write(HEADER_MAGIC)
+  outStream = graconGfx.ByteStream(HEADER_MAGIC)
   incFile.write('.db "%s" \n' % HEADER_MAGIC)
 
-  outFile.write(chr(maxTileLengthNormal & 0xff))
-  outFile.write(chr((maxTileLengthNormal & 0xff00) >> 8 ))
+  outStream.word(maxTileLengthNormal)
   incFile.write('.dw %s \n' % maxTileLengthNormal)
 
-  outFile.write(chr(maxTileLengthBig & 0xff))
-  outFile.write(chr((maxTileLengthBig & 0xff00) >> 8 ))
+  outStream.word(maxTileLengthBig)
   incFile.write('.dw %s \n' % maxTileLengthBig)
   
-  outFile.write(chr(maxPaletteLength & 0xff))
-  outFile.write(chr((maxPaletteLength & 0xff00) >> 8 ))
+  outStream.word(maxPaletteLength)
   incFile.write('.dw %s \n' % maxPaletteLength)
 
-  outFile.write(chr(maxTilemapLength & 0xff))
-  outFile.write(chr((maxTilemapLength & 0xff00) >> 8 ))
+  outStream.word(maxTilemapLength)
   incFile.write('.dw %s \n' % maxTilemapLength)
 
 
-  outFile.write(chr(framecount & 0xff))
-  outFile.write(chr((framecount & 0xff00) >> 8 ))
+  outStream.word(framecount)
   incFile.write('.dw %s \n' % framecount)
 
 
-  outFile.write(chr(loopstart & 0xff))
-  outFile.write(chr((loopstart & 0xff00) >> 8 ))
+  outStream.word(loopstart)
   incFile.write('.dw %s \n' % loopstart)
 
 
-  outFile.write(chr(int(options.get('bpp')/2) & 0xff))
+  outStream.byte(int(options.get('bpp')/2))
   incFile.write('.db %s \n' % int(options.get('bpp')/2))
 
-  outFile.write(chr(int(options.get('tilemultiplier')) & 0xff))
+  outStream.byte(int(options.get('tilemultiplier')))
   incFile.write('.db %s \n' % int(options.get('tilemultiplier')))
 
-  outFile.write(chr(imageSizeX & 0xff))
-  outFile.write(chr((imageSizeX & 0xff00) >> 8 ))
+  outStream.word(imageSizeX)
   incFile.write('.dw %s \n' % imageSizeX)
 
 
-  outFile.write(chr(imageSizeY & 0xff))
-  outFile.write(chr((imageSizeY & 0xff00) >> 8 ))
+  outStream.word(imageSizeY)
   incFile.write('.dw %s \n' % imageSizeY)
   
 
@@ -440,23 +567,23 @@ def main():
   staticFlags |= HEADER_STATIC_FLAG_PALETTES
   if options.get('statictiles'):
     staticFlags |= HEADER_STATIC_FLAG_TILES
+  if deltaTiles[0]:
+    staticFlags |= HEADER_FLAG_TILES_DELTA
 
-  outFile.write(chr(staticFlags))
+  outStream.byte(staticFlags)
   incFile.write('.db %s \n' % staticFlags)
   
 
-  tileHash = hash(str([frame.tiles for frame in frames])) & 0xffff
+  tileHash = hash(''.join([str(frame.tiles) for frame in frames])) & 0xffff
 
-  outFile.write(chr(tileHash & 0xff))
-  outFile.write(chr((tileHash & 0xff00) >> 8 ))
+  outStream.word(tileHash)
   incFile.write('.dw %s  ;tilehash\n' % tileHash)
 
   paletteHash = hash(str([pal['color'] for pal in palette if pal['refId'] == None])) & 0xffff
 
   logging.debug("palette hash: %x" % (paletteHash & 0xffff))
   
-  outFile.write(chr(paletteHash & 0xff))
-  outFile.write(chr((paletteHash & 0xff00) >> 8 ))
+  outStream.word(paletteHash)
   incFile.write('.dw %s  ;palhash\n' % paletteHash)
 
 
@@ -472,16 +599,15 @@ def main():
   elif 3 == options.get('baseframerate'):
     framerateMask = 0x7
     
-  outFile.write(chr(framerateMask & 0xff))
+  outStream.byte(framerateMask)
   incFile.write('.db %s \n' % framerateMask)
   
   #write framepointerlist
-  outFile.seek(HEADER_SIZE)
+  outStream.fill(HEADER_SIZE)
 
   for framePointer in framePointers:
   	framePointer += HEADER_SIZE + len(framePointers)*2
-  	outFile.write(chr(framePointer & 0xff))
-  	outFile.write(chr((framePointer & 0xff00) >> 8 ))
+  	outStream.word(framePointer)
 
   for i in range(len(frames)):
     incFile.write('.dw __%s.f%s - __%s.st \n' % (labelPrefix,i,labelPrefix))
@@ -491,14 +617,13 @@ def main():
   for i in range(len(frames)):
     frame = frames[i]
     #write frame header
-    pointer = FRAME_HEADER_SIZE
     incFile.write('\n__%s.f%s:\n' % (labelPrefix,i))
 
     tilesHash = "stln%s" % abs(hash(getByteList(frame.tiles)))
     paletteLongHash = "pal%s" % abs(hash(getByteList(frame.palette)))
 
     #frame delay
-    outFile.write(chr(frameDelays[i] & 0xff))
+    outStream.byte(frameDelays[i])
     incFile.write('.db %s \n' % frameDelays[i])
 
     #flags
@@ -511,17 +636,16 @@ def main():
     flags |= FRAME_FLAG_HAS_TILEMAP_BIG if frame.allocTilemapBigLength > 0 else 0
     
     flags |= FRAME_FLAG_HAS_PALETTE if frame.allocPaletteLength > 0 else 0
-    flags |= FRAME_FLAG_HAS_TILES_NORMAL if frame.allocLenTilesNormal > 0 else 0
-    flags |= FRAME_FLAG_HAS_TILES_BIG if frame.allocLenTilesBig > 0 else 0
+    flags |= FRAME_FLAG_HAS_TILES_NORMAL if frame.uploadLenTilesNormal > 0 else 0
+    flags |= FRAME_FLAG_HAS_TILES_BIG if frame.uploadLenTilesBig > 0 else 0
 
     print('flags: 0x%00x' % flags)
     
-    outFile.write(chr(flags & 0xff))
+    outStream.byte(flags)
     incFile.write('.db %s \n' % flags)
 
     #tiles normal
-    outFile.write(chr(pointer & 0xff))
-    outFile.write(chr(pointer >> 8 ))
+    outStream.word(frame.pointers['tiles'])
     if "stln0" == tilesHash:
       incFile.write('.db 0,0,0\n')
     else:
@@ -529,21 +653,17 @@ def main():
       incFile.write('.db :%s\n' % tilesHash)
 
     #tiles normal length
-    outFile.write(chr(frame.allocLenTilesNormal & 0xff))
-    outFile.write(chr((frame.allocLenTilesNormal & 0xff00) >> 8 ))
-    incFile.write('.dw %s \n' % frame.allocLenTilesNormal)
+    outStream.word(frame.uploadLenTilesNormal)
+    incFile.write('.dw %s \n' % frame.uploadLenTilesNormal)
 
     logging.debug("frm 0x%02x tile len normal: 0x%04x, len big: 0x%04x, len total: 0x%04x" % (i, frame.allocLenTilesNormal, frame.allocLenTilesBig, frame.allocLenTilesNormal+frame.allocLenTilesBig))
-    pointer += len(frame.tiles)
 
     #tiles big length
-    outFile.write(chr(frame.allocLenTilesBig & 0xff))
-    outFile.write(chr((frame.allocLenTilesBig & 0xff00) >> 8 ))
-    incFile.write('.dw %s \n' % frame.allocLenTilesBig)
+    outStream.word(frame.uploadLenTilesBig)
+    incFile.write('.dw %s \n' % frame.uploadLenTilesBig)
 
     #palette pointer
-    outFile.write(chr(pointer & 0xff))
-    outFile.write(chr(pointer >> 8 ))
+    outStream.word(frame.pointers['palette'])
 
     if "pal0" == paletteLongHash:
       incFile.write('.db 0,0,0\n')
@@ -552,53 +672,46 @@ def main():
       incFile.write('.db :%s\n' % paletteLongHash)
 
     #palette length
-    outFile.write(chr(frame.allocPaletteLength & 0xff))
-    outFile.write(chr((frame.allocPaletteLength & 0xff00) >> 8 ))
+    outStream.word(frame.allocPaletteLength)
     incFile.write('.dw %s \n' % frame.allocPaletteLength)
 
-    pointer += len(frame.palette)
 
     #tilemap normal
     hashList = [""]
     for tile in chunks(frame.mapNormal, 4):
       for tilly in tile:
-          hashList.append("n%x" % ord(tilly))
+          hashList.append("n%x" % tilly)
     for tile in chunks(frame.mapBig, 4):
       for tilly in tile:
-          hashList.append("b%x" % ord(tilly))
+          hashList.append("b%x" % tilly)
 
     tilemapHash = string.replace("%x" % hash(reduce(lambda x,y: "%s_%s" % (x,y) , hashList)), "-", "_")
     logging.debug("tilemap hash: %s" % tilemapHash)
 
     #tilemap norm pointer
-    outFile.write(chr(pointer & 0xff))
-    outFile.write(chr(pointer >> 8 ))
+    outStream.word(frame.pointers['tilemap'])
     incFile.write('.dw stm%s\n' % tilemapHash)
     incFile.write('.db :stm%s\n' % tilemapHash)
 
     #tilemap norm length
-    outFile.write(chr(frame.allocTilemapLength & 0xff))
-    outFile.write(chr((frame.allocTilemapLength & 0xff00) >> 8 ))
+    outStream.word(frame.allocTilemapLength)
 
     incFile.write('.dw %s \n' % frame.allocTilemapLength)
 
-    pointer += len(frame.tilemap)
 
     #tilemap big length
-    outFile.write(chr(frame.allocTilemapBigLength & 0xff))
-    outFile.write(chr((frame.allocTilemapBigLength & 0xff00) >> 8 ))
+    outStream.word(frame.allocTilemapBigLength)
 
     #tilemap x-normal pointer
-    outFile.write(chr(pointer & 0xff))
-    outFile.write(chr(pointer >> 8 ))
+    outStream.word(frame.pointers['xTilemap'])
 
     hashList = [""]
     for tile in chunks(frame.xMapNormal, 4):
       for tilly in tile:
-          hashList.append("n%x" % ord(tilly))
+          hashList.append("n%x" % tilly)
     for tile in chunks(frame.xMapBig, 4):
       for tilly in tile:
-          hashList.append("b%x" % ord(tilly))
+          hashList.append("b%x" % tilly)
 
     xtilemapHash = string.replace("%x" % hash(reduce(lambda x,y: "%s_%s" % (x,y) , hashList)), "-", "_")
     logging.debug("xtilemap hash: %s" % xtilemapHash)
@@ -606,9 +719,8 @@ def main():
     incFile.write('.dw stm%s\n' % xtilemapHash)
     incFile.write('.db :stm%s\n' % xtilemapHash)
 
-    pointer += len(frame.xTilemap)
-
-    [outFile.write(byte) for byte in frame.tiles]
+    if 'tiles' in frame.stored:
+      outStream.extend(frame.tiles)
     if not "stln0" == tilesHash:
       incFile.write("""
 .ifndef %s.defined
@@ -621,7 +733,8 @@ def main():
 .endif
 """ % (tilesHash,tilesHash,tilesHash,tilesHash,getByteList(frame.tiles),tilesHash))
 
-    [outFile.write(byte) for byte in frame.palette]
+    if 'palette' in frame.stored:
+      outStream.extend(frame.palette)
     if not "pal0" == paletteLongHash:
       incFile.write("""
 .ifndef %s.defined
@@ -635,22 +748,23 @@ def main():
 """ % (paletteLongHash,paletteLongHash,paletteLongHash,paletteLongHash,getByteList(frame.palette),paletteLongHash))
 
 
-    [outFile.write(byte) for byte in frame.tilemap]
+    if 'tilemap' in frame.stored:
+      outStream.extend(frame.tilemap)
     incFile.write("""
 .ifndef stm%s.defined
   .def stm%s.defined 1
   .export stm%s.defined
-stm%s:
-    """ % (tilemapHash,tilemapHash,tilemapHash,tilemapHash))
+%sstm%s:
+    """ % (tilemapHash,tilemapHash,tilemapHash,getCyclesDefinition(tilemapHash, frame.tilemapCycles, options),tilemapHash))
 
     '''
     counter = 0
     incFile.write('.accu 16\n.index 16\n')
     for tile in chunks(frame.mapBig, 4):
-      incFile.write('\tGENERATE_SPRITE_BIG $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
+      incFile.write('\tGENERATE_SPRITE_BIG $%02x $%02x $%02x%02x $%02x \n' % (tile[0], tile[1], tile[3], tile[2], counter))
       counter += 1
     for tile in chunks(frame.mapNormal, 4):
-      incFile.write('\tGENERATE_SPRITE_NORMAL $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
+      incFile.write('\tGENERATE_SPRITE_NORMAL $%02x $%02x $%02x%02x $%02x \n' % (tile[0], tile[1], tile[3], tile[2], counter))
       counter += 1
     incFile.write('rtl\n')
     '''
@@ -665,18 +779,19 @@ stm%s:
 .ifndef stm%s.defined
   .def stm%s.defined 1
   .export stm%s.defined
-stm%s:
-""" % (xtilemapHash,xtilemapHash,xtilemapHash,xtilemapHash))
+%sstm%s:
+""" % (xtilemapHash,xtilemapHash,xtilemapHash,getCyclesDefinition(xtilemapHash, frame.xTilemapCycles, options),xtilemapHash))
 
-    [outFile.write(byte) for byte in frame.xTilemap]
+    if 'xTilemap' in frame.stored:
+      outStream.extend(frame.xTilemap)
 
     counter = 0
     incFile.write('.accu 16\n.index 16\n')
     for tile in chunks(frame.xMapBig, 4):
-      incFile.write('\tGENERATE_SPRITE_BIG $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
+      incFile.write('\tGENERATE_SPRITE_BIG $%02x $%02x $%02x%02x $%02x \n' % (tile[0], tile[1], tile[3], tile[2], counter))
       counter += 1
     for tile in chunks(frame.xMapNormal, 4):
-      incFile.write('\tGENERATE_SPRITE_NORMAL $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
+      incFile.write('\tGENERATE_SPRITE_NORMAL $%02x $%02x $%02x%02x $%02x \n' % (tile[0], tile[1], tile[3], tile[2], counter))
       counter += 1
     incFile.write('\trtl\n')
 
@@ -689,392 +804,564 @@ stm%s:
   incFile.write(';EOF\n')
   
   incFile.close()
+  outFile.write(outStream)
+  outFile.close()
   if options.get('verify'):
     graconGfx.writeSamplePalette(palette, options)
     if not options.get('statictiles'):   
       writeSampleImageAnimation(tileFramesNormal, tileFramesBig, palette, imageSizeX, imageSizeY, options)
 
-  labelPrefix = "d" + labelPrefix
 
-  #extremly bad hack to determine maximum allocation size of animation pack folders
-  if options.get('createAllocationDummy'):
-    dummyFileName = "%s/dummy.gfx_sprite.animation" % os.path.dirname(options.get('outfile'))
-    logging.debug("opening dummy file %s " % dummyFileName)
-    try:
-      dummyFileRead = open( dummyFileName, 'rb' )
-      dummyFileRead.seek(2)
-      dummyMaxTilesNormal = max(maxTileLengthNormal, struct.unpack('<H', dummyFileRead.read(2))[0])
-      dummyMaxTilesBig = max(maxTileLengthBig, struct.unpack('<H', dummyFileRead.read(2))[0])
-      dummyMaxPalette = max(maxPaletteLength, struct.unpack('<H', dummyFileRead.read(2))[0])
-      dummyMaxTilemap = max(maxTilemapLength, struct.unpack('<H', dummyFileRead.read(2))[0])
-
-      dummyFileRead.seek(16)
-      dummyMaxSizeX = max(imageSizeX, struct.unpack('<H', dummyFileRead.read(2))[0])
-      dummyMaxSizeY = max(imageSizeY, struct.unpack('<H', dummyFileRead.read(2))[0])
-
-      dummyFileRead.close()
-
-    except IOError:
-      dummyMaxTilesNormal = maxTileLengthNormal
-      dummyMaxTilesBig = maxTileLengthBig
-      dummyMaxPalette = maxPaletteLength
-      dummyMaxTilemap = maxTilemapLength
-      dummyMaxSizeX = imageSizeX
-      dummyMaxSizeY = imageSizeY
-
-    try:
-      dummyFile = open( dummyFileName, 'wb' )
-      incFileDummy = open("%s.i" % dummyFileName, 'w')
-
-    except IOError:
-      logging.error( 'unable to access required dummy-file %s' % dummyFileName)
-      sys.exit(1)
+def getCyclesDefinition(tilemapHash, cycles, options):
+  '''worst case cycles of compiled tilemap code, for cpu budget checks in the including project'''
+  if not options.get('compileTilemapCode') or 'sprite' != options.get('mode'):
+    return ''
+  return '  .def stm%s.cycles %s\n  .export stm%s.cycles\n' % (tilemapHash, cycles, tilemapHash)
 
-    incFileDummy.write('__%s.st: \n' % labelPrefix)
 
-    dummyFile.write(HEADER_MAGIC)
-    incFileDummy.write('.db "%s" \n' % HEADER_MAGIC)
+def writeAllocationDummy( options ):
+  '''extremly bad hack to determine maximum allocation size of animation pack folders. takes sizes from the header of the animation file written before'''
+  try:
+    animationFile = open( options.get('outfile'), 'rb' )
+    header = animationFile.read(HEADER_SIZE + 2)
+    animationFile.seek(struct.unpack('<H', header[HEADER_SIZE:HEADER_SIZE + 2])[0])
+    frameDelay = ord(animationFile.read(1))
+    animationFile.close()
+  except IOError:
+    logging.error( 'unable to access animation file %s' % options.get('outfile') )
+    sys.exit(1)
 
-    dummyFile.write(chr(dummyMaxTilesNormal & 0xff))
-    dummyFile.write(chr((dummyMaxTilesNormal & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % dummyMaxTilesNormal)
+  maxTileLengthNormal, maxTileLengthBig, maxPaletteLength, maxTilemapLength = struct.unpack('<4H', header[2:10])
+  imageSizeX, imageSizeY = struct.unpack('<2H', header[16:20])
+  paletteHash = struct.unpack('<H', header[23:25])[0]
+  framerateMask = ord(header[25])
+  labelPrefix = "d%x" % abs(hash(string.replace(options.get('infolder'), "/", ".")))
 
-    dummyFile.write(chr(dummyMaxTilesBig & 0xff))
-    dummyFile.write(chr((dummyMaxTilesBig & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % dummyMaxTilesBig)
-    
-    dummyFile.write(chr(dummyMaxPalette & 0xff))
-    dummyFile.write(chr((dummyMaxPalette & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % dummyMaxPalette)
-
-    dummyFile.write(chr(dummyMaxTilemap & 0xff))
-    dummyFile.write(chr((dummyMaxTilemap & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % dummyMaxTilemap)
-
-    dummyFile.write(chr(0 & 0xff))
-    dummyFile.write(chr((0 & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % 0)
-
-    dummyFile.write(chr(0 & 0xff))
-    dummyFile.write(chr((0 & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % 0)
-
-    dummyFile.write(chr(int(options.get('bpp')/2) & 0xff))
-    incFileDummy.write('.db %s \n' % int(options.get('bpp')/2))
-    dummyFile.write(chr(int(options.get('tilemultiplier')) & 0xff))
-    incFileDummy.write('.db %s \n' % int(options.get('tilemultiplier')))
-
-    dummyFile.write(chr(imageSizeX & 0xff))
-    dummyFile.write(chr((imageSizeX & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % imageSizeX)
-
-    dummyFile.write(chr(imageSizeY & 0xff))
-    dummyFile.write(chr((imageSizeY & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s \n' % imageSizeY)
-    
-    dummyFile.write(chr(0))
-    incFileDummy.write('.db %s \n' % 0)
-    
+  dummyFileName = "%s/dummy.gfx_sprite.animation" % os.path.dirname(options.get('outfile'))
+  logging.debug("opening dummy file %s " % dummyFileName)
+  try:
+    dummyFileRead = open( dummyFileName, 'rb' )
+    dummyFileRead.seek(2)
+    dummyMaxTilesNormal = max(maxTileLengthNormal, struct.unpack('<H', dummyFileRead.read(2))[0])
+    dummyMaxTilesBig = max(maxTileLengthBig, struct.unpack('<H', dummyFileRead.read(2))[0])
+    dummyMaxPalette = max(maxPaletteLength, struct.unpack('<H', dummyFileRead.read(2))[0])
+    dummyMaxTilemap = max(maxTilemapLength, struct.unpack('<H', dummyFileRead.read(2))[0])
+
+    dummyFileRead.seek(16)
+    dummyMaxSizeX = max(imageSizeX, struct.unpack('<H', dummyFileRead.read(2))[0])
+    dummyMaxSizeY = max(imageSizeY, struct.unpack('<H', dummyFileRead.read(2))[0])
+
+    dummyFileRead.close()
+
+  except IOError:
+    dummyMaxTilesNormal = maxTileLengthNormal
+    dummyMaxTilesBig = maxTileLengthBig
+    dummyMaxPalette = maxPaletteLength
+    dummyMaxTilemap = maxTilemapLength
+    dummyMaxSizeX = imageSizeX
+    dummyMaxSizeY = imageSizeY
+
+  try:
+    dummyFile = open( dummyFileName, 'wb' )
+    incFileDummy = open("%s.i" % dummyFileName, 'w')
+
+  except IOError:
+    logging.error( 'unable to access required dummy-file %s' % dummyFileName)
+    sys.exit(1)
 
-    tileHash = 0x0
-    dummyFile.write(chr(tileHash & 0xff))
-    dummyFile.write(chr((tileHash & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s ;tilehash\n' % tileHash)
+  incFileDummy.write('__%s.st: \n' % labelPrefix)
 
-    #why is this zeroed-out? we need palette hash to be able to try to allocate palette with dummy animation to see if we are able to allocate or need to bail out gracefully.
-    dummyFile.write(chr(paletteHash & 0xff))
-    dummyFile.write(chr((paletteHash & 0xff00) >> 8 ))
-    incFileDummy.write('.dw %s ;palhash\n' % paletteHash)
+  dummyStream = graconGfx.ByteStream(HEADER_MAGIC)
+  incFileDummy.write('.db "%s" \n' % HEADER_MAGIC)
 
-    dummyFile.write(chr(framerateMask & 0xff))
-    incFileDummy.write('.db %s \n' % framerateMask)
+  dummyStream.word(dummyMaxTilesNormal)
+  incFileDummy.write('.dw %s \n' % dummyMaxTilesNormal)
 
-    #write one dummy frame
-    dummyFile.seek(HEADER_SIZE)
-    framePointers = [0]
-    for framePointer in framePointers:
-      framePointer += HEADER_SIZE + len(framePointers)*2
-      dummyFile.write(chr(framePointer & 0xff))
-      dummyFile.write(chr((framePointer & 0xff00) >> 8 ))
+  dummyStream.word(dummyMaxTilesBig)
+  incFileDummy.write('.dw %s \n' % dummyMaxTilesBig)
+  
+  dummyStream.word(dummyMaxPalette)
+  incFileDummy.write('.dw %s \n' % dummyMaxPalette)
 
-    for i in range(len(framePointers)):
-      incFileDummy.write('.dw __%s.f%s - __%s.st \n' % (labelPrefix,i,labelPrefix))
+  dummyStream.word(dummyMaxTilemap)
+  incFileDummy.write('.dw %s \n' % dummyMaxTilemap)
 
+  dummyStream.word(0)
+  incFileDummy.write('.dw %s \n' % 0)
 
-    framesNormal = [([],[],[],[])]
-    framesBig = [([],[],[],[])]
-    for i in range(len(framesNormal)):
-      pointer = FRAME_HEADER_SIZE
-      incFileDummy.write('__%s.f%s:\n' % (labelPrefix,i))
+  dummyStream.word(0)
+  incFileDummy.write('.dw %s \n' % 0)
 
-      #frame delay
-      dummyFile.write(chr(0 & 0xff))
-      incFileDummy.write('.db %s \n' % frameDelays[i])
+  dummyStream.byte(int(options.get('bpp')/2))
+  incFileDummy.write('.db %s \n' % int(options.get('bpp')/2))
+  dummyStream.byte(int(options.get('tilemultiplier')))
+  incFileDummy.write('.db %s \n' % int(options.get('tilemultiplier')))
 
-      #tiles normal
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      incFileDummy.write('.dw %s \n' % pointer)
+  dummyStream.word(imageSizeX)
+  incFileDummy.write('.dw %s \n' % imageSizeX)
 
-      dummyFile.write(chr(len(framesNormal[i][0]) & 0xff))
-      dummyFile.write(chr((len(framesNormal[i][0]) & 0xff00) >> 8 ))
-      incFileDummy.write('.dw %s \n' % len(framesNormal[i][0]))
+  dummyStream.word(imageSizeY)
+  incFileDummy.write('.dw %s \n' % imageSizeY)
+  
+  dummyStream.byte(0)
+  incFileDummy.write('.db %s \n' % 0)
+  
 
-      pointer += len(framesNormal[i][0])
+  tileHash = 0x0
+  dummyStream.word(tileHash)
+  incFileDummy.write('.dw %s ;tilehash\n' % tileHash)
 
-      #tiles big
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      incFileDummy.write('.dw %s \n' % pointer)
+  #why is this zeroed-out? we need palette hash to be able to try to allocate palette with dummy animation to see if we are able to allocate or need to bail out gracefully.
+  dummyStream.word(paletteHash)
+  incFileDummy.write('.dw %s ;palhash\n' % paletteHash)
 
-      dummyFile.write(chr(len(framesBig[i][0]) & 0xff))
-      dummyFile.write(chr((len(framesBig[i][0]) & 0xff00) >> 8 ))
-      incFileDummy.write('.dw %s \n' % len(framesBig[i][0]))
+  dummyStream.byte(framerateMask)
+  incFileDummy.write('.db %s \n' % framerateMask)
 
-      pointer += len(framesBig[i][0])
+  #write one dummy frame
+  dummyStream.fill(HEADER_SIZE)
+  framePointers = [0]
+  for framePointer in framePointers:
+    framePointer += HEADER_SIZE + len(framePointers)*2
+    dummyStream.word(framePointer)
 
-      #palette
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      incFileDummy.write('.dw %s \n' % pointer)
+  for i in range(len(framePointers)):
+    incFileDummy.write('.dw __%s.f%s - __%s.st \n' % (labelPrefix,i,labelPrefix))
 
-      dummyFile.write(chr(len(framesNormal[i][3]) & 0xff))
-      dummyFile.write(chr((len(framesNormal[i][3]) & 0xff00) >> 8 ))
-      incFileDummy.write('.dw %s \n' % len(framesNormal[i][3]))
 
-      pointer += len(framesNormal[i][3])
+  framesNormal = [([],[],[],[])]
+  framesBig = [([],[],[],[])]
+  for i in range(len(framesNormal)):
+    pointer = FRAME_HEADER_SIZE
+    incFileDummy.write('__%s.f%s:\n' % (labelPrefix,i))
 
-      #tilemap normal
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      incFileDummy.write('.dw extern.Sprite.dummyOamWrite\n')
-      incFileDummy.write('.db :extern.Sprite.dummyOamWrite\n')
-      dummyFile.write(chr(len(framesNormal[i][1]) & 0xff))
-      dummyFile.write(chr((len(framesNormal[i][1]) & 0xff00) >> 8 ))
+    #frame delay
+    dummyStream.byte(0)
+    incFileDummy.write('.db %s \n' % frameDelay)
 
-      lengthy = len(framesNormal[i][1])+len(framesBig[i][1])
-      incFileDummy.write('.dw %s \n' % lengthy)
+    #tiles normal
+    dummyStream.word(pointer)
+    incFileDummy.write('.dw %s \n' % pointer)
 
-      pointer += len(framesNormal[i][1])
+    dummyStream.word(len(framesNormal[i][0]))
+    incFileDummy.write('.dw %s \n' % len(framesNormal[i][0]))
 
-      #tilemap big
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      dummyFile.write(chr(len(framesBig[i][1]) & 0xff))
-      dummyFile.write(chr((len(framesBig[i][1]) & 0xff00) >> 8 ))
-      incFileDummy.write('.dw 0 \n')
+    pointer += len(framesNormal[i][0])
 
-      pointer += len(framesBig[i][1])
+    #tiles big
+    dummyStream.word(pointer)
+    incFileDummy.write('.dw %s \n' % pointer)
 
-      #tilemap x-normal
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
-      dummyFile.write(chr(len(framesNormal[i][2]) & 0xff))
-      dummyFile.write(chr((len(framesNormal[i][2]) & 0xff00) >> 8 ))
+    dummyStream.word(len(framesBig[i][0]))
+    incFileDummy.write('.dw %s \n' % len(framesBig[i][0]))
 
-      pointer += len(framesNormal[i][2])
+    pointer += len(framesBig[i][0])
 
-      #tilemap x-big
-      dummyFile.write(chr(pointer & 0xff))
-      dummyFile.write(chr(pointer >> 8 ))
+    #palette
+    dummyStream.word(pointer)
+    incFileDummy.write('.dw %s \n' % pointer)
 
-      dummyFile.write(chr(len(framesBig[i][2]) & 0xff))
-      dummyFile.write(chr((len(framesBig[i][2]) & 0xff00) >> 8 ))
+    dummyStream.word(len(framesNormal[i][3]))
+    incFileDummy.write('.dw %s \n' % len(framesNormal[i][3]))
 
-      incFileDummy.write('.dw extern.Sprite.dummyOamWrite\n')
-      incFileDummy.write('.db :extern.Sprite.dummyOamWrite\n')
-      incFileDummy.write('.dw 0 \n')
+    pointer += len(framesNormal[i][3])
 
-      pointer += len(framesBig[i][2])
+    #tilemap normal
+    dummyStream.word(pointer)
+    incFileDummy.write('.dw extern.Sprite.dummyOamWrite\n')
+    incFileDummy.write('.db :extern.Sprite.dummyOamWrite\n')
+    dummyStream.word(len(framesNormal[i][1]))
 
-    dummyFile.close()
-    incFileDummy.write(';EOF\n')
+    lengthy = len(framesNormal[i][1])+len(framesBig[i][1])
+    incFileDummy.write('.dw %s \n' % lengthy)
 
-    incFileDummy.close()
+    pointer += len(framesNormal[i][1])
 
+    #tilemap big
+    dummyStream.word(pointer)
+    dummyStream.word(len(framesBig[i][1]))
+    incFileDummy.write('.dw 0 \n')
 
+    pointer += len(framesBig[i][1])
 
-  logging.info('Successfully wrote animation file %s.' % options.get('outfile'))
+    #tilemap x-normal
+    dummyStream.word(pointer)
+    dummyStream.word(len(framesNormal[i][2]))
+
+    pointer += len(framesNormal[i][2])
+
+    #tilemap x-big
+    dummyStream.word(pointer)
+
+    dummyStream.word(len(framesBig[i][2]))
+
+    incFileDummy.write('.dw extern.Sprite.dummyOamWrite\n')
+    incFileDummy.write('.db :extern.Sprite.dummyOamWrite\n')
+    incFileDummy.write('.dw 0 \n')
+
+    pointer += len(framesBig[i][2])
+
+  dummyFile.write(dummyStream)
+  dummyFile.close()
+  incFileDummy.write(';EOF\n')
+
+  incFileDummy.close()
 
 def writeSampleImageAnimation(tileFramesNormal, tileFramesBig, palette, imageSizeX, imageSizeY, options):
-  sample = Image.new( "RGBA", ( len(tileFramesNormal)*imageSizeX, imageSizeY ), options.get('transcol').getPIL())
+  sample = graconGfx.getSampleCanvas( len(tileFramesNormal)*imageSizeX, imageSizeY, options, 4 )
   grid = Image.new( "RGBA", ( len(tileFramesNormal)*imageSizeX, imageSizeY ), (0,0,0))
   draw = ImageDraw.Draw(grid)
+  paletteTable = graconGfx.getPaletteRgbTable( palette, options )
   outFileName = "%s.%s" % ( options.get('outfile'), 'image.sample.png' )
   for frameID in range(len(tileFramesNormal)):
     baseX = frameID*imageSizeX
-    for tile in tileFramesBig[frameID]:
-
-      tiles = tileFramesBig[frameID]
-      tileConfig = graconGfx.fetchTileConfig( tile, tiles, palette )
-      tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel'] #hack, copy pixels of referenced tile into current tile
-      actualTile = graconGfx.mirrorTile( tile, { 'x' : tileConfig['xMirror'], 'y' : tileConfig['yMirror'] } )
-      actualPalette = palette[tileConfig['palId']]
-      draw.rectangle([(actualTile['x']+baseX,actualTile['y']),(actualTile['x']+baseX+32,actualTile['y']+32)])
-      for yPos in range(len(actualTile['pixel'])):
-        for xPos in range(len(actualTile['pixel'][yPos])):
-          colorIndex = actualTile['pixel'][yPos][xPos]
-          pixel = actualPalette['color'][colorIndex]
-          pixelPos = (actualTile['x']+xPos+baseX+((yPos>>3 << 3)%32), actualTile['y']+(yPos%8)+(yPos>>5<<3) )
-          if 0 < colorIndex:
-            try:
-              sample.putpixel(pixelPos,pixel.getPIL())
-            except IndexError:
-              pass
-
-    for tile in tileFramesNormal[frameID]:
-      tiles = tileFramesNormal[frameID]
-      tileConfig = graconGfx.fetchTileConfig( tile, tiles, palette )
-      tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel'] #hack, copy pixels of referenced tile into current tile
-      actualTile = graconGfx.mirrorTile( tile, { 'x' : tileConfig['xMirror'], 'y' : tileConfig['yMirror'] } )
-      actualPalette = palette[tileConfig['palId']]
-      draw.rectangle([(actualTile['x']+baseX,actualTile['y']),(actualTile['x']+baseX+8,actualTile['y']+8)])
-      for yPos in range(len(actualTile['pixel'])):
-        for xPos in range(len(actualTile['pixel'][yPos])):
-          colorIndex = actualTile['pixel'][yPos][xPos]
-          pixel = actualPalette['color'][colorIndex]
-          pixelPos = (actualTile['x']+xPos+baseX, actualTile['y']+yPos)
-          if 0 < colorIndex:
-            try:
-              sample.putpixel(pixelPos,pixel.getPIL())
-            except IndexError:
-              pass
+    tiles = tileFramesBig[frameID]
+    graconGfx.drawSampleTiles( sample, tiles, tiles, graconGfx.resolveTileReferences(tiles, palette), paletteTable, options, baseX, True, True )
+    for tile in tiles:
+      draw.rectangle([(tile['x']+baseX,tile['y']),(tile['x']+baseX+32,tile['y']+32)])
+
+    tiles = tileFramesNormal[frameID]
+    graconGfx.drawSampleTiles( sample, tiles, tiles, graconGfx.resolveTileReferences(tiles, palette), paletteTable, options, baseX, True )
+    for tile in tiles:
+      draw.rectangle([(tile['x']+baseX,tile['y']),(tile['x']+baseX+8,tile['y']+8)])
+  sample = Image.fromarray( sample, 'RGBA' )
   if 'bg' == options.get('mode'):
     sample.save( outFileName, 'PNG' )
   else:
     blended = Image.blend(sample, grid, 0.3)
     blended.save( outFileName, 'PNG' )
 
+def getFramePool(options, frameCount):
+  '''frames are independent until palette building. no pool inside daemonic workers, e.g. those of graconBuild'''
+  processes = options.get('processes') or multiprocessing.cpu_count()
+  if 2 > min(processes, frameCount) or multiprocessing.current_process().daemon:
+    return None
+  return multiprocessing.Pool(min(processes, frameCount))
+
+def mapFrames(pool, function, jobs):
+  '''results in frame order'''
+  return pool.map(function, jobs) if pool else map(function, jobs)
+
+def parseFrame(job):
+  options, fileName, frameId = job
+  image = graconGfx.getInputImage(options, fileName)
+  return graconGfx.parseTiles(image, options, frameId), (image['resolutionX'], image['resolutionY'])
+
+def optimizeFrame(job):
+  '''static tiles are optimized against the tiles of all frames and stay in the parent process'''
+  options, tiles, palette = job
+  return graconGfx.augmentOutIds(graconGfx.tilesLengthCheck(graconGfx.optimizeTilesNew(graconGfx.palettizeTiles(tiles, palette, options), None, options), options))
+
+def palettizeFrame(job):
+  options, tiles, palette = job
+  return graconGfx.augmentOutIds(graconGfx.palettizeTiles(tiles, palette, options))
+
+def getKeyframes(frameCount, loopstart, options):
+  '''frames uploading all their tiles. looping back to loop start must not depend on the last frame'''
+  interval = options.get('keyframeinterval')
+  return set([0, loopstart] + ([frameId for frameId in range(frameCount) if 0 == frameId % interval] if interval else []))
+
+def getDeltaTiles(framesNormal, framesBig, keyframes, options):
+  '''per frame tile block holding only the 8x8 chars differing from what the previous frames left in vram'''
+  charLength = 8 * options.get('bpp')
+  vramNormal = bytearray()
+  vramBig = bytearray()
+  deltaTiles = []
+  for i in range(len(framesNormal)):
+    if i in keyframes:
+      vramNormal = bytearray()
+      vramBig = bytearray()
+    patchesNormal = getTilePatches(framesNormal[i][0], vramNormal, charLength)
+    patchesBig = getTilePatches(framesBig[i][0], vramBig, charLength)
+
+    stream = graconGfx.ByteStream()
+    stream.byte(len(patchesNormal))
+    stream.byte(len(patchesBig))
+    for offset, length in patchesNormal + patchesBig:
+      stream.word(offset)
+      stream.word(length)
+    for offset, length in patchesNormal:
+      stream.extend(framesNormal[i][0][offset:offset+length])
+    for offset, length in patchesBig:
+      stream.extend(framesBig[i][0][offset:offset+length])
+
+    deltaTiles.append({
+      'stream' : stream,
+      'normal' : sum(length for offset, length in patchesNormal),
+      'big' : sum(length for offset, length in patchesBig)
+    })
+    vramNormal = updateVram(vramNormal, framesNormal[i][0])
+    vramBig = updateVram(vramBig, framesBig[i][0])
+
+  logging.info('delta frames upload %s of %s tile bytes' % (sum(delta['normal'] + delta['big'] for delta in deltaTiles), sum(len(framesNormal[i][0]) + len(framesBig[i][0]) for i in range(len(framesNormal)))))
+  return deltaTiles
+
+def allocateTileSlots(tileFrames, keyframes, options):
+  '''assigns vram slots to the normal tiles of all frames and points their outIds at them. returns the slot content after each frame.
+  tiles with identical chars share a slot. vram content is unknown at keyframes, so slots are only reused from the previous keyframe on'''
+  if 8 != options.get('tilesizex') or 8 != options.get('tilesizey'):
+	logging.error( 'Error, vram tile slots require 8x8 tiles.' )
+	sys.exit(1)
+
+  charLength = 8 * options.get('bpp')
+  budget = options.get('vramtiles')
+  frameChars = []
+  for tiles in tileFrames:
+    rootTiles = [tile for tile in tiles if tile['refId'] == None]
+    stream = graconGfx.getTileWriteStream(rootTiles, options)
+    frameChars.append([str(stream[i*charLength:(i+1)*charLength]) for i in range(len(rootTiles))])
+
+  slots = []
+  slotContents = []
+  for i in range(len(tileFrames)):
+    if i in keyframes:
+      slots = []
+    required = set(frameChars[i])
+    if budget < len(required):
+      logging.error( 'Error, frame %s requires %s tiles, but only %s vram tile slots are available.' % (i, len(required), budget) )
+      sys.exit(1)
+
+    for char in frameChars[i]:
+      if char in slots:
+        continue
+      if len(slots) < budget:
+        slots.append(char)
+      else:
+        evictable = [slot for slot in range(len(slots)) if slots[slot] not in required]
+        slots[max(evictable, key=lambda slot: getNextUse(frameChars, keyframes, i, slots[slot]))] = char
+
+    rootTiles = [tile for tile in tileFrames[i] if tile['refId'] == None]
+    for tileId in range(len(rootTiles)):
+      rootTiles[tileId]['outId'] = slots.index(frameChars[i][tileId])
+    slotContents.append(graconGfx.ByteStream(''.join(slots)))
+
+  logging.info('vram tile slots: %s of %s used' % (max(len(tiles) for tiles in slotContents) / charLength, budget))
+  return slotContents
+
+def getNextUse(frameChars, keyframes, frameId, char):
+  '''distance to the next frame using char. chars not used again before the next keyframe are never needed again. ties evict the lower slot'''
+  for i in range(frameId + 1, len(frameChars)):
+    if i in keyframes:
+      break
+    if char in frameChars[i]:
+      return i - frameId
+  return INFINITY
+
+def getTilePatches(tiles, vram, charLength):
+  '''(offset, length) runs of chars in tiles that differ from vram content'''
+  patches = []
+  for offset in range(0, len(tiles), charLength):
+    length = min(charLength, len(tiles) - offset)
+    if tiles[offset:offset+length] == vram[offset:offset+length]:
+      continue
+    if patches and patches[-1][0] + patches[-1][1] == offset:
+      patches[-1] = (patches[-1][0], patches[-1][1] + length)
+    else:
+      patches.append((offset, length))
+
+  if DELTA_PATCHES_MAX < len(patches):
+    #one upload spanning all changes instead
+    return [(patches[0][0], patches[-1][0] + patches[-1][1] - patches[0][0])]
+  return patches
+
+def updateVram(vram, tiles):
+  '''tiles are uploaded to the start of the allocation, chars beyond are left untouched'''
+  return bytearray(tiles) + vram[len(tiles):]
+
+def compressFrames(frames, options):
+  '''compresses the packed payloads of all frames. identical payloads are compressed once'''
+  payloads = []
+  for frame in frames:
+    payloads += [str(getattr(frame, name)) for name in frame.packed]
+  payloads = sorted(set(payloads), key=payloads.index)
+
+  pool = getFramePool(options, len(payloads))
+  compressed = dict(zip(payloads, mapFrames(pool, graconGfx.compress, payloads)))
+  if pool:
+    pool.close()
+    pool.join()
+
+  for frame in frames:
+    for name in frame.packed:
+      setattr(frame, name, compressed[str(getattr(frame, name))])
+
+def layoutFrames(frames, options):
+  '''returns frame pointers relative to the first frame, sets payload pointers relative to frame header.
+  packed animations store identical payloads once, later frames point back to them'''
+  payloadPointers = {}
+  framePointers = []
+  framePointer = 0
+  for frame in frames:
+    frame.pointers = {}
+    frame.stored = []
+    pointer = FRAME_HEADER_SIZE
+    for name in FRAME_PAYLOADS:
+      payload = str(getattr(frame, name))
+      if options.get('isPacked') and payload in payloadPointers:
+        #negative, wraps around like the 16 bit addition of the frame address does
+        frame.pointers[name] = (payloadPointers[payload] - framePointer) & 0xffff
+        continue
+      frame.pointers[name] = pointer
+      frame.stored.append(name)
+      if payload:
+        payloadPointers[payload] = framePointer + pointer
+      pointer += len(payload)
+    framePointers.append(framePointer)
+    framePointer += pointer
+  return framePointers
+
 def getCompletedFrames(tileFrames, globalTiles, palette, options):
   if options.get('statictiles'):
     tileMapGetter = graconGfx.getSpriteTileMapStreamGlobal if options.get('mode') == 'sprite' else graconGfx.getBgTileMapStreamGlobal
     globalTileStuff = graconGfx.augmentOutIds(graconGfx.tilesLengthCheck(graconGfx.optimizeTilesNew(graconGfx.palettizeTiles(globalTiles, palette, options), None, options), options))
+    globalResolution = graconGfx.resolveTileReferences(globalTileStuff, palette)
 
-    frames = [(graconGfx.getTileWriteStream([], options), tileMapGetter(tileFrame, globalTileStuff, palette, options, False, False), tileMapGetter(tileFrame, globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else [], graconGfx.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
+    frames = [(graconGfx.getTileWriteStream([], options), tileMapGetter(tileFrame, globalTileStuff, palette, options, False, False, globalResolution), tileMapGetter(tileFrame, globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap'), globalResolution) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else graconGfx.ByteStream(), graconGfx.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
     if options.get('directcolor'):
-      frames[0] = (graconGfx.getTileWriteStream(globalTileStuff, options), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, False, False), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else [], graconGfx.getPaletteWriteStream([], options))
+      frames[0] = (graconGfx.getTileWriteStream(globalTileStuff, options), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, False, False, globalResolution), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap'), globalResolution) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else graconGfx.ByteStream(), graconGfx.getPaletteWriteStream([], options))
     else:
-      frames[0] = (graconGfx.getTileWriteStream(globalTileStuff, options), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, False, False), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else [], graconGfx.getPaletteWriteStream(palette, options))
+      frames[0] = (graconGfx.getTileWriteStream(globalTileStuff, options), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, False, False, globalResolution), tileMapGetter(tileFrames[0], globalTileStuff, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap'), globalResolution) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else graconGfx.ByteStream(), graconGfx.getPaletteWriteStream(palette, options))
       
   else:
     tileMapGetter = graconGfx.getSpriteTileMapStream if options.get('mode') == 'sprite' else graconGfx.getBgTileMapStream
-    frames = [(graconGfx.getTileWriteStream(tileFrame, options), tileMapGetter(tileFrame, palette, options, False, False), tileMapGetter(tileFrame, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else [], graconGfx.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
+    frames = [(graconGfx.getTileWriteStream(tileFrame, options), tileMapGetter(tileFrame, palette, options, False, False), tileMapGetter(tileFrame, palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else graconGfx.ByteStream(), graconGfx.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
     if not options.get('directcolor'):
-      frames[0] = (graconGfx.getTileWriteStream(tileFrames[0], options), tileMapGetter(tileFrames[0], palette, options, False, False), tileMapGetter(tileFrames[0], palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else [], graconGfx.getPaletteWriteStream(palette, options))
+      frames[0] = (graconGfx.getTileWriteStream(tileFrames[0], options), tileMapGetter(tileFrames[0], palette, options, False, False), tileMapGetter(tileFrames[0], palette, options, options.get('xMirrorTilemap'), options.get('yMirrorTilemap')) if options.get('xMirrorTilemap') or options.get('yMirrorTilemap') else graconGfx.ByteStream(), graconGfx.getPaletteWriteStream(palette, options))
   return frames
 
-def generateSpriteNormal(incFile, tile, counter):
-  if 0 is ord(tile[1]):
-    yPos = "lda.b $34"
-  else:
-    yPos = """lda.w #$%x
-  clc
-  adc.b $34
-  cmp.w #233
-  bcc ++
-    lda.w #233
-++
-  sec
-  sbc.w #8""" % (ord(tile[1])+8)
-
-  if 0 is ord(tile[0]):
-    xPos = "lda.b $32"
-  else:
-    xPos = """lda.w #$%x
-  clc
-  adc.b $32
-  cmp.w #256
-  bcs +
-  sec
-  sbc.w #8""" % (ord(tile[0])+8)
-
-  if 0 is ord(tile[2]):
-    flags = "lda $62"
-  else:
-    flags = """lda.w #$%x
-clc
-adc $62
-""" % ord(tile[2])
-
-  incFile.write("""\t
-%s
-    sta.w $1ca4+$%x,y
-    and.w #$100
-    sta.w $217f
-%s
-    sta.w $1ca5+$%x,y
-%s
-    sta.w $1ca6+$%x,y
-+
-""" % (xPos, counter*4,yPos,1+counter*4,flags,2+counter*4))
-
-def generateSpriteBig(incFile, tile, counter):
-  if 0 is ord(tile[1]):
-    yPos = "lda.b $34"
+class AssembledCode(graconGfx.ByteStream):
+  '''65816 code and its worst case cycle count'''
+  cycles = 0
+
+def assembleSpriteTilemapCode(normal, big, options):
+  '''65816 code writing a sprite tilemap to the oam buffer, same effect as the GENERATE_SPRITE_BIG/GENERATE_SPRITE_NORMAL macro sequence.
+  16 bit accu and index, y: oam buffer offset, $32/$34: x/y position, $60/$62/$64: tile/attribute bases. ends with rtl'''
+  if big and not options.get('bigspritelut'):
+	logging.error( 'Error, compiled tilemap code for big sprites requires -bigspritelut.' )
+	sys.exit(1)
+
+  sprites = [(tile[0], tile[1], tile[2] | (tile[3] << 8), options.get('bigspritelut')) for tile in chunks(big, 4)]
+  sprites += [(tile[0], tile[1], tile[2] | (tile[3] << 8), None) for tile in chunks(normal, 4)]
+
+  code = AssembledCode()
+  counter = 0
+  while counter < len(sprites):
+    run = getAttributeRun(sprites, counter, options)
+    for spriteId in run:
+      x, y, flags, bigLut = sprites[spriteId]
+      assembleSprite(code, x, y, flags, spriteId, bigLut, options, 1 == len(run))
+    if 1 < len(run):
+      #sprites that are never skipped store their shared attributes in one go. y-position word stores overlap the attribute low byte, so attributes go last
+      assembleAttributes(code, sprites[counter][2], sprites[counter][3])
+      for spriteId in run:
+        assemble(code, 'sta abs,y', 0x1ca6 + spriteId*4)
+    counter += len(run)
+  assemble(code, 'rtl')
+  return code
+
+def getAttributeRun(sprites, start, options):
+  '''ids of adjacent sprites from start on with equal attributes, all never skipped. at least start'''
+  run = [start]
+  for spriteId in range(start + 1, len(sprites)):
+    if sprites[spriteId][2:] != sprites[start][2:] or not isOnscreenX(sprites[start][0], options) or not isOnscreenX(sprites[spriteId][0], options):
+      break
+    run.append(spriteId)
+  return run
+
+def isOnscreenX(x, options):
+  '''sprite at unmodified object position or can't cross the right screen border'''
+  return 0 == x or SCREEN_WIDTH > x + 8 + options.get('positionxmax')
+
+def assembleSprite(code, x, y, flags, counter, bigLut, options, attributes=True):
+  '''one oam entry. sprites beyond the right screen border are skipped, bottom border is clamped. bigLut: sprite32x32id.lut address for big sprites.
+  checks are left out where position ranges prove them redundant'''
+  skip = None
+  if 0 == x:
+    assemble(code, 'lda dp', 0x32)
+  elif isOnscreenX(x, options):
+    assembleAdd(code, x, 0x32)
   else:
-    yPos = """lda.w #$%x
-  clc
-  adc.b $34
-  cmp.w #233
-  bcc ++
-    lda.w #233
-++
-  sec
-  sbc.w #8""" % (ord(tile[1])+8)
-
-  if 0 is ord(tile[0]):
-    xPos = "lda.b $32"
+    assemble(code, 'lda #', x + 8)
+    assemble(code, 'clc')
+    assemble(code, 'adc dp', 0x32)
+    assemble(code, 'cmp #', SCREEN_WIDTH)
+    skip = assemble(code, 'bcs')
+    assemble(code, 'sec')
+    assemble(code, 'sbc #', 8)
+  assemble(code, 'sta abs,y', 0x1ca4 + counter*4)
+
+  #x bit 8 and size bit go to the oam high table through wmdata
+  if SCREEN_WIDTH > x + options.get('positionxmax'):
+    if None == bigLut:
+      assemble(code, 'stz abs', 0x217f)
+    else:
+      assemble(code, 'lda #', 0x200)
+      assemble(code, 'sta abs', 0x217f)
   else:
-    xPos = """lda.w #$%x
-  clc
-  adc.b $32
-  cmp.w #256
-  bcs +
-  sec
-  sbc.w #8""" % (ord(tile[0])+8)
-
-  if 0 is ord(tile[2]):
-    flags = "lda $62"
+    assemble(code, 'and #', 0x100)
+    if None != bigLut:
+      assemble(code, 'ora #', 0x200)
+    assemble(code, 'sta abs', 0x217f)
+
+  if 0 == y:
+    assemble(code, 'lda dp', 0x34)
+  elif SCREEN_CLAMP_Y > y + 8 + options.get('positionymax'):
+    assembleAdd(code, y, 0x34)
   else:
-    flags = """lda.w #$%x
-clc
-adc $62
-""" % ord(tile[2])
-
-  if 0 is ord(tile[2]) & OAM_FORMAT_TILE:
-    flags1 = "lda $60"
+    assemble(code, 'lda #', y + 8)
+    assemble(code, 'clc')
+    assemble(code, 'adc dp', 0x34)
+    assemble(code, 'cmp #', SCREEN_CLAMP_Y)
+    clamped = assemble(code, 'bcc')
+    assemble(code, 'lda #', SCREEN_CLAMP_Y)
+    resolveBranch(code, clamped)
+    assemble(code, 'sec')
+    assemble(code, 'sbc #', 8)
+  assemble(code, 'sta abs,y', 0x1ca5 + counter*4)
+
+  if attributes:
+    assembleAttributes(code, flags, bigLut)
+    assemble(code, 'sta abs,y', 0x1ca6 + counter*4)
+
+  if None != skip:
+    resolveBranch(code, skip)
+
+def assembleAttributes(code, flags, bigLut):
+  if None == bigLut:
+    assembleAdd(code, flags, 0x62)
   else:
-    flags1 = """lda.w #$%x
-    clc
-    adc $60
-""" % (ord(tile[2]) & OAM_FORMAT_TILE)
-
-
-  if 0 is ord(tile[2]) & (OAM_FORMAT_HFLIP | OAM_FORMAT_VFLIP):
-    flags2 = "lda $64"
+    assembleAdd(code, flags & OAM_FORMAT_TILE, 0x60)
+    assemble(code, 'asl a')
+    assemble(code, 'tax')
+    assembleAdd(code, flags & (OAM_FORMAT_HFLIP | OAM_FORMAT_VFLIP), 0x64)
+    assemble(code, 'clc')
+    assemble(code, 'adc long,x', bigLut)
+
+def assembleAdd(code, value, address):
+  '''accu = value + direct page word'''
+  if 0 == value:
+    assemble(code, 'lda dp', address)
   else:
-    flags2 = """lda.w #$%x
-    clc
-    adc $64""" % (ord(tile[2]) & (OAM_FORMAT_HFLIP | OAM_FORMAT_VFLIP))
-
-
-  incFile.write("""\t
-%s
-    sta.w $1ca4+$%x,y
-    and.w #$100
-    ora.w #$200
-    sta.w $217f
-%s
-    sta.w $1ca5+$%x,y
-%s
-    asl a
-    tax
-%s
-    clc
-    adc.l sprite32x32id.lut,x
-    sta.w $1ca6+$%x,y
-+    
-""" % (xPos, counter*4,yPos,1+counter*4,flags1,flags2,2+counter*4))
+    assemble(code, 'lda #', value)
+    assemble(code, 'clc')
+    assemble(code, 'adc dp', address)
+
+def assemble(code, mnemonic, operand=0):
+  '''appends instruction, returns its position. branches are forward only, their target is set by resolveBranch()'''
+  opcode, operandLength, cycles = OPCODES[mnemonic]
+  code.cycles += cycles
+  position = len(code)
+  code.byte(opcode)
+  for i in range(operandLength):
+    code.byte(operand >> (i * 8))
+  return position
+
+def resolveBranch(code, position):
+  '''points branch at position to the end of code'''
+  distance = len(code) - position - 2
+  if 0x7f < distance:
+    raise graconGfx.ConversionError( 'Branch distance %s in compiled tilemap code out of range.' % distance )
+  code[position + 1] = distance
 
 
 def debugLog( data, message = '' ):
@@ -1119,26 +1406,37 @@ def getByteList(data):
   if 0 == len(data):
     return ''
   else:
-    return '.db %s' % ','.join([str(ord(byte)) for byte in data])
+    return '.db %s' % ','.join([str(byte) for byte in data])
 
 class Frame():
-  def __init__(self, normal, big, options):
-    self.tiles = [chr(ord(byte)) for byte in graconGfx.compress(normal[0] + big[0])] if options.get('isPacked') else normal[0] + big[0]
+  def __init__(self, normal, big, options, delta=None):
+    tiles = delta['stream'] if delta else normal[0] + big[0]
+    self.tiles = tiles
+    self.tileBlockLength = len(tiles)
+    #payloads compressed later by compressFrames()
+    self.packed = ['tiles'] if options.get('isPacked') else []
     self.allocLenTilesNormal = len(normal[0])
     self.allocLenTilesBig = len(big[0])
+    self.uploadLenTilesNormal = delta['normal'] if delta else self.allocLenTilesNormal
+    self.uploadLenTilesBig = delta['big'] if delta else self.allocLenTilesBig
+    #worst case cycles of compiled tilemap code
+    self.tilemapCycles = 0
+    self.xTilemapCycles = 0
 
     logging.debug("tilemap len norm %s big %s" % (len(normal[1]), len(big[1])))
     #self.tilemap = [chr(ord(byte)) for byte in graconGfx.compress(normal[1])] if 'bg' == options.get('mode') else [chr(ord(byte)) for byte in self.compileSpriteTilemapCode(normal[1], big[1])]
     if 'bg' == options.get('mode'):
-        self.tilemap = [chr(ord(byte)) for byte in graconGfx.compress(normal[1])] if not options.get('statictiles') else normal[1]
+        self.tilemap = normal[1]
+        self.packed += ['tilemap'] if not options.get('statictiles') else []
         self.allocTilemapLength = len(normal[1])
         self.allocTilemapBigLength = 0
     elif options.get('compileTilemapCode'):
-        self.tilemap = [chr(ord(byte)) for byte in self.compileSpriteTilemapCode(normal[1], big[1])]
+        self.tilemap = self.compileSpriteTilemapCode(normal[1], big[1], options)
+        self.tilemapCycles = self.tilemap.cycles
         self.allocTilemapLength = len(normal[1])
         self.allocTilemapBigLength = len(big[1])
     else:
-        self.tilemap = [chr(ord(byte)) for byte in normal[1] + big[1]]
+        self.tilemap = normal[1] + big[1]
         self.allocTilemapLength = len(normal[1])
         self.allocTilemapBigLength = len(big[1])
         if (FRAME_TILEMAP_NORMAL_MAX*4) < len(normal[1]):
@@ -1155,11 +1453,13 @@ class Frame():
 
     #self.xTilemap = [chr(ord(byte)) for byte in graconGfx.compress(normal[2])] if 'bg' == options.get('mode') else [chr(ord(byte)) for byte in self.compileSpriteTilemapCode(normal[2], big[2])]
     if 'bg' == options.get('mode'):
-        self.xTilemap = [chr(ord(byte)) for byte in graconGfx.compress(normal[2])]
+        self.xTilemap = normal[2]
+        self.packed.append('xTilemap')
     elif options.get('compileTilemapCode'):
-        self.xTilemap = [chr(ord(byte)) for byte in self.compileSpriteTilemapCode(normal[2], big[2])]
+        self.xTilemap = self.compileSpriteTilemapCode(normal[2], big[2], options)
+        self.xTilemapCycles = self.xTilemap.cycles
     else:
-        self.xTilemap = [chr(ord(byte)) for byte in normal[2] + big[2]]
+        self.xTilemap = normal[2] + big[2]
 
     self.palette = normal[3]
     self.allocPaletteLength = len(normal[3])
@@ -1167,77 +1467,21 @@ class Frame():
 
   #required for sort, compare, hash
   def getLength(self):
-    return FRAME_HEADER_SIZE + len(self.tiles + self.tilemap + self.xTilemap + self.palette)
-
-  def compileSpriteTilemapCode(self, normal, big):
-    lnkFile = open("build/lnk/sprite.lst", 'w')
-    lnkFile.write("[objects]\nbuild/temp.o")
-    lnkFile.close()
-    srcFile = open("build/temp", 'w')
-    srcFile.write('''
-      .include "src/config/config.inc"
-
-      ;zp-vars,just a reference
-      .enum 0
-        iterator INSTANCEOF iteratorStruct
-        dimension INSTANCEOF dimensionStruct
-        animation INSTANCEOF animationStruct
-        oam INSTANCEOF oamStruct
-      zpLen ds 0
-      .ende
-
-      .ramsection "oam buffer zp" bank 0 slot 6
-        GLOBAL.oamBuffer INSTANCEOF oamSlot OAM_SLOTS
-        GLOBAL.oamBuffer.end ds 0
-        GLOBAL.oamBufferHi ds OAM_SLOTS
-        GLOBAL.oamBufferHi.end ds 0
-      .ends
-
-      ;object class static flags, default properties and zero page 
-      .define CLASS.FLAGS OBJECT.FLAGS.Present
-      .define CLASS.PROPERTIES 0
-      .define CLASS.ZP_LENGTH zpLen
-      .define CLASS.IMPLEMENTS interface.dimension
-
-/*
-      .base BSL
-      .bank STATIC.32X32_LUT >> 16
-      .org 0
-      .section "sprite32x32id.lut" force
-        .include "src/object/sprite/32x32id.lut"
-      .ends
-*/
-      ;crappy hack
-      .def sprite32x32id.lut (STATIC.32X32_LUT | (BSL << 16))
-
-      .base BSL
-      .bank 0 slot 0      
-    ''')
-
-    counter = 0
-    srcFile.write('.accu 16\n.index 16\n')
-    for tile in chunks(big, 4):
-      srcFile.write('\tGENERATE_SPRITE_BIG $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
-      counter += 1
-    for tile in chunks(normal, 4):
-      srcFile.write('\tGENERATE_SPRITE_NORMAL $%02x $%02x $%02x%02x $%02x \n' % (ord(tile[0]), ord(tile[1]), ord(tile[3]), ord(tile[2]), counter))
-      counter += 1
-    srcFile.write('\trtl\n')
-    srcFile.close()
-
-    try:
-      subprocess.check_call(['wla-65816', '-o', 'build/temp', 'build/temp.o'])
-      subprocess.check_call(['wlalink', '-b', 'build/lnk/sprite.lst', 'build/sprite.bin'])
-    except subprocess.CalledProcessError as e:
-      logging.error( 'Error while compiling sprite code.')
-      sys.exit(1)
+    return FRAME_HEADER_SIZE + len(self.tiles) + len(self.tilemap) + len(self.xTilemap) + len(self.palette)
 
-    binFile = open('build/sprite.bin', 'rb' )
-    bindata = binFile.read()
-    binFile.close()
-    return bindata
+  def compileSpriteTilemapCode(self, normal, big, options):
+    key = (str(normal), str(big), options.get('bigspritelut'), options.get('positionxmax'), options.get('positionymax'))
+    if key not in compiledTilemaps:
+      compiledTilemaps[key] = assembleSpriteTilemapCode(normal, big, options)
+    code = AssembledCode(compiledTilemaps[key])
+    code.cycles = compiledTilemaps[key].cycles
+    return code
 
 
 if __name__ == "__main__":
+  try:
 	main()
+  except graconGfx.ConversionError as error:
+	logging.error( error )
+	sys.exit(1)
 
@@ -37,6 +37,7 @@ import sys
 import math
 import time
 import graconUserOptions
+import graconCache
 import graconGfx
 import logging
 from PIL import Image
@@ -67,7 +68,11 @@ def main():
 	  'type'			: 'str'
 	  },
   })
-  
+
+  graconCache.run( options, [options.get('infolder')], [options.get('outfile')], lambda: convert( options ) )
+
+
+def convert( options ):
   if not os.path.exists(options.get('infolder')):
 	logging.error( 'Error, input folder "%s" is nonexistant.' % options.get('infolder') )
 	sys.exit(1)
@@ -103,25 +108,25 @@ def main():
 	logging.error( 'unable to access required output-file %s' % options.get('outfile') )
 	sys.exit(1)
 
-  outFile.write(HEADER_MAGIC)
+  stream = graconGfx.ByteStream(HEADER_MAGIC)
 
-  outFile.write(chr(HDMA_TYPE_COLOR))
+  stream.byte(HDMA_TYPE_COLOR)
   
-  outFile.write(chr(len(images) & 0xff))
-  outFile.write(chr((len(images) & 0xff00) >> 8 ))
+  stream.word(len(images))
 
-  outFile.write(chr(loopstart & 0xff))
-  outFile.write(chr((loopstart & 0xff00) >> 8 ))
+  stream.word(loopstart)
 
-  outFile.seek(HEADER_SIZE)
+  stream.fill(HEADER_SIZE)
   for framePointer in framePointers:
 	framePointer += HEADER_SIZE + len(framePointers)*2
-	outFile.write(chr(framePointer & 0xff))
-	outFile.write(chr((framePointer & 0xff00) >> 8 ))
+	stream.word(framePointer)
 
   #write frames
   for image in images:
-    [outFile.write(chr(byte)) for byte in image]
+    stream.extend(image)
+
+  outFile.write(stream)
+  outFile.close()
 
   logging.info('Successfully wrote hdma animation file %s.' % options.get('outfile'))
 
@@ -199,7 +204,7 @@ def getHdmaList(filename):
             'data': [out[0], out[1]]
           })
 
-  stream = []
+  stream = graconGfx.ByteStream()
   last = [128,0,0]
   for i in range(len(hdmaList)):
     try:
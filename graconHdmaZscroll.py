@@ -36,6 +36,7 @@ import sys
 import math
 import time
 import graconUserOptions
+import graconCache
 import graconGfx
 import logging
 from PIL import Image
@@ -83,6 +84,10 @@ def main():
     }
   })
 
+  graconCache.run( options, [options.get('infolder')], [options.get('outfile')], lambda: convert( options ) )
+
+
+def convert( options ):
   zBuffer = getZBuffer(options)
   frames = []
 
@@ -101,22 +106,24 @@ def main():
     logging.error( 'unable to access required output-file %s' % options.get('outfile') )
     sys.exit(1)
 
-  outFile.write(HEADER_MAGIC)
+  stream = graconGfx.ByteStream(HEADER_MAGIC)
 
-  outFile.write(chr(HDMA_TYPE_SCROLL))
+  stream.byte(HDMA_TYPE_SCROLL)
   
-  outFile.write(chr(len(frames) & 0xff))
-  outFile.write(chr((len(frames) & 0xff00) >> 8 ))
+  stream.word(len(frames))
 
-  outFile.seek(HEADER_SIZE)
+  stream.fill(HEADER_SIZE)
   for framePointer in framePointers:
     framePointer += HEADER_SIZE + len(framePointers)*2
-    outFile.write(chr(framePointer & 0xff))
-    outFile.write(chr((framePointer & 0xff00) >> 8 ))
+    stream.word(framePointer)
 
   #write frames
   for frame in frames:
-    [outFile.write(byte) for entry in frame for byte in entry.getCharData()]
+    for entry in frame:
+      stream.extend(entry.getCharData())
+
+  outFile.write(stream)
+  outFile.close()
 
   logging.info('Successfully wrote hdma animation file %s.' % options.get('outfile'))
 
@@ -214,11 +221,10 @@ class Hdma():
     self.value.append(other.value[0])
 
   def getCharData(self):
-    out = []
-    out.append(chr(self.count | 0x80 if self.repeat else self.count))
+    out = graconGfx.ByteStream()
+    out.byte(self.count | 0x80 if self.repeat else self.count)
     for byte in self.value:
-      out.append(chr(byte & 0xff))
-      out.append(chr(byte >> 8 & 0xff))
+      out.word(byte)
 
     return out
 
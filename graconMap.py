@@ -93,6 +93,7 @@ import string
 import logging
 import xml.dom.minidom
 import graconUserOptions
+import graconCache
 import graconGfx
 
 META_TILESIZE = 16
@@ -221,10 +222,12 @@ def main():
     }
   })
 
+  graconCache.run( options, getInputFiles( options ), getOutputFiles( options ), lambda: convert( options ) )
+
+
+def convert( options ):
   options.set('transcol', graconGfx.Color(graconGfx.getColorTuple(options.get('transcol'))))
   
-  sys.setrecursionlimit(10000)
-  
   singleTileSize = options.get('tilesizex') * options.get('tilesizey') / 2
 
   options.set('outfilebase', options.get('outfile'))
@@ -526,6 +529,7 @@ def main():
     'id' : tile['id'],
     'palette' : dummyTile['palette'],
     'pixel' : dummyTile['pixel'],
+    'rgb' : dummyTile['rgb'],
     'pixhash' : dummyTile['pixhash'],
     'refId' : dummyTile['refId'],
     'x' : tile['x'],
@@ -625,6 +629,7 @@ def main():
       'id' : tile['id'],
       'palette' : dummyStatusTile['palette'],
       'pixel' : dummyStatusTile['pixel'],
+      'rgb' : dummyStatusTile['rgb'],
       'pixhash' : dummyStatusTile['pixhash'],
       'refId' : dummyStatusTile['refId'],
       'x' : tile['x'],
@@ -773,7 +778,7 @@ def main():
       outFile.write(' .dw %s.parameter.%s ;parameter name\n' % (objects[i]['class'], parameter['name']))
       outFile.write(' .dw %s ;parameter value\n' % (parameter['value'] if parameter['value'] else "object.parameter.void"))
   outFile.write('\nlevel.%s.objectmap: ;obsolete, object map data\n .db 0\n.ends\n\n' % (levelName))
-  outFile.write('\n.section "level.%s.tilemap" superfree\nlevel.%s.tilemap: ;compressed metatiles\n %s\n.ends\n\n' % (levelName, levelName, getByteList(graconGfx.compress([chr(byte) for byte in getWordByteList(metaLayers['tiles'])]))))
+  outFile.write('\n.section "level.%s.tilemap" superfree\nlevel.%s.tilemap: ;compressed metatiles\n %s\n.ends\n\n' % (levelName, levelName, getByteList(graconGfx.compress(getWordByteList(metaLayers['tiles'])))))
   
   #compressed
   allMaps = metaLayers['layers'][0] + metaLayers['layers'][1]
@@ -785,7 +790,7 @@ def main():
   logging.debug("%s layers, %x tiles" % (len(metaLayers['layers']), len(allMaps) ))
 
   allMapsBytes = getWordByteList(allMaps)
-  allMapsCompressed = graconGfx.compress([chr(byte) for byte in allMapsBytes])
+  allMapsCompressed = graconGfx.compress(allMapsBytes)
   outFile.write('\n.section "level.%s.layers" superfree\nlevel.%s.layers: ;all compressed layers\n %s\n\n\n' % (levelName, levelName, getByteList(allMapsCompressed)))  
 
   outFile.write('\n.ends\n\n')
@@ -825,7 +830,7 @@ def main():
 
   if options.get('dump'):
     dumpBinaryFile(getWordByteList(metaLayers['tiles']), 'metatilelist', options)
-    dumpBinaryFile([int(ord(byte)) for byte in bgTilesetStream], 'tile', options)
+    dumpBinaryFile(bgTilesetStream, 'tile', options)
 
 
     for layerId in range(len(metaLayers['layers'])):
@@ -834,6 +839,25 @@ def main():
   logging.debug('exiting...')
 
 
+def getInputFiles(options):
+  '''map file, reference palettes and all tileset images referenced by the map'''
+  inputFiles = [options.get('infile'), '%s.palette.png' % options.get('infile'), '%s.palette_status.png' % options.get('infile')]
+  try:
+    xmlDom = xml.dom.minidom.parse(options.get('infile'))
+  except (IOError, xml.parsers.expat.ExpatError):
+    return inputFiles
+
+  for image in xmlDom.getElementsByTagName('image'):
+    for source in sorted(set([image.getAttribute('source'), image.getAttribute('source').replace('~WORKFILE', '')])):
+      inputFiles.append("%s/%s" % (os.path.dirname(options.get('infile')), source))
+  return inputFiles
+
+
+def getOutputFiles(options):
+  '''level file, -dump binaries and -verify samples'''
+  return [options.get('outfile')] + ['%s.%s' % (options.get('outfile'), name) for name in ('metatilelist', 'tile', 'layer.*', 'palette.sample.png', 'image.sample.png', 'tileset.sample.png')]
+
+
 def dumpBinaryFile(data, name, options):
   try:
     outFileName = '%s.%s' % (options.get('outfile'), name)
@@ -842,21 +866,20 @@ def dumpBinaryFile(data, name, options):
     logging.error( 'unable to access required output-file %s' % outFileName )
     sys.exit(1)
 
-  [outFile.write(chr(byte)) for byte in data]
+  outFile.write(data)
   outFile.close()
 
 
 def getByteList(data):
-  return '.db %s' % ','.join([str(ord(byte)) for byte in data])
+  return '.db %s' % ','.join([str(byte) for byte in data])
 
 def getByteIntList(data):
   return '.db %s' % ','.join([("$%x" % byte) for byte in data])
   
 def getWordByteList(data):
-  output = []
+  output = graconGfx.ByteStream()
   for byte in data:
-      output.append((byte)&0xff)
-      output.append(((byte)&0xff00) >> 8 )
+      output.word(byte)
   return output
 
 def getWordList(data):
@@ -866,6 +889,7 @@ def getUsedTiles(bgLayers, tileset):
   return set([max(0,(tile & ~(TILED_ID_FLIP_DIAGONAL | TILED_ID_FLIP_X | TILED_ID_FLIP_Y)) - int(tileset['firstgid'])) for layer in bgLayers for tile in layer['data']])
 
 def convertLayerTilemaps(bgLayers, tileset, convertedTileset, palette, options, offset):
+  resolution = graconGfx.resolveTileReferences(convertedTileset, palette)
   for layerId in range(len(bgLayers)):
     for tileId in range(len(bgLayers[layerId]['data'])):
       #0 denotes empty tile. anything > 0 is a set tile
@@ -874,7 +898,7 @@ def convertLayerTilemaps(bgLayers, tileset, convertedTileset, palette, options,
       if 0 != tileIdValue:
         try:
           tile = convertedTileset[tileIdValue - int(tileset['firstgid'])]
-          bgLayers[layerId]['data'][tileId] = (graconGfx.fetchTileConfig( tile, convertedTileset, palette )['concatConfig'] + offset) #+1 because of empty tile
+          bgLayers[layerId]['data'][tileId] = (graconGfx.fetchTileConfig( tile, resolution )['concatConfig'] + offset) #+1 because of empty tile
           if tileIdWithFlags & TILED_ID_FLIP_DIAGONAL:
             logging.info('Tile rotation unsupported for tile id %s contained in layer %s.' % (tileId, layerId))
           if tileIdWithFlags & TILED_ID_FLIP_Y:
@@ -1068,5 +1092,9 @@ def getMetaTilesAbsoluteBlock(layers, width):
   }
 
 if __name__ == "__main__":
+  try:
 	main()
+  except graconGfx.ConversionError as error:
+	logging.error( error )
+	sys.exit(1)
 
@@ -5,6 +5,7 @@ import re
 import sys
 import math
 import logging
+import graconCache
 
 BRR_BLOCK_SAMPLES = 16
 BRR_BLOCK_LENGTH = 9
@@ -38,18 +39,24 @@ INSTR_RES_MULTI = 1
 validModSignatures = [ 'M.K.', '1CHN', '2CHN', '3CHN', '4CHN', '5CHN', '6CHN', '7CHN', '8CHN']
 
 
-globalSampleBuffer = {
-  'last'		: 0,
-  'beforeLast'	: 0
-}
+def resetState():
+  '''sample buffer and statistics are per module, conversions may run one after another in the same process'''
+  global globalSampleBuffer
+  global statistics
+  globalSampleBuffer = {
+    'last'		: 0,
+    'beforeLast'	: 0
+  }
 
-statistics = {
-  'samples'	: 0,
-  'filter'	: { 0:0,1:0,2:0,3:0 },
-  'range'	: { 0:0,1:0,2:0,3:0,4:0,5:0,6:0,7:0,8:0,9:0,10:0,11:0,12:0 },
-  'maxError': 0,
-  'minError': BRR_BLOCK_SAMPLES * 0xffff
-}
+  statistics = {
+    'samples'	: 0,
+    'filter'	: { 0:0,1:0,2:0,3:0 },
+    'range'	: { 0:0,1:0,2:0,3:0,4:0,5:0,6:0,7:0,8:0,9:0,10:0,11:0,12:0 },
+    'maxError': 0,
+    'minError': BRR_BLOCK_SAMPLES * 0xffff
+  }
+
+resetState()
 
 logging.basicConfig(
                     level=logging.ERROR,
@@ -77,6 +84,11 @@ def main():
       inRomFileName = False
       outRomFileName = False
 
+    graconCache.run( sys.argv[1:], [inFileName, inRomFileName], [outFileName, outRomFileName], lambda: convert( inFileName, outFileName, inRomFileName, outRomFileName ) )
+
+
+def convert( inFileName, outFileName, inRomFileName, outRomFileName ):
+    resetState()
     try:
       inFile = open( inFileName, 'rb' )
     except IOError:
@@ -41,6 +41,7 @@ import sys
 import math
 import time
 import graconUserOptions
+import graconCache
 import graconGfx
 import logging
 import pprint
@@ -162,8 +163,10 @@ def main():
       },      
   })
 
-  sys.setrecursionlimit(10000)
-    
+  graconCache.run( options, [options.get('infolder')], [options.get('outfile')], lambda: convert( options ) )
+
+
+def convert( options ):
   if not os.path.exists(options.get('infolder')):
 	logging.error( 'Error, input folder "%s" is nonexistant.' % options.get('infolder') )
 	sys.exit(1)
@@ -222,41 +225,42 @@ def main():
 	logging.error( 'unable to access required output-file %s' % options.get('outfile') )
 	sys.exit(1)
 
-  outFile.write(HEADER_MAGIC)
+  stream = graconGfx.ByteStream(HEADER_MAGIC)
   
-  outFile.write(chr(maxPaletteLength & 0xff))
-  outFile.write(chr((maxPaletteLength & 0xff00) >> 8 ))
+  stream.word(maxPaletteLength)
 
-  outFile.write(chr(framecount & 0xff))
-  outFile.write(chr((framecount & 0xff00) >> 8 ))
+  stream.word(framecount)
 
-  outFile.write(chr(loopstart & 0xff))
-  outFile.write(chr((loopstart & 0xff00) >> 8 ))
+  stream.word(loopstart)
 
   paletteHash = hash(str([[color for palette in paletteFrames for color in palette]])) & 0xffff
 
   logging.debug("palette hash: %x" % (paletteHash & 0xffff))
 
-  outFile.write(chr(paletteHash & 0xff))
-  outFile.write(chr((paletteHash & 0xff00) >> 8 ))
+  stream.word(paletteHash)
 
   #write framepointerlist
-  outFile.seek(HEADER_SIZE)
+  stream.fill(HEADER_SIZE)
   for framePointer in framePointers:
 	framePointer += HEADER_SIZE + len(framePointers)*2
-	outFile.write(chr(framePointer & 0xff))
-	outFile.write(chr((framePointer & 0xff00) >> 8 ))
+	stream.word(framePointer)
 
   #write frames
   for i in range(len(paletteFrames)):
     for color in paletteFrames[i]:
-      outFile.write(chr(color.getSNES() & 0xff))
-      outFile.write(chr((color.getSNES() & 0xff00) >> 8 ))
+      stream.word(color.getSNES())
+
+  outFile.write(stream)
+  outFile.close()
 
   logging.info('Successfully wrote animation file %s.' % options.get('outfile'))
 
   
   
 if __name__ == "__main__":
+  try:
 	main()
+  except graconGfx.ConversionError as error:
+	logging.error( error )
+	sys.exit(1)
 
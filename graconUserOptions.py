@@ -14,16 +14,30 @@ import sys
 import logging
 
 
+class OptionsError(Exception):
+  pass
+
+
 class Options():
-  def __init__( self, args, defaults ):
-	self.__options = self.__parseUserArguments(args, defaults)
+  '''values: optional dict of option values, applied on top of args. raiseErrors: raise OptionsError instead of exiting'''
+  def __init__( self, args, defaults, values=None, raiseErrors=False ):
+	self.__raiseErrors = raiseErrors
+	self.__options = self.__parseUserArguments(args, defaults, values or {})
 
   def get( self, option ):
 	if option in self.__options:
 	  return self.__options[option]['value']
 	else:
-	  logging.error( 'Invalid option %s requested.' % option )
-	  sys.exit(1)
+	  self.__fail( 'Invalid option %s requested.' % option )
+
+  def __fail( self, message ):
+	if self.__raiseErrors:
+	  raise OptionsError( message )
+	logging.error( message )
+	sys.exit(1)
+
+  def items( self ):
+	return sorted( ( optionName, optionValue['value'] ) for optionName, optionValue in self.__options.iteritems() )
 
   def manualSet( self, option, value ):
 	self.__options[option]['value'] = value
@@ -31,12 +45,16 @@ class Options():
   def set( self, option, value ):
 	self.__options[option]['value'] = value
 
-  def __parseUserArguments( self, args, defaults ):
+  def __parseUserArguments( self, args, defaults, values ):
 	options = defaults
 	  
 	for i in range( len( args ) ):
 	  if args[i][1:] in defaults:
 		options[args[i][1:]]['value'] = args[i+1]
+	for optionName, value in values.iteritems():
+	  if optionName not in defaults:
+		self.__fail( 'Invalid option %s.' % optionName )
+	  options[optionName]['value'] = value
 	return self.__sanitizeOptions( options )
 
 
@@ -52,11 +70,9 @@ class Options():
 	  try:
 		optionValue['value'] = int( optionValue['value'], 10 )
 	  except ( TypeError, ValueError ):
-		logging.error( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
-		sys.exit(1)
+		self.__fail( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
 	if optionValue['value'] < optionValue['min'] or optionValue['value'] > optionValue['max']:
-		logging.error( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
-		sys.exit(1)
+		self.__fail( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
 	return optionValue
 
   def __sanitizeFloat( self, optionName, optionValue ):
@@ -64,11 +80,9 @@ class Options():
 	  try:
 		optionValue['value'] = float( optionValue['value'] )
 	  except ( TypeError, ValueError ):
-		logging.error( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
-		sys.exit(1)
+		self.__fail( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
 	if optionValue['value'] < optionValue['min'] or optionValue['value'] > optionValue['max']:
-		logging.error( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
-		sys.exit(1)
+		self.__fail( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
 	return optionValue
 
   def __sanitizeHex( self, optionName, optionValue ):
@@ -76,26 +90,22 @@ class Options():
 	  try:
 		optionValue['value'] = int( optionValue['value'], 16 )
 	  except ( TypeError, ValueError ):
-		logging.error( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
-		sys.exit(1)
+		self.__fail( 'Invalid argument %s for option -%s.' % ( optionValue['value'], optionName ) )
 	if optionValue['value'] < optionValue['min'] or optionValue['value'] > optionValue['max']:
-		logging.error( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
-		sys.exit(1)
+		self.__fail( 'Argument %s for option -%s is out of allowed range %s - %s.' % ( optionValue['value'], optionName, optionValue['min'], optionValue['max'] ) )
 	return optionValue
 	
 	
   def __sanitizeStr( self, optionName, optionValue ):
 	if len( optionValue ) < 1:
-		logging.error( 'Argument %s for option -%s is invalid.' % ( optionValue['value'], optionName ) )
-		sys.exit(1)
+		self.__fail( 'Argument %s for option -%s is invalid.' % ( optionValue['value'], optionName ) )
 	return optionValue
 
 
   def __sanitizeBool( self, optionName, optionValue ):
 	if type( optionValue['value'] ) is str:
 	  if optionValue['value'] not in ( 'on', 'off' ):
-		logging.error( 'Argument %s for option -%s is invalid. Only on and off are allowed.' % ( optionValue['value'], optionName ) )
-		sys.exit(1)
+		self.__fail( 'Argument %s for option -%s is invalid. Only on and off are allowed.' % ( optionValue['value'], optionName ) )
 	  optionValue['value'] = True if optionValue['value'] == 'on' else False
 	return optionValue
 	